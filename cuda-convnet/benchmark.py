@@ -0,0 +1,247 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Benchmarks for the Python side of the training pipeline.
+#
+# Usage: python benchmark.py <benchmark> [options]
+# Run without arguments to list the available benchmarks.
+
+from data import *
+from layer import StandInRunner
+from options import *
+from ordereddict import OrderedDict
+import shutil
+import subprocess
+import sys
+import tempfile
+
+benchmarks = OrderedDict()
+
+def register_benchmark(name, desc, func, get_options_parser):
+    benchmarks[name] = (desc, func, get_options_parser)
+
+def make_jpeg(img_size, quality=90):
+    # Smooth noise compresses more like a photograph than white noise does
+    small = (nr.rand(img_size / 8, img_size / 8, 3) * 255).astype(n.uint8)
+    img = Image.fromarray(small).resize((img_size, img_size), Image.BICUBIC)
+    out = c.StringIO()
+    img.save(out, 'jpeg', quality=quality)
+    return out.getvalue()
+
+# Writes num_batches LevelDB batches of random JPEGs in the layout imagenet_mapper produces.
+def make_imagenet_batches(data_dir, num_batches, batch_size, img_size):
+    pickle(os.path.join(data_dir, BATCH_META_FILE), {'label_names': ['%d' % i for i in xrange(1000)],
+                                                     'img_size': img_size})
+    jpegs = [make_jpeg(img_size) for i in xrange(64)]
+    for b in xrange(1, num_batches + 1):
+        db = leveldb.LevelDB(os.path.join(data_dir, 'batch-%d' % b))
+        wb = leveldb.WriteBatch()
+        for i in xrange(batch_size):
+            wb.Put('n%08d_%d.JPEG' % (i % 1000, i), cPickle.dumps({'data': jpegs[i % len(jpegs)], 'label': i % 1000}, -1))
+        db.Write(wb)
+        del db
+
+def bench_imagenet_decode(op):
+    data_dir = tempfile.mkdtemp(prefix='imagenet-bench-')
+    try:
+        num_batches, batch_size = op.get_value('num_batches'), op.get_value('batch_size')
+        make_imagenet_batches(data_dir, num_batches, batch_size, op.get_value('img_size'))
+        print "%-10s %12s" % ("workers", "images/sec")
+        for workers in op.get_value('workers'):
+            dp = ImageNetDataProvider(data_dir, range(1, num_batches + 1), dp_params={'decode_workers': workers})
+            dp.load_batch(1) # warm up the pool
+            start = time()
+            for b in xrange(1, num_batches + 1):
+                images, labels = dp.load_batch(b)
+            elapsed = time() - start
+            print "%-10d %12.1f" % (workers, num_batches * batch_size / elapsed)
+            if dp.pool:
+                dp.pool.terminate()
+    finally:
+        shutil.rmtree(data_dir)
+
+def imagenet_decode_options():
+    op = OptionsParser()
+    op.add_option("batches", "num_batches", IntegerOptionParser, "Number of batches", default=4)
+    op.add_option("batch-size", "batch_size", IntegerOptionParser, "Images per batch", default=2048)
+    op.add_option("img-size", "img_size", IntegerOptionParser, "Image size", default=64)
+    op.add_option("workers", "workers", ListOptionParser(IntegerOptionParser), "Decode worker counts to try",
+                  default=sorted(set([1, 2, 4, multiprocessing.cpu_count()])))
+    return op
+
+register_benchmark('imagenet-decode', 'ImageNetDataProvider decode throughput on a synthetic LevelDB', bench_imagenet_decode, imagenet_decode_options)
+
+# Runs exchange.py's scaling benchmark under mpirun for each number of ranks.
+def bench_exchange_scaling(op):
+    exchange_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exchange.py')
+    print "%-6s %12s %11s %12s %12s" % ("ranks", "images/sec", "efficiency", "compute sec", "exchange sec")
+    base = None
+    for ranks in op.get_value('ranks'):
+        out = subprocess.check_output(op.get_value('mpirun').split() + ['-np', str(ranks), sys.executable, exchange_py, 'benchmark',
+                                      op.get_value('mode'), str(op.get_value('num_batches')), str(op.get_value('exchange_freq')),
+                                      str(op.get_value('fake_hosts'))])
+        fields = out.split()
+        result = dict(zip(fields[::2], fields[1::2]))
+        images_per_sec = float(result['images/sec'])
+        base = base or images_per_sec / ranks
+        print "%-6d %12.1f %10.1f%% %12s %12s" % (ranks, images_per_sec, 100 * images_per_sec / (ranks * base), result['compute'], result['exchange'])
+
+def exchange_scaling_options():
+    op = OptionsParser()
+    op.add_option("ranks", "ranks", ListOptionParser(IntegerOptionParser), "Numbers of ranks to try", default=[1, 2, 4, 8])
+    op.add_option("mode", "mode", StringOptionParser, "Exchange mode (best/average)", default="average")
+    op.add_option("batches", "num_batches", IntegerOptionParser, "Batches per run", default=40)
+    op.add_option("exchange-freq", "exchange_freq", IntegerOptionParser, "Exchange frequency", default=1)
+    op.add_option("fake-hosts", "fake_hosts", IntegerOptionParser, "Exchange through the leaders of this many pretend hosts (0 for a flat exchange)", default=0)
+    op.add_option("mpirun", "mpirun", StringOptionParser, "MPI launcher command", default="mpirun --oversubscribe")
+    return op
+
+register_benchmark('exchange-scaling', 'Scaling efficiency of weight exchange with a CPU stand-in model', bench_exchange_scaling, exchange_scaling_options)
+
+# Runs exchange.py's codec regression under mpirun for each codec: softmax
+# regression on dummy-cn-n batches with compressed and with exact averaging.
+def bench_exchange_codec(op):
+    exchange_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exchange.py')
+    print "%-16s %9s %11s %11s %7s %10s %10s" % ("codec", "cost", "exact cost", "divergence", "ratio", "encode ms", "decode ms")
+    regressed = False
+    for codec in op.get_value('codecs'):
+        out = subprocess.check_output(op.get_value('mpirun').split() + ['-np', str(op.get_value('ranks')), sys.executable, exchange_py, 'regression',
+                                      codec, str(op.get_value('num_batches')), str(op.get_value('exchange_freq'))])
+        fields = out.split()
+        result = dict(zip(fields[::2], fields[1::2]))
+        cost, exact_cost = float(result['cost']), float(result['exact_cost'])
+        ok = cost <= exact_cost * (1 + op.get_value('tolerance'))
+        regressed = regressed or not ok
+        print "%-16s %9.5f %11.5f %11s %6sx %10s %10s %s" % (codec, cost, exact_cost, result['divergence'], result['ratio'],
+                                                          result['encode_ms'], result['decode_ms'], "" if ok else "REGRESSED")
+    if regressed:
+        sys.exit(1)
+
+def exchange_codec_options():
+    op = OptionsParser()
+    op.add_option("codecs", "codecs", ListOptionParser(StringOptionParser, sepchar=';'), "Exchange codecs to try, separated by semicolons",
+                  default=['zlib', 'fp16', 'fp16,zlib', 'topk:0.01', 'topk:0.1,zlib'])
+    op.add_option("ranks", "ranks", IntegerOptionParser, "Number of ranks", default=4)
+    op.add_option("batches", "num_batches", IntegerOptionParser, "Batches per run", default=200)
+    op.add_option("exchange-freq", "exchange_freq", IntegerOptionParser, "Exchange frequency", default=5)
+    op.add_option("tolerance", "tolerance", FloatOptionParser, "Allowed relative increase of the final cost", default=0.01)
+    op.add_option("mpirun", "mpirun", StringOptionParser, "MPI launcher command", default="mpirun --oversubscribe")
+    return op
+
+register_benchmark('exchange-codec', 'Convergence and compression of exchange codecs on dummy-cn-n', bench_exchange_codec, exchange_codec_options)
+
+# Returns the checkpoint in --load-file, or a checkpoint of the freshly
+# initialized model in --layer-def.
+def get_benchmark_checkpoint(op):
+    from checkpoint import load_checkpoint, list_checkpoints
+    import layer as lay
+    load_file = op.get_value('load_file')
+    if load_file:
+        if os.path.isdir(load_file):
+            load_file = os.path.join(load_file, list_checkpoints(load_file)[-1])
+        return load_checkpoint(load_file, lazy=False)
+    model = StandInRunner(op.get_value('data_dims'), op.get_value('num_classes'))
+    layers = lay.LayerParser.parse_layers(op.get_value('layer_def'), op.get_value('layer_params'), model, layers=[])
+    return {'model_state': {'layers': layers, 'epoch': 1, 'batchnum': 1, 'train_outputs': [], 'test_outputs': []}, 'op': model.op}
+
+# Raises CheckpointError unless every layer array in loaded, a checkpoint read
+# back from disk, has the value and memory order of its counterpart in dic.
+def check_checkpoint_arrays(dic, loaded):
+    from checkpoint import CheckpointError
+    for l, ll in zip(dic['model_state']['layers'], loaded['model_state']['layers']):
+        for key, v in l.iteritems():
+            if isinstance(v, n.ndarray):
+                pairs = [(v, ll[key])]
+            elif isinstance(v, list) and v and isinstance(v[0], n.ndarray):
+                pairs = zip(v, ll[key])
+            else:
+                continue
+            for i, (a, b) in enumerate(pairs):
+                if (a.flags.c_contiguous, a.flags.f_contiguous) != (b.flags.c_contiguous, b.flags.f_contiguous) or not n.array_equal(a, b):
+                    raise CheckpointError("Layer '%s' %s[%d] changed in a save and load" % (l['name'], key, i))
+
+def bench_checkpoint_codec(op):
+    from checkpoint import write_checkpoint, load_checkpoint, snapshot_state
+    state = get_benchmark_checkpoint(op)
+    # Written as the training loop writes them, through the snapshot CheckpointWriter takes
+    dic = snapshot_state(state)
+    save_dir = tempfile.mkdtemp(prefix='checkpoint-bench-')
+    try:
+        filename = os.path.join(save_dir, 'checkpoint')
+        write_checkpoint(filename, dic)
+        check_checkpoint_arrays(state, load_checkpoint(filename, lazy=False))
+        raw_size = os.path.getsize(filename)
+        print "%.1f MB uncompressed" % (raw_size / 1024.0**2)
+        print "%-20s %10s %12s %12s" % ("codec", "ratio", "write MB/s", "read MB/s")
+        for codec in op.get_value('codecs'):
+            write_time = read_time = None
+            for i in xrange(op.get_value('repeat')):
+                start = time()
+                write_checkpoint(filename, dic, codec)
+                write_time = min(write_time or 1e9, time() - start)
+                start = time()
+                loaded = load_checkpoint(filename)
+                read_time = min(read_time or 1e9, time() - start)
+            check_checkpoint_arrays(state, loaded)
+            size = os.path.getsize(filename)
+            print "%-20s %10.2f %12.1f %12.1f" % (codec, float(raw_size) / size, raw_size / 1024.0**2 / write_time, raw_size / 1024.0**2 / read_time)
+    finally:
+        shutil.rmtree(save_dir)
+
+def checkpoint_codec_options():
+    op = OptionsParser()
+    op.add_option("load-file", "load_file", StringOptionParser, "Checkpoint to compress (default: a new model built from --layer-def)", default="")
+    op.add_option("layer-def", "layer_def", StringOptionParser, "Layer definition file", default="example-layers/layers-18pct.cfg")
+    op.add_option("layer-params", "layer_params", StringOptionParser, "Layer parameter file", default="example-layers/layer-params-18pct.cfg")
+    op.add_option("data-dims", "data_dims", IntegerOptionParser, "Data dimensionality of the --layer-def model", default=3072)
+    op.add_option("num-classes", "num_classes", IntegerOptionParser, "Number of classes of the --layer-def model", default=10)
+    op.add_option("codecs", "codecs", ListOptionParser(StringOptionParser, sepchar=';'), "Checkpoint codecs to try, separated by semicolons",
+                  default=['zip', 'fast', 'default', 'best', 'zlib:1', 'bz2:9'])
+    op.add_option("repeat", "repeat", IntegerOptionParser, "Runs to take the best of", default=3)
+    return op
+
+register_benchmark('checkpoint-codec', 'Compression ratio and throughput of checkpoint codecs', bench_checkpoint_codec, checkpoint_codec_options)
+
+def print_benchmarks():
+    print "Usage: %s <benchmark> [options]" % os.path.basename(sys.argv[0])
+    print ""
+    longest = max(len(name) for name in benchmarks)
+    for name, (desc, func, get_options_parser) in benchmarks.iteritems():
+        print "    %s  %s" % (name.ljust(longest), desc)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print_benchmarks()
+        sys.exit(1)
+    desc, func, get_options_parser = benchmarks[sys.argv[1]]
+    del sys.argv[1]
+    op = get_options_parser()
+    try:
+        op.parse()
+        op.eval_expr_defaults()
+    except OptionException, e:
+        print e
+        op.print_usage()
+        sys.exit(1)
+    func(op)
@@ -0,0 +1,415 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Checkpoints are written by a background thread so that the training loop only
+# pays for copying the model state, not for pickling, compressing and writing it.
+#
+# Uncompressed checkpoints are batch files (see util.py) with their own magic
+# string. The state dictionary is pickled into the "state" array with every
+# numpy array in it replaced by a reference to an array stored next to it, so
+# that loading a checkpoint only unpickles the options and small state and maps
+# the weights into memory.
+
+from util import *
+from codec import CODEC_MAGIC, pickle_without_arrays, unpickle_with_arrays
+from codec import dump_arrays as codec_dump_arrays, load_arrays as codec_load_arrays
+from multiprocessing.pool import ThreadPool
+from ordereddict import OrderedDict
+from time import time
+import cPickle
+import heapq
+import os
+import re
+import struct
+import threading
+import zipfile
+
+# Suffix of checkpoints that are still being written.
+TEMP_SUFFIX = '.tmp'
+# Lists the checkpoints in a checkpoint directory with their sizes.
+MANIFEST_FILE = 'manifest'
+
+# Magic string of uncompressed checkpoints.
+CHECKPOINT_MAGIC = 'CCNCKPT1'
+# Name of the array holding the pickled state in an uncompressed checkpoint.
+STATE_ARRAY = 'state'
+
+class CheckpointError(Exception):
+    pass
+
+def write_checkpoint(filename, dic, codec='', base=None):
+    """Writes dic to filename, compressed with codec (see codec.py, or "zip" for
+    a zip-compressed pickle) if one is given and otherwise as an uncompressed
+    checkpoint. The checkpoint is written under a temporary name, synced to disk
+    and renamed into place, so filename never holds a partial checkpoint.
+    
+    If base, a (name, arrays) pair describing a full checkpoint in the same
+    directory, is given, a delta checkpoint against it is written instead.
+    Returns the checkpoint's arrays (an OrderedDict of name --> array) if it
+    can be the base of delta checkpoints, and None otherwise."""
+    tmp_filename = filename + TEMP_SUFFIX
+    arrays = None
+    if codec == ZIP_CODEC and base is None:
+        fo = open(tmp_filename, 'wb')
+        zf = zipfile.ZipFile(fo, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        zf.writestr('data', cPickle.dumps(dic, -1))
+        zf.close()
+    else:
+        state, arrays = pickle_without_arrays(dic)
+        arrays = OrderedDict(arrays)
+        if base is not None:
+            fo = open(tmp_filename, 'wb')
+            write_delta(fo, state, arrays, base, DELTA_CODEC if codec in ('', ZIP_CODEC) else codec)
+            arrays = None
+        elif codec:
+            fo = open(tmp_filename, 'wb')
+            codec_dump_arrays(fo, state, arrays.items(), codec)
+        else:
+            maps = create_batch_file(tmp_filename, [(STATE_ARRAY, n.uint8, (len(state),))] +
+                                                   [(name, a.dtype, a.shape) for name, a in arrays.iteritems()], magic=CHECKPOINT_MAGIC)
+            maps[STATE_ARRAY][...] = n.frombuffer(state, dtype=n.uint8)
+            for name, a in arrays.iteritems():
+                maps[name][...] = a
+            for m in maps.values():
+                m.flush()
+            del maps
+            fo = open(tmp_filename, 'rb')
+    fo.flush()
+    os.fsync(fo.fileno())
+    fo.close()
+    os.rename(tmp_filename, filename)
+    return arrays
+
+# Delta checkpoints: DELTA_MAGIC, the length of the base checkpoint's name and
+# the name, followed by a compressed pickle (see codec.py) of the state and
+# arrays. An array shaped like the base's array of the same name is stored
+# XORed with it under XOR_PREFIX + its name: weights that changed little since
+# the base share their sign, exponent and leading mantissa bits with it, so
+# the XOR is mostly zero bits and compresses far better than the weights.
+DELTA_MAGIC = 'CCNDELTA'
+XOR_PREFIX = 'xor:'
+# Codec of delta checkpoints when checkpoints are not compressed with a codec.
+DELTA_CODEC = 'fast'
+
+def _xor(a, b):
+    uint = n.dtype('u%d' % a.itemsize)
+    return n.bitwise_xor(a.view(uint), b.view(uint)).view(a.dtype)
+
+def _can_xor(a, b):
+    return a.dtype == b.dtype and a.shape == b.shape and a.itemsize in (1, 2, 4, 8)
+
+def write_delta(fo, state, arrays, base, codec):
+    base_name, base_arrays = base
+    delta = []
+    for name, a in arrays.iteritems():
+        if name in base_arrays and _can_xor(a, base_arrays[name]):
+            delta += [(XOR_PREFIX + name, _xor(a, base_arrays[name]))]
+        else:
+            delta += [(name, a)]
+    fo.write(DELTA_MAGIC + struct.pack('<I', len(base_name)) + base_name)
+    codec_dump_arrays(fo, state, delta, codec)
+
+# Returns the name of the checkpoint that the checkpoint in filename is a
+# delta against, or None if it is a full checkpoint.
+def read_delta_base(filename):
+    fo = open(filename, 'rb')
+    base_name = None
+    if fo.read(len(DELTA_MAGIC)) == DELTA_MAGIC:
+        base_name = fo.read(struct.unpack('<I', fo.read(4))[0])
+    fo.close()
+    return base_name
+
+# Returns the pickled state and an OrderedDict of name --> array of the
+# checkpoint in filename, which must be uncompressed, compressed with a codec
+# or a delta checkpoint.
+def read_checkpoint_arrays(filename, lazy=True, workers=4):
+    magic = read_magic(filename)
+    if magic == CHECKPOINT_MAGIC:
+        maps = open_batch_file(filename, magic=CHECKPOINT_MAGIC)
+        state = maps.pop(STATE_ARRAY).tostring()
+        if lazy:
+            return state, OrderedDict((name, m.view(n.ndarray)) for name, m in maps.iteritems())
+        pool = ThreadPool(workers)
+        arrays = OrderedDict(zip(maps.keys(), pool.map(n.array, maps.values(), chunksize=1)))
+        pool.close()
+        return state, arrays
+    if magic == CODEC_MAGIC:
+        fo = open(filename, 'rb')
+        state, arrays = codec_load_arrays(fo)
+        fo.close()
+        return state, arrays
+    if magic == DELTA_MAGIC:
+        fo = open(filename, 'rb')
+        fo.seek(len(DELTA_MAGIC))
+        base_name = fo.read(struct.unpack('<I', fo.read(4))[0])
+        state, delta = codec_load_arrays(fo)
+        fo.close()
+        base_state, base_arrays = read_checkpoint_arrays(os.path.join(os.path.dirname(filename), base_name))
+        arrays = OrderedDict()
+        for name, a in delta.iteritems():
+            if name.startswith(XOR_PREFIX):
+                name = name[len(XOR_PREFIX):]
+                a = _xor(a, base_arrays[name])
+            arrays[name] = a
+        return state, arrays
+    raise CheckpointError("Checkpoint '%s' holds no separately stored arrays." % filename)
+
+def load_checkpoint(filename, lazy=True, workers=4):
+    """Loads the state dictionary written by write_checkpoint or pickle().
+    
+    The arrays of an uncompressed checkpoint are mapped copy-on-write: with lazy,
+    they are read from disk when first touched, so loading only costs unpickling
+    the small state. Otherwise they are read into memory up front by workers
+    threads. A delta checkpoint is applied to its base, which is read in full."""
+    if not os.path.exists(filename):
+        raise UnpickleError("Path '%s' does not exist." % filename)
+    if read_magic(filename) not in (CHECKPOINT_MAGIC, DELTA_MAGIC):
+        return unpickle(filename)
+    return unpickle_with_arrays(*read_checkpoint_arrays(filename, lazy, workers))
+
+# Checkpoints are named epoch.batchnum. Other files in a checkpoint directory are left alone.
+CHECKPOINT_NAME_PATTERN = re.compile(r'^(\d+)\.(\d+)$')
+
+# Returns the names of the complete checkpoints in checkpoint_dir, oldest first.
+def list_checkpoints(checkpoint_dir):
+    return sorted([f for f in os.listdir(checkpoint_dir) if CHECKPOINT_NAME_PATTERN.match(f)], key=alphanum_key)
+
+class CheckpointManifest:
+    """Records the size, epoch, batch, test error and delta base of every
+    checkpoint in a directory, oldest first, so that retention never has to
+    stat the directory.
+    
+    The manifest is a text file with one "name size epoch batchnum test_error
+    base" line per checkpoint. If it is missing, it is rebuilt from the
+    directory listing once, without test errors."""
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.filename = os.path.join(checkpoint_dir, MANIFEST_FILE)
+        self.entries = OrderedDict()
+        if os.path.exists(self.filename):
+            for line in open(self.filename):
+                # manifests from before delta checkpoints have no base column
+                name, size, epoch, batchnum, test_error, base = (line.split() + ['-'])[:6]
+                if not CHECKPOINT_NAME_PATTERN.match(name): # written by a version that listed every file
+                    continue
+                self.entries[name] = {'size': int(size),
+                                      'epoch': int(epoch),
+                                      'batchnum': int(batchnum),
+                                      'test_error': None if test_error == '-' else float(test_error),
+                                      'base': None if base == '-' else base}
+        elif os.path.exists(checkpoint_dir):
+            for name in list_checkpoints(checkpoint_dir):
+                epoch, batchnum = map(int, CHECKPOINT_NAME_PATTERN.match(name).groups())
+                path = os.path.join(checkpoint_dir, name)
+                self.add(name, os.path.getsize(path), epoch, batchnum, base=read_delta_base(path))
+        
+    def add(self, name, size, epoch, batchnum, test_error=None, base=None):
+        self.entries.pop(name, None)
+        self.entries[name] = {'size': size, 'epoch': epoch, 'batchnum': batchnum, 'test_error': test_error, 'base': base}
+        
+    def save(self):
+        tmp_filename = self.filename + TEMP_SUFFIX
+        fo = open(tmp_filename, 'w')
+        for name, e in self.entries.iteritems():
+            fo.write("%s %d %s %s %s %s\n" % (name, e['size'], e['epoch'], e['batchnum'], '-' if e['test_error'] is None else repr(e['test_error']),
+                                              e['base'] or '-'))
+        fo.close()
+        os.rename(tmp_filename, self.filename)
+    
+    # Deletes the checkpoints the policy does not keep and saves the manifest.
+    # Returns the names of the deleted checkpoints.
+    def prune(self, policy):
+        deleted = policy.select_for_deletion(self.entries)
+        for name in deleted:
+            del self.entries[name]
+            try:
+                os.remove(os.path.join(self.checkpoint_dir, name))
+            except OSError: # already deleted by hand
+                pass
+        self.save()
+        return deleted
+
+class RetentionPolicy:
+    """Decides which checkpoints to delete. The newest keep_last checkpoints, the
+    keep_best with the lowest test error and the last checkpoint of every
+    keep_every-th epoch are kept, as are the bases of kept delta checkpoints. Of
+    the rest, the oldest are deleted until the checkpoints take up at most
+    max_bytes; deleting a base deletes the deltas against it too. The newest
+    checkpoint is always kept."""
+    def __init__(self, max_bytes, keep_last=1, keep_best=0, keep_every=0):
+        self.max_bytes = max_bytes
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_every = keep_every
+        
+    def get_kept(self, entries):
+        names = entries.keys()
+        kept = set(names[-max(1, self.keep_last):])
+        if self.keep_best > 0:
+            kept.update(heapq.nsmallest(self.keep_best, [name for name in names if entries[name]['test_error'] is not None],
+                                        key=lambda name: entries[name]['test_error']))
+        if self.keep_every > 0:
+            last_of_epoch = {}
+            for name in names:
+                if entries[name]['epoch'] % self.keep_every == 0:
+                    last_of_epoch[entries[name]['epoch']] = name
+            kept.update(last_of_epoch.values())
+        kept.update([entries[name]['base'] for name in kept if entries[name].get('base') in entries])
+        return kept
+    
+    # Returns the names in entries (an ordered dict of name --> manifest entry) to delete.
+    def select_for_deletion(self, entries):
+        if not entries:
+            return []
+        kept = self.get_kept(entries)
+        deltas = {}
+        for name, e in entries.iteritems():
+            deltas.setdefault(e.get('base'), []).append(name)
+        total = sum(e['size'] for e in entries.itervalues())
+        deleted = []
+        for name in entries:
+            if total <= self.max_bytes:
+                break
+            if name in kept or name in deleted:
+                continue
+            for d in [name] + deltas.get(name, []):
+                if d not in deleted:
+                    deleted += [d]
+                    total -= entries[d]['size']
+        return deleted
+
+# Returns a copy of the state dictionary dic that the training loop cannot
+# modify under the writer thread. Only the layers' arrays are copied, since the
+# model writes the weights back into them in place; the rest is copied shallowly,
+# lists included, which the training loop appends to. Arrays shared between
+# layers stay shared in the copy, and Fortran-ordered arrays stay Fortran-ordered.
+def snapshot_state(dic):
+    copies = {}
+    def copy_array(a):
+        if id(a) not in copies:
+            copies[id(a)] = a.copy(order='K')
+        return copies[id(a)]
+    def copy_value(v):
+        if isinstance(v, n.ndarray):
+            return copy_array(v)
+        if isinstance(v, list) and any(isinstance(a, n.ndarray) for a in v):
+            return [copy_value(a) for a in v]
+        return v
+    snapshot = dict(dic)
+    if 'model_state' in dic:
+        ms = snapshot['model_state'] = dict(dic['model_state'])
+        for k, v in ms.iteritems():
+            if isinstance(v, list):
+                ms[k] = list(v)
+        if 'layers' in ms:
+            layers = OrderedDict((id(l), dict((k, copy_value(v)) for k, v in l.iteritems())) for l in ms['layers'])
+            # inputLayers refers to the input layers themselves, weights and all.
+            for l in layers.itervalues():
+                if 'inputLayers' in l:
+                    l['inputLayers'] = [layers[id(inp)] for inp in l['inputLayers']]
+            ms['layers'] = layers.values()
+    return snapshot
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread, one at a time.
+    
+    save() copies the state it is given, so the caller can go on modifying it,
+    and returns once the copy is made. If the previous checkpoint is still being
+    written it waits for it first. An error in the writer thread is raised by
+    the next call to save() or wait().
+    
+    With full_save_freq > 1, only every full_save_freq-th checkpoint is written
+    in full, and the others as deltas against the last full one, whose arrays
+    are kept in memory for that. last_base is the name of the checkpoint that
+    the last checkpoint written is a delta against, or None."""
+    def __init__(self, full_save_freq=1):
+        self.full_save_freq = full_save_freq
+        self.base = None
+        self.saves_since_base = 0
+        self.last_base = None
+        self.thread = None
+        self.error = None
+        self.saves = 0
+        self.wait_time = 0.0
+        self.pending_wait_time = None
+        self.last_write_time = 0.0
+        
+    # Starts writing dic to filename. after_write, if given, is called on
+    # the writer thread once the checkpoint is in place.
+    def save(self, filename, dic, codec='', after_write=None):
+        start = time()
+        self.wait()
+        snapshot = snapshot_state(dic)
+        self.__add_wait_time(time() - start)
+        
+        self.thread = threading.Thread(target=self.__write, args=(filename, snapshot, codec, after_write))
+        self.thread.start()
+        self.saves += 1
+        
+    def __write(self, filename, dic, codec, after_write):
+        try:
+            start = time()
+            base = self.__get_base(filename)
+            arrays = write_checkpoint(filename, dic, codec, base=base)
+            if self.full_save_freq > 1 and arrays is not None:
+                self.base, self.saves_since_base = (filename, arrays), 0
+            self.saves_since_base += 1
+            self.last_base = base and base[0]
+            self.last_write_time = time() - start
+            if after_write is not None:
+                after_write()
+        except Exception, e:
+            self.error = e
+    
+    # Returns the (name, arrays) of the checkpoint to write filename as a delta
+    # against, or None to write it in full.
+    def __get_base(self, filename):
+        if self.base is None or self.saves_since_base >= self.full_save_freq:
+            return None
+        base_filename, arrays = self.base
+        if os.path.dirname(base_filename) != os.path.dirname(filename) or not os.path.exists(base_filename):
+            return None
+        return os.path.basename(base_filename), arrays
+    
+    # Blocks until the checkpoint in flight, if any, has been written.
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise CheckpointError("Error writing checkpoint: %s" % e)
+        
+    def is_busy(self):
+        return self.thread is not None and self.thread.is_alive()
+    
+    def __add_wait_time(self, wait_time):
+        self.wait_time += wait_time
+        self.pending_wait_time = (self.pending_wait_time or 0) + wait_time
+        
+    # Returns the time save() has blocked the caller since the last call,
+    # or None if save() has not been called since.
+    def take_wait_time(self):
+        wait_time, self.pending_wait_time = self.pending_wait_time, None
+        return wait_time
@@ -0,0 +1,204 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# Compressed pickles for checkpoints and data batches.
+#
+# A codec is a comma-separated list of stages: an optional "shuffle" filter,
+# which stores the first bytes of every array element together, then the second
+# bytes and so on, followed by a compressor with an optional level, e.g.
+# "shuffle,zlib:1" or "bz2:9". Shuffling makes float32 arrays compress much
+# better, since neighbouring weights mostly share their sign and exponent bytes.
+#
+# Arrays are compressed in chunks on a pool of threads (zlib and bz2 release
+# the interpreter lock), and written as they are compressed. The file is the
+# magic string, the chunks, a header listing the codec and every array's
+# (name, dtype, shape, chunk sizes), and the header's offset. The pickled
+# state, with its arrays replaced by references, is stored as the first array.
+
+from multiprocessing.pool import ThreadPool
+from ordereddict import OrderedDict
+import bz2
+import cPickle
+import cStringIO
+import multiprocessing
+import numpy as n
+import struct
+import zlib
+from ast import literal_eval
+
+CODEC_MAGIC = 'CCNCODEC'
+# Uncompressed bytes per chunk.
+CHUNK_SIZE = 4 * 1024 * 1024
+# Name of the array holding the pickled state.
+STATE_ARRAY = 'state'
+
+class CodecException(Exception):
+    pass
+
+# name --> (compress(data, level), decompress(data), default level, (min level, max level))
+compressors = OrderedDict([('zlib', (zlib.compress, zlib.decompress, 6, (0, 9))),
+                           ('bz2', (bz2.compress, bz2.decompress, 9, (1, 9))),
+                           ('none', (lambda data, level: str(data), lambda data: data, 0, (0, 0)))])
+
+# Named speed/ratio trade-offs.
+codec_levels = OrderedDict([('fast', 'shuffle,zlib:1'),
+                            ('default', 'shuffle,zlib:6'),
+                            ('best', 'shuffle,bz2:9')])
+
+# Pickles data with its arrays replaced by (name, fortran) references. Returns
+# the pickle and a list of (name, array) pairs holding the arrays, each stored
+# C-ordered (transposed if it was Fortran-ordered). An array that appears
+# several times, like a shared weight matrix, is stored once.
+def pickle_without_arrays(data):
+    arrays, refs = [], {}
+    def persistent_id(obj):
+        if type(obj) not in (n.ndarray, n.memmap) or obj.dtype.hasobject:
+            return None
+        if id(obj) not in refs:
+            fortran = obj.ndim > 1 and obj.flags.f_contiguous and not obj.flags.c_contiguous
+            name = 'array-%d' % len(arrays)
+            arrays.append((name, n.ascontiguousarray(obj.T if fortran else obj)))
+            refs[id(obj)] = (name, fortran)
+        return refs[id(obj)]
+    out = cStringIO.StringIO()
+    pickler = cPickle.Pickler(out, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(data)
+    return out.getvalue(), arrays
+
+# Unpickles what pickle_without_arrays returned, given a dict of name --> array.
+def unpickle_with_arrays(state, arrays):
+    loaded = {}
+    def persistent_load(ref):
+        name, fortran = ref
+        if name not in loaded:
+            loaded[name] = arrays[name].T if fortran else arrays[name]
+        return loaded[name]
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(state))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+class Codec:
+    def __init__(self, spec):
+        self.spec = codec_levels.get(spec, spec)
+        stages = [s.strip() for s in self.spec.split(',')]
+        self.shuffle = stages[0] == 'shuffle'
+        if self.shuffle:
+            stages = stages[1:]
+        if len(stages) != 1:
+            raise CodecException("Codec '%s': expected an optional shuffle stage and one compressor" % spec)
+        name, level = (stages[0].split(':') + [None])[:2]
+        if name not in compressors:
+            raise CodecException("Codec '%s': unknown compressor '%s'; expected one of %s" % (spec, name, ", ".join(compressors)))
+        self.compress_func, self.decompress_func, default_level, (min_level, max_level) = compressors[name]
+        try:
+            self.level = default_level if level is None else int(level)
+        except ValueError:
+            raise CodecException("Codec '%s': level must be an integer" % spec)
+        if not min_level <= self.level <= max_level:
+            raise CodecException("Codec '%s': level must be between %d and %d" % (spec, min_level, max_level))
+        
+    # Compresses a chunk of an array, given as a (elements, itemsize) uint8 array.
+    def compress_chunk(self, chunk):
+        if self.shuffle:
+            chunk = n.ascontiguousarray(chunk.T)
+        return self.compress_func(buffer(chunk), self.level)
+    
+    # Decompresses data into out, a (elements, itemsize) uint8 array.
+    def decompress_chunk(self, chunk):
+        data, out = chunk
+        data = n.frombuffer(self.decompress_func(data), dtype=n.uint8)
+        if self.shuffle:
+            out[...] = data.reshape(out.shape[::-1]).T
+        else:
+            out.reshape(-1)[...] = data
+
+# Returns the chunks of array a, each a view of up to CHUNK_SIZE bytes of it as
+# a (elements, itemsize) uint8 array.
+def _chunks(a):
+    elements = a.reshape(-1, 1).view(n.uint8)
+    step = max(1, CHUNK_SIZE / a.itemsize)
+    return [elements[start:start + step] for start in xrange(0, max(1, a.size), step)]
+
+def get_pool(workers=0):
+    return ThreadPool(workers or multiprocessing.cpu_count())
+
+def dump(fo, data, codec, pool=None):
+    """Writes data, compressed with codec (a Codec or its spec), to the open file fo."""
+    state, arrays = pickle_without_arrays(data)
+    dump_arrays(fo, state, arrays, codec, pool)
+
+def load(fo, pool=None):
+    """Reads data written by dump() from the open file fo, decompressing on pool."""
+    state, arrays = load_arrays(fo, pool)
+    return unpickle_with_arrays(state, arrays)
+
+# Writes what pickle_without_arrays returned to fo, compressed with codec.
+def dump_arrays(fo, state, arrays, codec, pool=None):
+    codec = codec if isinstance(codec, Codec) else Codec(codec)
+    own_pool = pool is None
+    pool = pool or get_pool()
+    try:
+        arrays = [(STATE_ARRAY, n.frombuffer(state, dtype=n.uint8))] + list(arrays)
+        start = fo.tell()
+        fo.write(CODEC_MAGIC)
+        entries = []
+        for name, a in arrays:
+            sizes = []
+            for chunk in pool.imap(codec.compress_chunk, _chunks(a)):
+                fo.write(chunk)
+                sizes += [len(chunk)]
+            entries += [(name, a.dtype.str, a.shape, sizes)]
+        header_offset = fo.tell() - start
+        fo.write(repr({'codec': codec.spec, 'entries': entries}))
+        fo.write(struct.pack('<Q', header_offset))
+    finally:
+        if own_pool:
+            pool.close()
+
+# Reads what dump_arrays wrote, from fo's position to the end of the file.
+# Returns the pickled state and an OrderedDict of name --> array.
+def load_arrays(fo, pool=None):
+    own_pool = pool is None
+    pool = pool or get_pool()
+    try:
+        start = fo.tell()
+        if fo.read(len(CODEC_MAGIC)) != CODEC_MAGIC:
+            raise CodecException("Not a compressed pickle")
+        fo.seek(-8, 2)
+        end = fo.tell()
+        header_offset = struct.unpack('<Q', fo.read(8))[0]
+        fo.seek(start + header_offset)
+        header = literal_eval(fo.read(end - start - header_offset))
+        codec = Codec(header['codec'])
+        
+        fo.seek(start + len(CODEC_MAGIC))
+        arrays = OrderedDict()
+        for name, dtype, shape, sizes in header['entries']:
+            dtype = n.dtype(dtype)
+            arrays[name] = n.empty(shape, dtype=dtype)
+            pool.map(codec.decompress_chunk, zip([fo.read(size) for size in sizes], _chunks(arrays[name])), chunksize=1)
+        return arrays.pop(STATE_ARRAY).tostring(), arrays
+    finally:
+        if own_pool:
+            pool.close()
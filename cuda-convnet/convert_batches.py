@@ -0,0 +1,95 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Converts pickled data_batch_N files (and their .1, .2, ... sub-batches) into
+# memory-mapped data_batch_N.mm files readable by MemmapDataProvider.
+#
+# Usage: python convert_batches.py --src=<dir> --dst=<dir> [--range=1-6] [--raw=1]
+
+from data import *
+from options import *
+import sys
+
+# Rows of data converted at a time, to bound the size of temporaries.
+CONVERT_CHUNK_ROWS = 256
+
+def convert_batch(dp, batch_num, filename, data_mean, raw=False):
+    dic = dp.get_batch(batch_num)
+    data = n.asarray(dic['data'])
+    labels = n.require(n.asarray(dic['labels']).reshape((1, data.shape[1])), dtype=n.single, requirements='C')
+
+    tmp_filename = filename + '.tmp'
+    arrays = create_batch_file(tmp_filename, [('data', data.dtype if raw else n.single, data.shape),
+                                              ('labels', n.single, labels.shape)])
+    if raw:
+        arrays['data'][...] = data
+    else:
+        for r in xrange(0, data.shape[0], CONVERT_CHUNK_ROWS):
+            arrays['data'][r:r+CONVERT_CHUNK_ROWS] = data[r:r+CONVERT_CHUNK_ROWS] - data_mean[r:r+CONVERT_CHUNK_ROWS]
+    arrays['labels'][...] = labels
+    for a in arrays.values():
+        a.flush()
+    del arrays
+    os.rename(tmp_filename, filename)
+    return data.shape
+
+def convert_batches(src_dir, dst_dir, batch_range=None, raw=False):
+    if batch_range is None:
+        batch_range = DataProvider.get_batch_nums(src_dir)
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    dp = DataProvider(src_dir, batch_range)
+    meta = dict(dp.batch_meta)
+    data_mean = n.require(meta['data_mean'], dtype=n.single).reshape((-1, 1))
+    
+    for batch_num in batch_range:
+        filename = os.path.join(dst_dir, 'data_batch_%d.mm' % batch_num)
+        shape = convert_batch(dp, batch_num, filename, data_mean, raw=raw)
+        print "Converted batch %d: %dx%d %s" % (batch_num, shape[0], shape[1], 'raw' if raw else 'mean-subtracted single')
+    
+    meta['dp_type'] = 'memmap'
+    meta['num_vis'] = data_mean.shape[0]
+    meta['data_mean'] = data_mean
+    pickle(os.path.join(dst_dir, BATCH_META_FILE), meta)
+    print "Wrote %s" % os.path.join(dst_dir, BATCH_META_FILE)
+
+def get_options_parser():
+    op = OptionsParser()
+    op.add_option("src", "src_dir", StringOptionParser, "Directory of pickled batches")
+    op.add_option("dst", "dst_dir", StringOptionParser, "Output directory")
+    op.add_option("range", "batch_range", RangeOptionParser, "Batches to convert (default: all)", default=[])
+    op.add_option("raw", "raw", BooleanOptionParser, "Store data in its original type without subtracting the mean?", default=0)
+    return op
+
+if __name__ == "__main__":
+    op = get_options_parser()
+    try:
+        op.parse()
+        op.eval_expr_defaults()
+    except OptionException, e:
+        print e
+        op.print_usage()
+        sys.exit(1)
+    convert_batches(op.get_value('src_dir'), op.get_value('dst_dir'),
+                    batch_range=op.get_value('batch_range') or None, raw=op.get_value('raw'))
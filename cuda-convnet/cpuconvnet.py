@@ -0,0 +1,876 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# A NumPy implementation of the CUDA convnet module, for machines without a GPU.
+#
+# ConvNet runs the layer dicts made by layer.py on the CPU. Like the CUDA
+# ConvNet, it takes workers (TrainingWorker, SyncWorker, ...) from a worker
+# queue on its own thread and puts WorkResults on a result queue, so
+# ConvNetRunner drives either one the same way. The classes and methods that
+# ConvNetRunner calls keep the CUDA module's names.
+#
+# Activities are (dimensions, cases) matrices, with images laid out as
+# (channels, y, x, cases) like cudaconv2. Convolutions unroll the input patches
+# into a matrix (im2col) and multiply it by the filters, one GEMM per filter
+# group. As in the CUDA code, bprop produces the negative gradient of the cost,
+# which the weight update adds.
+#
+# Weights are updated in place in the layer dicts' arrays, so the dicts always
+# hold the current weights and syncing with the host costs nothing.
+#
+# Gradient check: python cpuconvnet.py <layer def> <layer params> [<minibatch size> [<data dims> <classes>]]
+
+from numpy.lib.stride_tricks import as_strided
+from ordereddict import OrderedDict
+from threading import Thread
+import Queue as queue
+import numpy as n
+import os
+import sys
+import traceback
+
+# Same threshold as the CUDA gradient check.
+GC_REL_ERR_THRESH = 0.02
+# Central difference steps. The check runs in double precision, so they can be smaller than on the GPU.
+GC_WEIGHT_STEP = 1e-5
+GC_BIAS_STEP = 1e-5
+# Every entry costs two forward passes on the CPU, so bigger matrices are checked at this many random entries.
+GC_MAX_ENTRIES = 200
+
+class CPUConvNetException(Exception):
+    pass
+
+class Queue(queue.Queue):
+    def enqueue(self, item):
+        self.put(item)
+
+    def dequeue(self):
+        return self.get()
+
+class CPUData:
+    """The data matrices of a batch, each (dimensions, cases)."""
+    def __init__(self, data):
+        self.data = data
+
+    def get_num_cases(self):
+        return self.data[0].shape[1]
+
+    # Cases [start, end) of every matrix, copied like a minibatch moving to the GPU.
+    def get_slice(self, start, end):
+        return [n.ascontiguousarray(d[:, start:end]) for d in self.data]
+
+class Cost:
+    """The summed values of every cost layer over some cases."""
+    def __init__(self, num_cases=0, costs=[]):
+        self.num_cases = num_cases
+        self.cost_map = OrderedDict((c.name, list(c.cost)) for c in costs)
+        self.coeffs = dict((c.name, c.coeff) for c in costs)
+
+    def __iadd__(self, other):
+        for name, values in other.cost_map.iteritems():
+            if name not in self.cost_map:
+                self.cost_map[name] = [0] * len(values)
+                self.coeffs[name] = other.coeffs[name]
+            self.cost_map[name] = [a + b for a, b in zip(self.cost_map[name], values)]
+        self.num_cases += other.num_cases
+        return self
+
+    def get_value(self):
+        return sum(self.coeffs[name] * values[0] for name, values in self.cost_map.iteritems())
+
+    def getCostMap(self):
+        return dict((name, list(values)) for name, values in self.cost_map.iteritems())
+
+    def getNumCases(self):
+        return self.num_cases
+
+class WorkResult:
+    BATCH_DONE, SYNC_DONE = range(2)
+
+    def __init__(self, result_type, results=None):
+        self.result_type, self.results = result_type, results
+
+    def getResults(self):
+        return self.results
+
+    def getResultType(self):
+        return self.result_type
+
+# f(x): type --> (activate(x, params), input gradient(v, x, y, params)),
+# where v is the gradient of the outputs y.
+neurons = {'ident': (lambda x, p: x,
+                     lambda v, x, y, p: v),
+           'relu': (lambda x, p: n.maximum(x, 0),
+                    lambda v, x, y, p: v * (y > 0)),
+           'brelu': (lambda x, p: n.clip(x, 0, p['a']),
+                     lambda v, x, y, p: v * ((y > 0) & (y < p['a']))),
+           'abs': (lambda x, p: n.abs(x),
+                   lambda v, x, y, p: n.where(x > 0, v, -v)),
+           'logistic': (lambda x, p: 1 / (1 + n.exp(-x)),
+                        lambda v, x, y, p: v * y * (1 - y)),
+           'tanh': (lambda x, p: p['a'] * n.tanh(p['b'] * x),
+                    lambda v, x, y, p: v * (p['a'] * p['b']) * (1 - (y / p['a'])**2)),
+           'softrelu': (lambda x, p: n.where(x > 4, x, n.log1p(n.exp(n.minimum(x, 4)))),
+                        lambda v, x, y, p: v * -n.expm1(-y)),
+           'square': (lambda x, p: x * x,
+                      lambda v, x, y, p: 2 * v * x),
+           'sqrt': (lambda x, p: n.sqrt(x),
+                    lambda v, x, y, p: v / (2 * y)),
+           'linear': (lambda x, p: p['a'] * x + p['b'],
+                      lambda v, x, y, p: p['a'] * v)}
+
+# out[i] = sum of a[j] over start <= j - i < start + size along axis, clipped to the array.
+def _window_sum(a, axis, start, size):
+    out = n.zeros_like(a)
+    length = a.shape[axis]
+    for off in xrange(start, start + size):
+        if abs(off) >= length:
+            continue
+        dst, src = [slice(None)] * a.ndim, [slice(None)] * a.ndim
+        dst[axis] = slice(max(0, -off), length - max(0, off))
+        src[axis] = slice(max(0, off), length + min(0, off))
+        out[tuple(dst)] += a[tuple(src)]
+    return out
+
+# Sums a along axis over blocks of size elements, broadcast back to every element of the block.
+def _block_sum(a, axis, size):
+    sums = n.add.reduceat(a, range(0, a.shape[axis], size), axis=axis)
+    return n.repeat(sums, size, axis=axis).take(xrange(a.shape[axis]), axis=axis)
+
+# Copies images (channels, size, size, cases) into the middle of a zero (or fill)
+# border of before pixels on the top/left and after pixels on the bottom/right.
+def _pad(images, before, after, fill=0):
+    if before == 0 and after == 0:
+        return images
+    c, size, size, cases = images.shape
+    padded = n.empty((c, size + before + after, size + before + after, cases), dtype=images.dtype)
+    padded.fill(fill)
+    padded[:, before:before + size, before:before + size] = images
+    return padded
+
+# The pixels at offset (y, x) of every window of a (start, stride, count) grid.
+def _grid(images, start, stride, count, y, x):
+    end = (count - 1) * stride + 1
+    return images[:, start + y:start + y + end:stride, start + x:start + x + end:stride]
+
+class Weights:
+    """A weight matrix with its increment, learning parameters and the gradient
+    accumulated over the current minibatch. Layers sharing a matrix share its Weights."""
+    def __init__(self, w, inc, eps, mom, wc):
+        self.w, self.inc = w, inc
+        self.eps, self.mom, self.wc = eps, mom, wc
+        self.grad = None
+
+    def add_grad(self, grad):
+        if self.grad is None:
+            self.grad = grad
+        else:
+            self.grad += grad
+
+    # inc = mom * inc + eps * (grad / cases - wc * w); w += inc
+    def update(self, num_cases):
+        if self.eps <= 0 or self.grad is None:
+            return
+        inc = self.grad.reshape(self.w.shape)
+        inc *= self.eps / num_cases
+        if self.mom > 0:
+            inc += self.mom * self.inc
+        if self.wc > 0:
+            inc -= (self.wc * self.eps) * self.w
+        self.w += inc
+        self.inc[...] = inc
+        self.grad = None
+
+class Layer:
+    def __init__(self, dic):
+        self.dic = dic
+        self.name, self.type = dic['name'], dic['type']
+        self.inputs = dic.get('inputs', [])
+        self.prev, self.next = [], []
+        self.acts = None
+        self.conserve_mem = dic.get('conserveMem', False)
+        self.grad_consumer = dic.get('gradConsumer', False)
+
+    def is_grad_producer(self):
+        return True
+
+    # Sets self.acts from the activities of the input layers.
+    def fprop(self, inputs):
+        raise NotImplementedError()
+
+    # Returns the gradient of input inp_idx, given the gradient v of self.acts.
+    def bprop(self, v, inputs, inp_idx):
+        raise NotImplementedError()
+
+class DataLayer(Layer):
+    def fprop(self, data):
+        self.acts = data[self.dic['dataIdx']]
+
+    def is_grad_producer(self):
+        return False
+
+class NeuronLayer(Layer):
+    def __init__(self, dic):
+        Layer.__init__(self, dic)
+        neuron = dic['neuron']
+        if neuron['type'] not in neurons:
+            raise CPUConvNetException("Unknown neuron type: %s" % neuron['type'])
+        self.activate, self.gradient = neurons[neuron['type']]
+        self.params = neuron['params']
+
+    def fprop(self, inputs):
+        self.acts = self.activate(inputs[0], self.params).astype(inputs[0].dtype, copy=False)
+
+    def bprop(self, v, inputs, inp_idx):
+        return self.gradient(v, inputs[0], self.acts, self.params)
+
+class WeightLayer(Layer):
+    def __init__(self, dic):
+        Layer.__init__(self, dic)
+        self.weights = []
+        self.biases = Weights(dic['biases'], dic['biasesInc'], dic['epsB'], dic['momB'], 0)
+
+    # Resolves shared weight matrices to the Weights of the layer that owns them.
+    def link_weights(self, layers):
+        dic = self.dic
+        self.weights = []
+        for i, src_idx in enumerate(dic['weightSourceLayerIndices']):
+            matrix_idx = dic['weightSourceMatrixIndices'][i]
+            if src_idx == len(layers):
+                self.weights += [self.weights[matrix_idx]]
+            elif src_idx >= 0:
+                self.weights += [layers[src_idx].weights[matrix_idx]]
+            else:
+                self.weights += [Weights(dic['weights'][i], dic['weightsInc'][i], dic['epsW'][i], dic['momW'][i], dic['wc'][i])]
+
+    def bprop_weights(self, v, inputs):
+        if self.biases.eps > 0:
+            self.biases.add_grad(self.bprop_biases(v))
+        for i, eps in enumerate(self.dic['epsW']):
+            if eps > 0:
+                self.weights[i].add_grad(self.bprop_weight(v, inputs, i))
+
+    def update_weights(self, num_cases):
+        owned = [w for w, src_idx in zip(self.weights, self.dic['weightSourceLayerIndices']) if src_idx < 0]
+        for w in owned + [self.biases]:
+            w.update(num_cases)
+
+class FCLayer(WeightLayer):
+    def fprop(self, inputs):
+        acts = n.dot(self.weights[0].w.T, inputs[0])
+        for x, weights in zip(inputs[1:], self.weights[1:]):
+            acts += n.dot(weights.w.T, x)
+        acts += self.biases.w.T
+        self.acts = acts
+
+    def bprop(self, v, inputs, inp_idx):
+        return n.dot(self.weights[inp_idx].w, v)
+
+    def bprop_biases(self, v):
+        return v.sum(axis=1).reshape(self.biases.w.shape)
+
+    def bprop_weight(self, v, inputs, inp_idx):
+        return n.dot(inputs[inp_idx], v.T)
+
+class LocalLayer(WeightLayer):
+    """Convolutional and locally-connected layers. The patches of every input
+    are unrolled into a (filterChannels * filterPixels, modules, cases) matrix
+    per filter group, whose channels are a slice of the input's or, with
+    randSparse, the group's filterConns."""
+    def __init__(self, dic):
+        WeightLayer.__init__(self, dic)
+        self.filters, self.modules_x = dic['filters'], dic['modulesX']
+        self.conns = []
+        for i in xrange(len(self.inputs)):
+            fc, groups = dic['filterChannels'][i], dic['groups'][i]
+            if dic['randSparse'][i]:
+                conns = n.array(dic['filterConns'][i])
+                self.conns += [[conns[g * fc:(g + 1) * fc] for g in xrange(groups)]]
+            else:
+                self.conns += [[slice(g * fc, (g + 1) * fc) for g in xrange(groups)]]
+        self.cols = [None] * len(self.inputs)
+
+    def get_padding(self, i):
+        dic = self.dic
+        before = -dic['padding'][i]
+        after = max(0, (self.modules_x - 1) * dic['stride'][i] + dic['filterSize'][i] - before - dic['imgSize'][i])
+        return before, after
+
+    def get_group_filters(self, i, g):
+        per_group = self.filters / self.dic['groups'][i]
+        return slice(g * per_group, (g + 1) * per_group)
+
+    # Returns the unrolled patches of input i, one (filterChannels * filterPixels, modules, cases) matrix per group.
+    def im2col(self, x, i):
+        dic = self.dic
+        channels, size, fsize, stride = dic['channels'][i], dic['imgSize'][i], dic['filterSize'][i], dic['stride'][i]
+        images = _pad(n.ascontiguousarray(x).reshape(channels, size, size, -1), *self.get_padding(i))
+        sc, sy, sx, sn = images.strides
+        shape = (channels, fsize, fsize, self.modules_x, self.modules_x, images.shape[3])
+        patches = as_strided(images, shape, (sc, sy, sx, sy * stride, sx * stride, sn))
+        rows = dic['filterChannels'][i] * dic['filterPixels'][i]
+        return [patches[conns].reshape(rows, self.modules_x**2, -1) for conns in self.conns[i]]
+
+    # Sums the patch gradients of every group back into an input gradient.
+    def col2im(self, group_cols, i):
+        dic = self.dic
+        channels, size, fsize, stride = dic['channels'][i], dic['imgSize'][i], dic['filterSize'][i], dic['stride'][i]
+        before, after = self.get_padding(i)
+        cases = group_cols[0].shape[-1]
+        images = n.zeros((channels, size + before + after, size + before + after, cases), dtype=group_cols[0].dtype)
+        for conns, cols in zip(self.conns[i], group_cols):
+            cols = cols.reshape(-1, fsize, fsize, self.modules_x, self.modules_x, cases)
+            for y in xrange(fsize):
+                for x in xrange(fsize):
+                    images[conns, y:y + (self.modules_x - 1) * stride + 1:stride, x:x + (self.modules_x - 1) * stride + 1:stride] += cols[:, y, x]
+        images = images[:, before:before + size, before:before + size]
+        return n.ascontiguousarray(images).reshape(channels * size * size, cases)
+
+    def fprop(self, inputs):
+        cases = inputs[0].shape[1]
+        acts = n.zeros((self.filters, self.modules_x**2, cases), dtype=inputs[0].dtype)
+        for i, x in enumerate(inputs):
+            cols = self.im2col(x, i)
+            for g, group_cols in enumerate(cols):
+                acts[self.get_group_filters(i, g)] += self.filter_acts(group_cols, i, g)
+            self.cols[i] = None if self.conserve_mem else cols
+        self.acts = self.add_biases(acts).reshape(self.filters * self.modules_x**2, cases)
+
+    def bprop(self, v, inputs, inp_idx):
+        v = v.reshape(self.filters, self.modules_x**2, -1)
+        group_cols = [self.img_acts(v[self.get_group_filters(inp_idx, g)], inp_idx, g) for g in xrange(len(self.conns[inp_idx]))]
+        return self.col2im(group_cols, inp_idx)
+
+    def bprop_weight(self, v, inputs, inp_idx):
+        cols = self.cols[inp_idx] if self.cols[inp_idx] is not None else self.im2col(inputs[inp_idx], inp_idx)
+        self.cols[inp_idx] = None
+        v = v.reshape(self.filters, self.modules_x**2, -1)
+        return n.concatenate([self.weight_acts(v[self.get_group_filters(inp_idx, g)], group_cols)
+                              for g, group_cols in enumerate(cols)], axis=-1)
+
+class ConvLayer(LocalLayer):
+    """Filters (filterChannels * filterPixels, filters), shared by all modules."""
+    def get_group_weights(self, i, g):
+        return self.weights[i].w[:, self.get_group_filters(i, g)]
+
+    def filter_acts(self, cols, i, g):
+        rows, modules, cases = cols.shape
+        return n.dot(self.get_group_weights(i, g).T, cols.reshape(rows, -1)).reshape(-1, modules, cases)
+
+    def img_acts(self, v, i, g):
+        filters, modules, cases = v.shape
+        return n.dot(self.get_group_weights(i, g), v.reshape(filters, -1)).reshape(-1, modules, cases)
+
+    def weight_acts(self, v, cols):
+        return n.dot(cols.reshape(cols.shape[0], -1), v.reshape(v.shape[0], -1).T)
+
+    def add_biases(self, acts):
+        if self.dic['sharedBiases']:
+            acts += self.biases.w.reshape(self.filters, 1, 1)
+        else:
+            acts += self.biases.w.reshape(self.filters, -1, 1)
+        return acts
+
+    def bprop_biases(self, v):
+        v = v.reshape(self.filters, -1) if self.dic['sharedBiases'] else v
+        return v.sum(axis=1).reshape(self.biases.w.shape)
+
+class LocalUnsharedLayer(LocalLayer):
+    """Filters (modules * filterChannels * filterPixels, filters), one set per module."""
+    def get_group_weights(self, i, g):
+        weights = self.weights[i].w.reshape(self.modules_x**2, -1, self.filters)
+        return weights[:, :, self.get_group_filters(i, g)]
+
+    # (modules, filters, cases) <-- (modules, filters, rows) x (modules, rows, cases)
+    def filter_acts(self, cols, i, g):
+        acts = n.matmul(self.get_group_weights(i, g).transpose(0, 2, 1), cols.transpose(1, 0, 2))
+        return acts.transpose(1, 0, 2)
+
+    def img_acts(self, v, i, g):
+        cols = n.matmul(self.get_group_weights(i, g), v.transpose(1, 0, 2))
+        return cols.transpose(1, 0, 2)
+
+    # (modules, rows, filters) <-- (modules, rows, cases) x (modules, cases, filters)
+    def weight_acts(self, v, cols):
+        return n.matmul(cols.transpose(1, 0, 2), v.transpose(1, 2, 0))
+
+    def bprop_weight(self, v, inputs, inp_idx):
+        grad = LocalLayer.bprop_weight(self, v, inputs, inp_idx)
+        return grad.reshape(self.weights[inp_idx].w.shape)
+
+    def add_biases(self, acts):
+        acts += self.biases.w.reshape(self.filters, -1, 1)
+        return acts
+
+    def bprop_biases(self, v):
+        return v.sum(axis=1).reshape(self.biases.w.shape)
+
+class PoolLayer(Layer):
+    """Max or average pooling over sizeX x sizeX windows starting at start + k * stride,
+    clipped to the image. Average pooling divides by the number of pixels inside it."""
+    def __init__(self, dic):
+        Layer.__init__(self, dic)
+        if dic['pool'] not in ('max', 'avg'):
+            raise CPUConvNetException("Unknown pooling layer type %s" % dic['pool'])
+        self.channels, self.size, self.size_x = dic['channels'], dic['imgSize'], dic['sizeX']
+        self.start, self.stride, self.outputs_x = dic['start'], dic['stride'], dic['outputsX']
+        self.before = max(0, -self.start)
+        self.after = max(0, self.start + (self.outputs_x - 1) * self.stride + self.size_x - self.size)
+        lo = [max(0, self.start + o * self.stride) for o in xrange(self.outputs_x)]
+        hi = [min(self.size, self.start + o * self.stride + self.size_x) for o in xrange(self.outputs_x)]
+        extent = n.array(hi, dtype=n.single) - lo
+        self.region_sizes = n.outer(extent, extent).reshape(1, self.outputs_x, self.outputs_x, 1)
+
+    def windows(self, images):
+        start = self.start + self.before
+        for y in xrange(self.size_x):
+            for x in xrange(self.size_x):
+                yield _grid(images, start, self.stride, self.outputs_x, y, x)
+
+    def fprop(self, inputs):
+        fill = n.finfo(n.single).min if self.dic['pool'] == 'max' else 0
+        images = _pad(inputs[0].reshape(self.channels, self.size, self.size, -1), self.before, self.after, fill)
+        windows = self.windows(images)
+        acts = next(windows).copy()
+        for w in windows:
+            if self.dic['pool'] == 'max':
+                n.maximum(acts, w, out=acts)
+            else:
+                acts += w
+        if self.dic['pool'] == 'avg':
+            acts /= self.region_sizes
+        self.acts = acts.reshape(-1, acts.shape[-1])
+
+    def bprop(self, v, inputs, inp_idx):
+        cases = v.shape[1]
+        v = v.reshape(self.channels, self.outputs_x, self.outputs_x, cases)
+        padded = self.size + self.before + self.after
+        grad = n.zeros((self.channels, padded, padded, cases), dtype=v.dtype)
+        if self.dic['pool'] == 'max':
+            images = _pad(inputs[0].reshape(self.channels, self.size, self.size, -1), self.before, self.after, n.finfo(n.single).min)
+            acts = self.acts.reshape(v.shape)
+            for g, w in zip(self.windows(grad), self.windows(images)):
+                g += v * (w == acts)
+        else:
+            v = v / self.region_sizes
+            for g in self.windows(grad):
+                g += v
+        grad = grad[:, self.before:self.before + self.size, self.before:self.before + self.size]
+        return n.ascontiguousarray(grad).reshape(-1, cases)
+
+class ResponseNormLayer(Layer):
+    """out = x * (1 + scale * sum of x^2 over a size x size neighbourhood)^-pow"""
+    def __init__(self, dic):
+        Layer.__init__(self, dic)
+        self.channels, self.size, self.img_size = dic['channels'], dic['size'], dic['imgSize']
+        self.scale, self.pow = dic['scale'], dic['pow']
+        self.denoms = None
+
+    def neighbourhood_sum(self, a, transpose=False):
+        start = self.size / 2 - self.size + 1 if transpose else -(self.size / 2)
+        return _window_sum(_window_sum(a, 1, start, self.size), 2, start, self.size)
+
+    def get_images(self, x):
+        return x.reshape(self.channels, self.img_size, self.img_size, -1)
+
+    def fprop(self, inputs):
+        x = self.get_images(inputs[0])
+        self.denoms = 1 + self.scale * self.neighbourhood_sum(x * x)
+        self.acts = (x * self.denoms**-self.pow).reshape(inputs[0].shape)
+
+    # dx = v * d^-pow - 2 * scale * pow * x * (sum over the neighbourhoods containing x of v * out / d)
+    def bprop(self, v, inputs, inp_idx):
+        x, v, acts = self.get_images(inputs[0]), self.get_images(v), self.get_images(self.acts)
+        grad = v * self.denoms**-self.pow
+        grad -= (2 * self.scale * self.pow) * x * self.neighbourhood_sum(v * acts / self.denoms, transpose=True)
+        if self.conserve_mem:
+            self.denoms = None
+        return grad.reshape(inputs[0].shape)
+
+class CrossMapResponseNormLayer(ResponseNormLayer):
+    """Normalizes over size neighbouring channels, or blocks of size channels."""
+    def neighbourhood_sum(self, a, transpose=False):
+        if self.dic['blocked']:
+            return _block_sum(a, 0, self.size)
+        start = self.size / 2 - self.size + 1 if transpose else -(self.size / 2)
+        return _window_sum(a, 0, start, self.size)
+
+class SoftmaxLayer(Layer):
+    def fprop(self, inputs):
+        acts = inputs[0] - inputs[0].max(axis=0)
+        n.exp(acts, out=acts)
+        acts /= acts.sum(axis=0)
+        self.acts = acts
+
+    # Feeding only a logreg cost, the combined gradient avoids dividing by tiny probabilities.
+    def does_logreg_grad(self):
+        return len(self.next) == 1 and self.next[0].type == 'cost.logreg'
+
+    def bprop(self, v, inputs, inp_idx):
+        if self.does_logreg_grad():
+            cost = self.next[0]
+            return cost.coeff * (cost.get_label_matrix(self.acts) - self.acts)
+        return self.acts * (v - (v * self.acts).sum(axis=0))
+
+class EltwiseSumLayer(Layer):
+    def fprop(self, inputs):
+        acts = self.dic['coeffs'][0] * inputs[0]
+        for coeff, x in zip(self.dic['coeffs'][1:], inputs[1:]):
+            acts += coeff * x
+        self.acts = acts
+
+    def bprop(self, v, inputs, inp_idx):
+        return self.dic['coeffs'][inp_idx] * v
+
+class EltwiseMaxLayer(Layer):
+    def fprop(self, inputs):
+        self.acts = reduce(n.maximum, inputs)
+
+    def bprop(self, v, inputs, inp_idx):
+        return v * (inputs[inp_idx] == self.acts)
+
+class CostLayer(Layer):
+    def __init__(self, dic):
+        Layer.__init__(self, dic)
+        self.coeff = dic['coeff']
+        self.cost = []
+
+    def is_grad_producer(self):
+        return self.coeff != 0
+
+class LogregCostLayer(CostLayer):
+    """Inputs: labels (1, cases) and probabilities (classes, cases). The costs
+    are the negative log probability of the labels and the number of errors."""
+    def fprop(self, inputs):
+        labels, probs = inputs
+        cases = n.arange(probs.shape[1])
+        label_probs = probs[labels.ravel().astype(n.int), cases]
+        max_probs = probs.max(axis=0)
+        # a tie for the most probable class counts as a fraction of a correct guess
+        correct = (label_probs == max_probs) / (probs == max_probs).sum(axis=0).astype(n.double)
+        self.acts = n.log(label_probs).reshape(1, -1)
+        self.cost = [-self.acts.sum(dtype=n.double), probs.shape[1] - correct.sum()]
+
+    # The one-hot matrix of the labels, shaped like probs.
+    def get_label_matrix(self, probs):
+        labels = self.prev[0].acts.ravel().astype(n.int)
+        matrix = n.zeros_like(probs)
+        matrix[labels, n.arange(labels.size)] = 1
+        return matrix
+
+    def bprop(self, v, inputs, inp_idx):
+        probs = self.prev[1]
+        if len(probs.next) == 1 and probs.type == 'softmax':
+            return None # the softmax layer does it
+        return self.coeff * self.get_label_matrix(inputs[1]) / inputs[1]
+
+class SumOfSquaresCostLayer(CostLayer):
+    def fprop(self, inputs):
+        self.acts = inputs[0] * inputs[0]
+        self.cost = [self.acts.sum(dtype=n.double)]
+
+    def bprop(self, v, inputs, inp_idx):
+        return (-2 * self.coeff) * inputs[0]
+
+# All the layer types
+layer_classes = {'data': DataLayer,
+                 'fc': FCLayer,
+                 'conv': ConvLayer,
+                 'local': LocalUnsharedLayer,
+                 'pool': PoolLayer,
+                 'rnorm': ResponseNormLayer,
+                 'cmrnorm': CrossMapResponseNormLayer,
+                 'softmax': SoftmaxLayer,
+                 'eltsum': EltwiseSumLayer,
+                 'eltmax': EltwiseMaxLayer,
+                 'neuron': NeuronLayer,
+                 'cost.logreg': LogregCostLayer,
+                 'cost.sum2': SumOfSquaresCostLayer}
+
+class ConvNet(Thread):
+    def __init__(self, layers, minibatch_size, device_id=-1):
+        Thread.__init__(self)
+        self.daemon = True
+        self.minibatch_size = minibatch_size
+        self.layers = []
+        for dic in layers:
+            if dic['type'] not in layer_classes:
+                raise CPUConvNetException("Layer '%s': unknown layer type %s" % (dic['name'], dic['type']))
+            l = layer_classes[dic['type']](dic)
+            l.prev = [self.layers[i] for i in l.inputs]
+            if isinstance(l, WeightLayer):
+                l.link_weights(self.layers)
+            l.grad_consumer = l.grad_consumer or any(p.grad_consumer for p in l.prev)
+            self.layers += [l]
+        for l in self.layers:
+            for p in l.prev:
+                p.next += [l]
+        self.costs = [l for l in self.layers if isinstance(l, CostLayer)]
+        self.worker_queue, self.result_queue = Queue(), Queue()
+        self.data = None
+
+    def run(self):
+        try:
+            for worker in iter(self.worker_queue.dequeue, None):
+                worker.run()
+        except:
+            # like the CUDA thread, fail loudly rather than leave the runner waiting for a result
+            traceback.print_exc()
+            sys.stdout.flush()
+            os._exit(1)
+
+    # Stops the thread once the workers queued so far have run. The runner calls
+    # this before exiting, so the thread is not torn down with the interpreter.
+    def stop(self):
+        self.worker_queue.enqueue(None)
+        self.join()
+
+    def getWorkerQueue(self):
+        return self.worker_queue
+
+    def getResultQueue(self):
+        return self.result_queue
+
+    def get_layer(self, idx):
+        return self.layers[idx]
+
+    def set_data(self, data):
+        self.data = data
+
+    def get_num_minibatches(self):
+        return (self.data.get_num_cases() + self.minibatch_size - 1) / self.minibatch_size
+
+    def get_minibatch(self, idx):
+        start = idx * self.minibatch_size
+        return self.data.get_slice(start, min(self.data.get_num_cases(), start + self.minibatch_size))
+
+    def fprop(self, data):
+        self.num_cases = data[0].shape[1]
+        for l in self.layers:
+            if isinstance(l, DataLayer):
+                l.fprop(data)
+            else:
+                l.fprop([p.acts for p in l.prev])
+
+    def bprop(self):
+        grads, rcvd = {}, set()
+        for l in reversed(self.layers):
+            if isinstance(l, CostLayer):
+                if not l.is_grad_producer():
+                    continue
+            elif l not in rcvd or not l.grad_consumer:
+                continue
+            v = grads.pop(l, None)
+            inputs = [p.acts for p in l.prev]
+            if isinstance(l, WeightLayer):
+                l.bprop_weights(v, inputs)
+            for i, p in enumerate(l.prev):
+                if p.grad_consumer:
+                    grad = l.bprop(v, inputs, i)
+                    rcvd.add(p)
+                    if grad is None:
+                        continue
+                    if p in grads:
+                        grads[p] = grads[p] + grad
+                    else:
+                        grads[p] = grad
+
+    def update_weights(self):
+        for l in self.layers:
+            if isinstance(l, WeightLayer):
+                l.update_weights(self.num_cases)
+
+    def get_cost(self):
+        return Cost(self.num_cases, self.costs)
+
+    # The weights live in the layer dicts, so there is nothing to copy.
+    def copy_to_cpu(self):
+        pass
+
+    def copy_to_gpu(self):
+        pass
+
+    # Checks the gradients of every learned matrix on the first minibatch. The check
+    # runs in double precision, so the model's matrices are promoted for good.
+    def check_gradients(self):
+        data = [d.astype(n.double) for d in self.get_minibatch(0)]
+        promoted = set()
+        for l in self.layers:
+            if isinstance(l, WeightLayer):
+                for weights in l.weights + [l.biases]:
+                    if id(weights) not in promoted:
+                        promoted.add(id(weights))
+                        weights.w, weights.inc = weights.w.astype(n.double), weights.inc.astype(n.double)
+        self.fprop(data)
+        self.bprop()
+        num_tests = num_failures = 0
+        for l in self.layers:
+            if not isinstance(l, WeightLayer):
+                continue
+            checks = [("%s weights[%d]" % (l.name, i), GC_WEIGHT_STEP, w) for i, w in enumerate(l.weights)]
+            for name, step, weights in checks + [("%s biases" % l.name, GC_BIAS_STEP, l.biases)]:
+                if weights.grad is None: # not learned
+                    continue
+                num_tests += 1
+                num_failures += not self.check_gradient(name, step, weights, data)
+        print "------------------------"
+        if num_failures > 0:
+            print "%d/%d TESTS FAILED" % (num_failures, num_tests)
+        else:
+            print "ALL %d TESTS PASSED" % num_tests
+        return num_failures == 0
+
+    # Compares the gradient of weights from bprop with central differences of step on data.
+    def check_gradient(self, name, step, weights, data):
+        entries = list(n.ndindex(*weights.w.shape))
+        if len(entries) > GC_MAX_ENTRIES:
+            entries = [entries[i] for i in n.random.permutation(len(entries))[:GC_MAX_ENTRIES]]
+        num_grad = n.zeros(len(entries))
+        for i, idx in enumerate(entries):
+            v = weights.w[idx]
+            costs = []
+            for w in (v + step, v - step):
+                weights.w[idx] = w
+                self.fprop(data)
+                costs += [self.get_cost().get_value()]
+            weights.w[idx] = v
+            num_grad[i] = (costs[0] - costs[1]) / (2 * step * self.num_cases)
+        if not n.all(n.isfinite(num_grad)):
+            print "Numerical computation produced nan or inf when checking '%s'." % name
+            print "Consider reducing the sizes of the weights or finite difference steps."
+            return False
+        grad = -weights.grad.reshape(weights.w.shape) / self.num_cases
+        grad = n.array([grad[idx] for idx in entries])
+        rel_err = n.linalg.norm(num_grad - grad) / n.linalg.norm(grad)
+        passed = rel_err < GC_REL_ERR_THRESH
+        if not passed:
+            print "========================"
+            print "(****FAIL****) %s GRADIENT CHECK" % name
+            print "========================"
+            print "Analytic norm: %e" % n.linalg.norm(grad)
+            print "Numeric norm:  %e" % n.linalg.norm(num_grad)
+        print "%s: relative error %e" % (name, rel_err)
+        return passed
+
+class Worker:
+    def __init__(self, convnet):
+        self.convnet = convnet
+
+class TrainingWorker(Worker):
+    def __init__(self, convnet, data, test):
+        Worker.__init__(self, convnet)
+        self.data, self.test = data, test
+
+    def run(self):
+        convnet = self.convnet
+        convnet.set_data(self.data)
+        batch_cost = Cost()
+        for i in xrange(convnet.get_num_minibatches()):
+            convnet.fprop(convnet.get_minibatch(i))
+            batch_cost += convnet.get_cost()
+            if not self.test:
+                convnet.bprop()
+                convnet.update_weights()
+        convnet.getResultQueue().enqueue(WorkResult(WorkResult.BATCH_DONE, batch_cost))
+
+class SyncWorker(Worker):
+    def run(self):
+        self.convnet.copy_to_cpu()
+        self.convnet.getResultQueue().enqueue(WorkResult(WorkResult.SYNC_DONE))
+
+class CopyToGPUWorker(Worker):
+    def run(self):
+        self.convnet.copy_to_gpu()
+        self.convnet.getResultQueue().enqueue(WorkResult(WorkResult.SYNC_DONE))
+
+class GradCheckWorker(Worker):
+    def __init__(self, convnet, data):
+        Worker.__init__(self, convnet)
+        self.data = data
+
+    # Exits when done, like the CUDA version.
+    def run(self):
+        self.convnet.set_data(self.data)
+        self.convnet.check_gradients()
+        sys.stdout.flush()
+        os._exit(0)
+
+class MultiviewTestWorker(Worker):
+    """Tests on the average of the softmax outputs for num_views views of each case.
+    The data holds all cases of the first view, then all cases of the second, and so on."""
+    def __init__(self, convnet, data, num_views, logreg_idx):
+        Worker.__init__(self, convnet)
+        assert data.get_num_cases() % num_views == 0
+        self.data, self.num_views, self.logreg_idx = data, num_views, logreg_idx
+
+    def run(self):
+        convnet = self.convnet
+        logreg = convnet.get_layer(self.logreg_idx)
+        num_cases = self.data.get_num_cases() / self.num_views
+        batch_cost = Cost()
+        for start in xrange(0, num_cases, convnet.minibatch_size):
+            end = min(num_cases, start + convnet.minibatch_size)
+            probs = 0
+            for v in xrange(self.num_views):
+                convnet.fprop(self.data.get_slice(v * num_cases + start, v * num_cases + end))
+                probs = probs + logreg.prev[1].acts
+            logreg.fprop([logreg.prev[0].acts, probs / self.num_views])
+            batch_cost += convnet.get_cost()
+        convnet.getResultQueue().enqueue(WorkResult(WorkResult.BATCH_DONE, batch_cost))
+
+class FeatureWorker(Worker):
+    """Writes the activities of layer layer_idx into ftrs, a (cases, dimensions) matrix."""
+    def __init__(self, convnet, data, ftrs, layer_idx):
+        Worker.__init__(self, convnet)
+        assert ftrs.shape[0] == data.get_num_cases()
+        self.data, self.ftrs, self.layer_idx = data, ftrs, layer_idx
+
+    def run(self):
+        convnet = self.convnet
+        convnet.set_data(self.data)
+        batch_cost = Cost()
+        for i in xrange(convnet.get_num_minibatches()):
+            convnet.fprop(convnet.get_minibatch(i))
+            batch_cost += convnet.get_cost()
+            start = i * convnet.minibatch_size
+            self.ftrs[start:start + convnet.num_cases] = convnet.get_layer(self.layer_idx).acts.T
+        convnet.getResultQueue().enqueue(WorkResult(WorkResult.BATCH_DONE, batch_cost))
+
+# Checks the gradients of the model in layer_def on random data.
+def check_layer_gradients(layer_def, layer_params, minibatch_size, data_dims, num_classes):
+    import layer as lay
+    layers = lay.LayerParser.parse_layers(layer_def, layer_params, lay.StandInRunner(data_dims, num_classes), layers=[])
+    n.random.seed(0)
+    data = n.random.randn(data_dims, minibatch_size).astype(n.single)
+    labels = n.random.randint(0, num_classes, (1, minibatch_size)).astype(n.single)
+    convnet = ConvNet(layers, minibatch_size)
+    convnet.set_data(CPUData([data, labels]))
+    return convnet.check_gradients()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "Usage: python cpuconvnet.py <layer def> <layer params> [<minibatch size> [<data dims> <classes>]]"
+        sys.exit(1)
+    minibatch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    data_dims, num_classes = (int(sys.argv[4]), int(sys.argv[5])) if len(sys.argv) > 5 else (3 * 32 * 32, 10)
+    sys.exit(0 if check_layer_gradients(sys.argv[1], sys.argv[2], minibatch_size, data_dims, num_classes) else 1)
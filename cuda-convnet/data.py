@@ -24,21 +24,29 @@
 
 from PIL import Image
 from numpy.random import randn, rand, random_integers
+from numpy.lib.stride_tricks import as_strided
 from util import *
+from ordereddict import OrderedDict
 import cPickle
 import cStringIO as c
+import hashlib
 import leveldb
 import numpy as n
 import numpy.random as nr
 import os
 import random as r
 import tarfile
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from time import time
 
 
 BATCH_META_FILE = "batches.meta"
 
 class DataProvider:
-    BATCH_REGEX = re.compile('^data_batch_(\d+)(\.\d+)?$')
+    BATCH_REGEX = re.compile('^data_batch_(\d+)(\.\d+|\.mm)?$')
     def __init__(self, data_dir, batch_range=None, init_epoch=1, init_batchnum=None, dp_params={}, test=False):
         if batch_range == None:
             batch_range = DataProvider.get_batch_nums(data_dir)
@@ -54,6 +62,14 @@ class DataProvider:
         self.data_dic = None
         self.test = test
         self.batch_idx = batch_range.index(init_batchnum)
+        self.buffer_pool = (dp_params or {}).get('buffer_pool')
+
+    # Returns an uninitialized C-contiguous array to return a batch in, from the
+    # buffer pool if there is one. The caller must fill all of it.
+    def get_batch_buffer(self, shape, dtype=n.single):
+        if self.buffer_pool is None:
+            return n.empty(shape, dtype=dtype)
+        return self.buffer_pool.get(shape, dtype)
 
     def get_next_batch(self):
         if self.data_dic is None or len(self.batch_range) > 1:
@@ -63,27 +79,29 @@ class DataProvider:
 
         return epoch, batchnum, self.data_dic
     
-    def __add_subbatch(self, batch_num, sub_batchnum, batch_dic):
-        subbatch_path = "%s.%d" % (os.path.join(self.data_dir, self.get_data_file_name(batch_num)), sub_batchnum)
+    def __load_subbatch(self, batch_num, sub_batchnum):
+        subbatch_path = "%s.%d" % (self.get_data_file_name(batch_num), sub_batchnum)
         if os.path.exists(subbatch_path):
-            sub_dic = unpickle(subbatch_path)
-            self._join_batches(batch_dic, sub_dic)
-        else:
-            raise IndexError("Sub-batch %d.%d does not exist in %s" % (batch_num,sub_batchnum, self.data_dir))
+            return unpickle(subbatch_path)
+        raise IndexError("Sub-batch %d.%d does not exist in %s" % (batch_num,sub_batchnum, self.data_dir))
         
-    def _join_batches(self, main_batch, sub_batch):
-        main_batch['data'] = n.r_[main_batch['data'], sub_batch['data']]
+    # Joins all the sub-batches at once, so the data is copied only one time.
+    def _join_batches(self, main_batch, sub_batches):
+        main_batch['data'] = n.concatenate([main_batch['data']] + [sub['data'] for sub in sub_batches])
         
     def get_batch(self, batch_num):
         if os.path.exists(self.get_data_file_name(batch_num) + '.1'): # batch in sub-batches
             dic = unpickle(self.get_data_file_name(batch_num) + '.1')
+            sub_dics = []
             sb_idx = 2
             while True:
                 try:
-                    self.__add_subbatch(batch_num, sb_idx, dic)
+                    sub_dics += [self.__load_subbatch(batch_num, sb_idx)]
                     sb_idx += 1
                 except IndexError:
                     break
+            if sub_dics:
+                self._join_batches(dic, sub_dics)
         else:
             dic = unpickle(self.get_data_file_name(batch_num))
         return dic
@@ -120,7 +138,7 @@ class DataProvider:
                 raise DataProviderException("No such data provider: %s" % type)
             _class = dp_classes[name]
             dims = int(type.split('-')[-1])
-            return _class(dims)
+            return _class(dims, dp_params=dp_params)
         elif type in dp_types:
             _class = dp_classes[type]
             return _class(data_dir, batch_range, init_epoch, init_batchnum, dp_params, test)
@@ -152,13 +170,14 @@ class DataProvider:
         return len(DataProvider.get_batch_nums(srcdir))
     
 class DummyDataProvider(DataProvider):
-    def __init__(self, data_dim):
+    def __init__(self, data_dim, dp_params={}):
         #self.data_dim = data_dim
         self.batch_range = [1]
         self.batch_meta = {'num_vis': data_dim, 'data_in_rows':True}
         self.curr_epoch = 1
         self.curr_batchnum = 1
         self.batch_idx = 0
+        self.buffer_pool = (dp_params or {}).get('buffer_pool')
         
     def get_next_batch(self):
         epoch,  batchnum = self.curr_epoch, self.curr_batchnum
@@ -168,8 +187,9 @@ class DummyDataProvider(DataProvider):
 
     
 class LabeledDummyDataProvider(DummyDataProvider):
-    def __init__(self, data_dim, num_classes=10, num_cases=512):
+    def __init__(self, data_dim, num_classes=10, num_cases=512, dp_params={}):
         #self.data_dim = data_dim
+        self.buffer_pool = (dp_params or {}).get('buffer_pool')
         self.batch_range = [1]
         self.batch_meta = {'num_vis': data_dim,
                            'label_names': [str(x) for x in range(num_classes)],
@@ -257,39 +277,179 @@ class CIFARDataProvider(LabeledMemoryDataProvider):
     def get_plottable_data(self, data):
         return n.require((data + self.data_mean).T.reshape(data.shape[1], 3, self.img_size, self.img_size).swapaxes(1,3).swapaxes(1,2) / 255.0, dtype=n.single)
     
+# Decodes one pickled record written by imagenet.imagenet_mapper. Returns its label
+# and its pixels as a uint8 vector in channel, row, column order. Runs in the
+# ImageNetDataProvider decode pool.
+# Records are either JPEGs or, if built with --raw, the uint8 CHW pixels themselves.
+def _decode_imagenet_record(pickled):
+    record = cPickle.loads(pickled)
+    if 'shape' in record:
+        return record['label'], n.frombuffer(record['data'], dtype=n.uint8)
+    img = Image.open(c.StringIO(record['data'])).convert('RGB')
+    return record['label'], n.ascontiguousarray(n.asarray(img).transpose(2, 0, 1)).reshape(-1)
+
+class DecodedBatchCache:
+    """Keeps decoded batches so that they only have to be decoded once.
+    
+    Batches are kept in RAM up to max_bytes, evicting the least recently used
+    first. If cache_dir is given every batch put in the cache is also written
+    there as a batch file, and batches that have been evicted from RAM are
+    mapped back in from disk. Files on disk are named by dataset_key as well as
+    the batch number, so that datasets sharing a cache_dir, or a dataset and a
+    rebuilt version of it, never read each other's batches."""
+    def __init__(self, max_bytes, cache_dir=None, dataset_key=''):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.dataset_key = dataset_key
+        self.batches = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.reset_stats()
+    
+    def get_file_name(self, key):
+        return os.path.join(self.cache_dir, 'decoded_batch_%s_%d.mm' % (self.dataset_key, key))
+        
+    # Returns the list of arrays cached under key, or None.
+    def get(self, key):
+        with self.lock:
+            if key in self.batches:
+                arrays = self.batches.pop(key)
+                self.batches[key] = arrays
+                self.ram_hits += 1
+                return arrays
+        if self.cache_dir and os.path.exists(self.get_file_name(key)):
+            arrays = [n.array(a) for a in open_batch_file(self.get_file_name(key), mode='r').values()]
+            self.__put_ram(key, arrays)
+            with self.lock:
+                self.disk_hits += 1
+            return arrays
+        with self.lock:
+            self.misses += 1
+        return None
+    
+    def put(self, key, arrays):
+        self.__put_ram(key, arrays)
+        if self.cache_dir:
+            write_batch_file(self.get_file_name(key), [('array%d' % i, a) for i, a in enumerate(arrays)])
+    
+    def __put_ram(self, key, arrays):
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.batches:
+                self.bytes -= sum(a.nbytes for a in self.batches.pop(key))
+            while self.bytes + size > self.max_bytes:
+                self.bytes -= sum(a.nbytes for a in self.batches.popitem(last=False)[1])
+                self.evictions += 1
+            self.batches[key] = arrays
+            self.bytes += size
+    
+    def reset_stats(self):
+        self.ram_hits, self.disk_hits, self.misses, self.evictions = 0, 0, 0, 0
+        
+    def get_stats(self):
+        return {'ram_hits': self.ram_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'batches': len(self.batches),
+                'bytes': self.bytes}
+
 class ImageNetDataProvider(LabeledDataProvider):
+    # Number of images decoded before they are transposed into the batch matrix together.
+    DECODE_CHUNK = 256
+    
     def __init__(self, data_dir, batch_range, init_epoch=1, init_batchnum=None, dp_params={}, test=False):
         LabeledDataProvider.__init__(self, data_dir, batch_range, init_epoch, init_batchnum, dp_params, test)
         self.num_colors = 3
-        self.img_size = 64
+        self.img_size = self.batch_meta.get('img_size', 64)
+        if 'data_mean' in self.batch_meta:
+            self.data_mean = n.require(self.batch_meta['data_mean'], dtype=n.single).reshape((self.get_data_dims(), 1))
+        else:
+            self.data_mean = n.zeros((self.get_data_dims(), 1), dtype=n.single)
+        # The pool is created here, before the model initializes the GPU, so the
+        # forked workers never inherit a CUDA context. A process forked from this
+        # one (like a process prefetch worker) inherits the pool object but not
+        # the threads that serve it, so only the creating process may use it.
+        workers = dp_params.get('decode_workers', 0) or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+        self.pool_pid = os.getpid()
+        self.batch_locks = {}
+        self.cache = None
+        if dp_params.get('cache_mb', 0) > 0 or dp_params.get('cache_dir'):
+            self.cache = DecodedBatchCache(dp_params.get('cache_mb', 0) * 2**20, dp_params.get('cache_dir'), self.get_cache_key())
 
     def get_next_batch(self):
+        epoch, batchnum = self.curr_epoch, self.curr_batchnum
         self.advance_batch()
 
-        epoch = self.curr_epoch        
-        batchnum = self.curr_batchnum
-        
-        datadic = leveldb.LevelDB(self.data_dir + '/batch-%d' % batchnum)
-        img_raw = []
-        label_raw = []
-        for k, pickled in datadic.RangeIter():
-          imgdata = cPickle.loads(pickled)
-          img_raw.append(Image.open(c.StringIO(imgdata['data'])))
-          label_raw.append(imgdata['label'])
-        
-        labels = n.array(label_raw)
-        images = n.ndarray((len(img_raw), 64 * 64 * 3), dtype=n.single)
-        for idx, jpegdata in enumerate(img_raw):
-          images[idx] = n.array(img_raw)
-     
-        print labels.shape
-        print images.shape
+        return epoch, batchnum, self.load_batch(batchnum)
+
+    # Identifies this dataset's decoded batches in the disk cache: the data
+    # directory, the image format, and the batches.meta file, which
+    # build_imagenet_batch.py rewrites whenever it (re)builds the batches.
+    def get_cache_key(self):
+        meta_stat = os.stat(os.path.join(self.data_dir, BATCH_META_FILE))
+        key = (os.path.abspath(self.data_dir), self.img_size, self.batch_meta.get('raw', False), meta_stat.st_mtime, meta_stat.st_size)
+        return hashlib.md5(repr(key)).hexdigest()[:16]
+
+    # Returns the number of records in batch batchnum and an iterator over them.
+    def get_batch_records(self, batchnum):
+        db = leveldb.LevelDB(os.path.join(self.data_dir, 'batch-%d' % batchnum))
+        num_cases = sum(1 for k in db.RangeIter(include_value=False))
+        return num_cases, (pickled for k, pickled in db.RangeIter())
 
-        images = n.require(images, dtype=n.single, requirements='C')
-        labels = labels.reshape((1, images.shape[1]))
-        labels = n.require(labels, dtype=n.single, requirements='C')
+    # Loads batch batchnum without touching the epoch/batch cursor, so that
+    # several batches can be loaded at once by a PrefetchingDataProvider.
+    # Decoded batches come from the cache when there is one.
+    def load_batch(self, batchnum):
+        # A LevelDB can only be opened once at a time, so loads of the same batch take turns
+        with self.batch_locks.setdefault(batchnum, threading.Lock()):
+            decoded = self.cache.get(batchnum) if self.cache else None
+            if decoded is None:
+                decoded = self.decode_batch(batchnum)
+                if self.cache:
+                    self.cache.put(batchnum, decoded)
+        images, labels = decoded
+        data = self.get_batch_buffer(images.shape)
+        n.subtract(images, self.data_mean, out=data)
+        return [data, labels]
+    
+    # Returns the cache hit/miss counts since the last call and resets them.
+    def get_cache_stats(self):
+        if self.cache is None:
+            return None
+        stats = self.cache.get_stats()
+        self.cache.reset_stats()
+        return stats
+    
+    # Returns the uint8 images of batch batchnum, one per column, and their labels.
+    # Records are streamed to the decode pool and the decoded images are
+    # written straight into the preallocated batch matrix.
+    def decode_batch(self, batchnum):
+        num_cases, records = self.get_batch_records(batchnum)
+        images = n.empty((self.get_data_dims(), num_cases), dtype=n.uint8)
+        labels = n.empty((1, num_cases), dtype=n.single)
+        chunk = n.empty((self.DECODE_CHUNK, self.get_data_dims()), dtype=n.uint8)
+        
+        if self.pool and os.getpid() == self.pool_pid:
+            decoded = self.pool.imap(_decode_imagenet_record, records, 16)
+        else:
+            decoded = (_decode_imagenet_record(r) for r in records)
+        for i, (label, img) in enumerate(decoded):
+            if img.shape[0] != self.get_data_dims():
+                raise DataProviderException("Image %d of batch %d has %d values; expected %dx%dx%d" % (i, batchnum, img.shape[0], self.num_colors, self.img_size, self.img_size))
+            labels[0, i] = label
+            chunk[i % self.DECODE_CHUNK] = img
+            if i % self.DECODE_CHUNK == self.DECODE_CHUNK - 1:
+                images[:, i + 1 - self.DECODE_CHUNK:i + 1] = chunk.T
+        if num_cases % self.DECODE_CHUNK:
+            images[:, num_cases - num_cases % self.DECODE_CHUNK:] = chunk[:num_cases % self.DECODE_CHUNK].T
 
-        return epoch, batchnum, [images, labels]
+        return [images, labels]
 
     # Returns the dimensionality of the two data matrices returned by get_next_batch
     # idx is the index of the matrix. 
@@ -303,6 +463,148 @@ class ImageNetDataProvider(LabeledDataProvider):
     def get_plottable_data(self, data):
         return n.require((data + self.data_mean).T.reshape(data.shape[1], 3, self.img_size, self.img_size).swapaxes(1,3).swapaxes(1,2) / 255.0, dtype=n.single)    
 
+# Reads batches written by convert_batches.py. Each data_batch_N.mm file is mapped
+# into memory rather than unpickled, so loading a batch costs nothing until its
+# pages are touched, and processes on the same host share them in the page cache.
+class MemmapDataProvider(LabeledDataProvider):
+    def __init__(self, data_dir, batch_range, init_epoch=1, init_batchnum=None, dp_params={}, test=False):
+        LabeledDataProvider.__init__(self, data_dir, batch_range, init_epoch, init_batchnum, dp_params, test)
+        self.data_mean = n.require(self.batch_meta['data_mean'], dtype=n.single).reshape((self.batch_meta['num_vis'], 1))
+        self.num_colors = self.batch_meta.get('num_colors', 3)
+        self.img_size = self.batch_meta.get('img_size', int(n.sqrt(self.batch_meta['num_vis'] / self.num_colors)))
+        
+    def get_next_batch(self):
+        epoch, batchnum = self.curr_epoch, self.curr_batchnum
+        self.advance_batch()
+
+        return epoch, batchnum, self.load_batch(batchnum)
+    
+    def load_batch(self, batchnum):
+        arrays = open_batch_file(self.get_data_file_name(batchnum))
+        data, labels = arrays['data'], arrays['labels']
+        if data.dtype != n.single: # stored raw, so subtract the mean here
+            data = n.subtract(data, self.data_mean, out=self.get_batch_buffer(data.shape))
+        return [data, labels]
+    
+    def get_data_file_name(self, batchnum=None):
+        return DataProvider.get_data_file_name(self, batchnum) + '.mm'
+
+    def get_data_dims(self, idx=0):
+        return self.batch_meta['num_vis'] if idx == 0 else 1
+    
+    def get_plottable_data(self, data):
+        return n.require((data + self.data_mean).T.reshape(data.shape[1], self.num_colors, self.img_size, self.img_size).swapaxes(1,3).swapaxes(1,2) / 255.0, dtype=n.single)
+
+class CropFlipAugmenter:
+    """Crops inner_size x inner_size patches out of a batch of img_size x img_size
+    images, stored one image per row, flipping them horizontally as requested.
+    Patches are gathered through a strided view of every possible crop
+    window, so a whole batch is cropped with two fancy-indexing operations
+    rather than one slice per case.
+    
+    Random offsets and flips are drawn all at once from numpy.random. If a seed
+    is given they instead come from a private generator, in the same order
+    as two randint(0, border+1) calls and one randint(2) call per case would
+    draw them. Output is then bit-identical to cropping the cases one at a time."""
+    def __init__(self, img_size, inner_size, num_colors=3, seed=None):
+        self.img_size = img_size
+        self.inner_size = inner_size
+        self.num_colors = num_colors
+        self.max_offset = img_size - inner_size
+        self.seed = seed
+        self.rng = nr if seed is None else nr.RandomState(seed)
+        self.raw = n.zeros(0, dtype=n.uint32) # seeded mode: drawn but unused random words
+        
+    def draw(self, num_cases):
+        if self.seed is not None:
+            return self.__draw_in_order(num_cases)
+        startY = self.rng.randint(0, self.max_offset + 1, size=num_cases)
+        startX = self.rng.randint(0, self.max_offset + 1, size=num_cases)
+        flip = self.rng.randint(2, size=num_cases) == 0
+        return startY, startX, flip
+    
+    # randint(low, high) draws 32-bit words, masks them to the smallest covering
+    # power of two and rejects values >= high - low; randint(2) always uses one word.
+    # Draw enough words at once and replay that process to see which word each
+    # offset and flip came from.
+    def __draw_in_order(self, num_cases):
+        mask = (1 << self.max_offset.bit_length()) - 1
+        raw = self.raw
+        while True:
+            raw = n.r_[raw, self.rng.randint(0, 2**32, size=5*num_cases + 64, dtype=n.uint32)]
+            if self.max_offset > 0:
+                accepted = n.where((raw & mask) <= self.max_offset, n.arange(raw.shape[0]), raw.shape[0])
+                next_accepted = n.minimum.accumulate(accepted[::-1])[::-1].tolist() + [raw.shape[0]]
+            else: # randint(0, 1) returns 0 without drawing anything
+                next_accepted = range(raw.shape[0] + 1)
+            step = 0 if self.max_offset == 0 else 1
+            startY_idx, startX_idx, pos = [], [], 0
+            for c in xrange(num_cases):
+                y = next_accepted[pos]
+                x = next_accepted[y + step] if y < raw.shape[0] else raw.shape[0]
+                pos = x + step + 1
+                if pos > raw.shape[0]:
+                    break
+                startY_idx += [y]
+                startX_idx += [x]
+            if len(startY_idx) == num_cases:
+                break
+        self.raw = raw[pos:]
+        flip_idx = n.array(startX_idx) + step
+        if self.max_offset > 0:
+            startY = (raw[startY_idx] & mask).astype(n.int64)
+            startX = (raw[startX_idx] & mask).astype(n.int64)
+        else:
+            startY = startX = n.zeros(num_cases, dtype=n.int64)
+        return startY, startX, (raw[flip_idx] & 1) == 0
+    
+    # Returns (numCases, startY, startX, colors, innerSize, innerSize) views of
+    # every crop window of the given images, and of the images flipped.
+    def __windows(self, images):
+        views = []
+        for imgs in (images, images[:,:,:,::-1]):
+            s = imgs.strides
+            views += [as_strided(imgs, shape=(imgs.shape[0], self.max_offset + 1, self.max_offset + 1, self.num_colors, self.inner_size, self.inner_size),
+                                 strides=(s[0], s[2], s[3], s[1], s[2], s[3]))]
+        return views
+    
+    # Writes the patch of image cases[i] starting at (startY[i], startX[i]) into
+    # column i of target, flipped if flip[i] is true.
+    def crop(self, x, target, startY, startX, flip, cases):
+        images = x.reshape(x.shape[0], self.num_colors, self.img_size, self.img_size)
+        windows, flipped_windows = self.__windows(images)
+        patches = n.empty((len(cases), self.num_colors, self.inner_size, self.inner_size), dtype=x.dtype)
+        idx = n.flatnonzero(~flip)
+        patches[idx] = windows[cases[idx], startY[idx], startX[idx]]
+        # Column startX of an image is column max_offset - startX of its mirror image
+        idx = n.flatnonzero(flip)
+        patches[idx] = flipped_windows[cases[idx], startY[idx], self.max_offset - startX[idx]]
+        target[:,:] = patches.reshape((len(cases), target.shape[0])).T
+        
+    def random_crop(self, x, target):
+        startY, startX, flip = self.draw(x.shape[0])
+        self.crop(x, target, startY, startX, flip, n.arange(x.shape[0]))
+    
+    # Crops every case at the same position, which needs no gathering at all.
+    def crop_all(self, x, target, startY, startX, flip=False):
+        images = x.reshape(x.shape[0], self.num_colors, self.img_size, self.img_size)
+        pic = images[:, :, startY:startY + self.inner_size, startX:startX + self.inner_size]
+        if flip:
+            pic = pic[:,:,:,::-1]
+        target[:,:] = pic.reshape((x.shape[0], target.shape[0])).T
+        
+    def center_crop(self, x, target):
+        self.crop_all(x, target, self.max_offset / 2, self.max_offset / 2)
+    
+    # Crops every case at each of the given start positions and again flipped.
+    # View i of all cases goes in columns i*numCases:(i+1)*numCases of target,
+    # with the flipped views after the unflipped ones.
+    def multiview_crop(self, x, target, start_positions):
+        num_cases, num_views = x.shape[0], len(start_positions)
+        for i, (startY, startX) in enumerate(start_positions):
+            self.crop_all(x, target[:,i*num_cases:(i+1)*num_cases], startY, startX)
+            self.crop_all(x, target[:,(num_views + i)*num_cases:(num_views + i + 1)*num_cases], startY, startX, flip=True)
+
 class CroppedCIFARDataProvider(LabeledMemoryDataProvider):
     def __init__(self, data_dir, batch_range=None, init_epoch=1, init_batchnum=None, dp_params=None, test=False):
         LabeledMemoryDataProvider.__init__(self, data_dir, batch_range, init_epoch, init_batchnum, dp_params, test)
@@ -315,18 +617,29 @@ class CroppedCIFARDataProvider(LabeledMemoryDataProvider):
         self.num_colors = 3
         
         for d in self.data_dic:
-            d['data'] = n.require(d['data'], requirements='C')
             d['labels'] = n.require(n.tile(d['labels'].reshape((1, d['data'].shape[1])), (1, self.data_mult)), requirements='C')
+            # Store one image per row, so that CropFlipAugmenter reads each crop from contiguous memory
+            d['data'] = n.require(d['data'].T, requirements='C')
         
-        self.cropped_data = [n.zeros((self.get_data_dims(), self.data_dic[0]['data'].shape[1]*self.data_mult), dtype=n.single) for x in xrange(2)]
+        # One buffer for the batch on the GPU, one being filled, plus one for
+        # every batch a PrefetchingDataProvider keeps queued. With a buffer
+        # pool, the batches come from the pool instead.
+        self.num_buffers = 0 if self.buffer_pool else 2 + dp_params.get('prefetch', 0)
+        self.cropped_shape = (self.get_data_dims(), self.data_dic[0]['data'].shape[0]*self.data_mult)
+        self.cropped_data = [n.zeros(self.cropped_shape, dtype=n.single) for x in xrange(self.num_buffers)]
 
+        crop_seed = dp_params.get('crop_seed', -1)
+        self.augmenter = CropFlipAugmenter(32, self.inner_size, self.num_colors, seed=crop_seed if crop_seed >= 0 else None)
         self.batches_generated = 0
         self.data_mean = self.batch_meta['data_mean'].reshape((3,32,32))[:,self.border_size:self.border_size+self.inner_size,self.border_size:self.border_size+self.inner_size].reshape((self.get_data_dims(), 1))
 
     def get_next_batch(self):
         epoch, batchnum, datadic = LabeledMemoryDataProvider.get_next_batch(self)
 
-        cropped = self.cropped_data[self.batches_generated % 2]
+        if self.buffer_pool:
+            cropped = self.get_batch_buffer(self.cropped_shape)
+        else:
+            cropped = self.cropped_data[self.batches_generated % self.num_buffers]
 
         self.__trim_borders(datadic['data'], cropped)
         cropped -= self.data_mean
@@ -344,50 +657,186 @@ class CroppedCIFARDataProvider(LabeledMemoryDataProvider):
         return n.require((data + self.data_mean).T.reshape(data.shape[1], 3, self.inner_size, self.inner_size).swapaxes(1,3).swapaxes(1,2) / 255.0, dtype=n.single)
     
     def __trim_borders(self, x, target):
-        y = x.reshape(3, 32, 32, x.shape[1])
-
         if self.test: # don't need to loop over cases
             if self.multiview:
                 start_positions = [(0,0),  (0, self.border_size*2),
                                    (self.border_size, self.border_size),
                                   (self.border_size*2, 0), (self.border_size*2, self.border_size*2)]
-                end_positions = [(sy+self.inner_size, sx+self.inner_size) for (sy,sx) in start_positions]
-                for i in xrange(self.num_views/2):
-                    pic = y[:,start_positions[i][0]:end_positions[i][0],start_positions[i][1]:end_positions[i][1],:]
-                    target[:,i * x.shape[1]:(i+1)* x.shape[1]] = pic.reshape((self.get_data_dims(),x.shape[1]))
-                    target[:,(self.num_views/2 + i) * x.shape[1]:(self.num_views/2 +i+1)* x.shape[1]] = pic[:,:,::-1,:].reshape((self.get_data_dims(),x.shape[1]))
+                self.augmenter.multiview_crop(x, target, start_positions)
             else:
-                pic = y[:,self.border_size:self.border_size+self.inner_size,self.border_size:self.border_size+self.inner_size, :] # just take the center for now
-                target[:,:] = pic.reshape((self.get_data_dims(), x.shape[1]))
+                self.augmenter.center_crop(x, target) # just take the center for now
         else:
-            for c in xrange(x.shape[1]): # loop over cases
-                startY, startX = nr.randint(0,self.border_size*2 + 1), nr.randint(0,self.border_size*2 + 1)
-                endY, endX = startY + self.inner_size, startX + self.inner_size
-                pic = y[:,startY:endY,startX:endX, c]
-                if nr.randint(2) == 0: # also flip the image with 50% probability
-                    pic = pic[:,:,::-1]
-                target[:,c] = pic.reshape((self.get_data_dims(),))
+            self.augmenter.random_crop(x, target)
    
 class DummyConvNetDataProvider(LabeledDummyDataProvider):
-    def __init__(self, data_dim):
-        LabeledDummyDataProvider.__init__(self, data_dim)
+    def __init__(self, data_dim, dp_params={}):
+        LabeledDummyDataProvider.__init__(self, data_dim, dp_params=dp_params)
         
     def get_next_batch(self):
         epoch, batchnum, dic = LabeledDummyDataProvider.get_next_batch(self)
         
-        dic['data'] = n.require(dic['data'].T, requirements='C')
-        dic['labels'] = n.require(dic['labels'].T, requirements='C')
+        data = self.get_batch_buffer(dic['data'].shape[::-1])
+        data[...] = dic['data'].T
+        labels = self.get_batch_buffer(dic['labels'].shape[::-1])
+        labels[...] = dic['labels'].T
         
-        return epoch, batchnum, [dic['data'], dic['labels']]
+        return epoch, batchnum, [data, labels]
     
     # Returns the dimensionality of the two data matrices returned by get_next_batch
     def get_data_dims(self, idx=0):
         return self.batch_meta['num_vis'] if idx == 0 else 1
 
+class BatchBufferPool:
+    """A ring of page-aligned, C-contiguous batch buffers that data providers
+    fill in place, so that batches stop allocating memory once training is
+    under way.
+    
+    get() returns a free buffer of the requested shape and dtype. Buffers stay
+    in use until release() hands them back, which the caller does once the
+    model is done with the batch. At most size buffers of each shape and dtype
+    are pooled; past that, get() returns buffers that release() ignores, as it
+    ignores arrays that did not come from the pool."""
+    def __init__(self, size):
+        self.size = size
+        self.free = {}
+        self.pooled = {}
+        self.lock = threading.Lock()
+        self.allocations = 0
+        self.reuses = 0
+        
+    def get(self, shape, dtype=n.single):
+        key = (tuple(shape), n.dtype(dtype).str)
+        with self.lock:
+            free = self.free.setdefault(key, [])
+            if free:
+                self.reuses += 1
+                return free.pop()
+            self.allocations += 1
+            buf = empty_aligned(shape, dtype)
+            if sum(k == key for k, b in self.pooled.itervalues()) < self.size:
+                self.pooled[id(buf)] = (key, buf)
+            return buf
+    
+    # Returns the given arrays to the pool, skipping any that are not pooled buffers.
+    def release(self, *arrays):
+        with self.lock:
+            for a in arrays:
+                key, buf = self.pooled.get(id(a), (None, None))
+                if buf is a and all(b is not a for b in self.free[key]):
+                    self.free[key].append(a)
+    
+    def get_stats(self):
+        with self.lock:
+            free = sum(len(f) for f in self.free.itervalues())
+            return {'allocations': self.allocations,
+                    'reuses': self.reuses,
+                    'pooled': len(self.pooled),
+                    'in_use': len(self.pooled) - free}
+
+# The provider a process pool worker loads batches from. It is set before the
+# pool forks, so every worker inherits its own copy.
+_prefetch_dp = None
+
+def _prefetch_load(batchnum):
+    return _prefetch_dp.load_batch(batchnum)
+
+# Does the provider own a running process pool? Forked workers inherit such a
+# pool without the threads that serve it, so they cannot use it.
+def _owns_process_pool(dp):
+    return any(isinstance(v, multiprocessing.pool.Pool) and not isinstance(v, ThreadPool) and v._state == multiprocessing.pool.RUN
+               for v in vars(dp).itervalues())
+
+class PrefetchingDataProvider(object):
+    """Wraps a data provider and keeps up to depth batches loading in the background.
+    
+    If the provider implements load_batch(batchnum), batches are loaded in
+    parallel on a pool of workers ('thread' or 'process'). Otherwise the
+    provider's own get_next_batch is called on a single background thread.
+    Either way batches come out in exactly the order advance_batch produces.
+    Providers that recycle their output arrays must keep depth + 2 of them.
+    A 'process' pool cannot wrap a provider that owns a process pool of its
+    own, like an ImageNetDataProvider with more than one decode worker.
+    Everything other than get_next_batch is forwarded to the wrapped provider."""
+    def __init__(self, dp, depth=2, workers=1, pool_type='thread'):
+        global _prefetch_dp
+        if pool_type not in ('thread', 'process'):
+            raise DataProviderException("Unknown prefetch pool type: %s" % pool_type)
+        self.dp = dp
+        self.depth = max(1, depth)
+        self.parallel = hasattr(dp, 'load_batch')
+        if not self.parallel:
+            workers, pool_type = 1, 'thread'
+        if pool_type == 'process':
+            if _owns_process_pool(dp):
+                raise DataProviderException("Process prefetching cannot wrap %s, which has its own process pool; use thread prefetching or a single decode worker"
+                                            % dp.__class__.__name__)
+            _prefetch_dp = dp
+            self.pool = multiprocessing.Pool(workers)
+        else:
+            self.pool = ThreadPool(workers)
+        self.pool_type = pool_type
+        self.workers = workers
+        self.pending = deque()
+        
+        self.batches_served = 0
+        self.stalls = 0
+        self.wait_time = 0.0
+        self.last_wait_time = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.dp, name)
+
+    def __fill(self):
+        while len(self.pending) < self.depth:
+            if self.parallel:
+                epoch, batchnum = self.dp.curr_epoch, self.dp.curr_batchnum
+                self.dp.advance_batch()
+                if self.pool_type == 'process':
+                    res = self.pool.apply_async(_prefetch_load, (batchnum,))
+                else:
+                    res = self.pool.apply_async(self.dp.load_batch, (batchnum,))
+                self.pending.append((epoch, batchnum, res))
+            else:
+                self.pending.append((None, None, self.pool.apply_async(self.dp.get_next_batch)))
+
+    def get_next_batch(self):
+        self.__fill()
+        epoch, batchnum, res = self.pending.popleft()
+        if not res.ready():
+            self.stalls += 1
+        start = time()
+        data = res.get()
+        self.last_wait_time = time() - start
+        self.wait_time += self.last_wait_time
+        self.batches_served += 1
+        self.__fill()
+        if epoch is None:
+            return data
+        return epoch, batchnum, data
+    
+    # Number of batches requested from the pool and number of those that are ready.
+    def get_queue_depth(self):
+        return len(self.pending), sum(res.ready() for e, b, res in self.pending)
+    
+    def get_stats(self):
+        queued, ready = self.get_queue_depth()
+        return {'queued': queued,
+                'ready': ready,
+                'batches': self.batches_served,
+                'stalls': self.stalls,
+                'wait_time': self.wait_time,
+                'last_wait_time': self.last_wait_time}
+    
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.pending.clear()
+
 dp_types = {}
 dp_classes = {}
 DataProvider.register_data_provider('imagenet', 'ImageNet', ImageNetDataProvider)
 DataProvider.register_data_provider('cifar', 'CIFAR', CIFARDataProvider)
 DataProvider.register_data_provider('dummy-cn-n', 'Dummy ConvNet', DummyConvNetDataProvider)
 DataProvider.register_data_provider('cifar-cropped', 'Cropped CIFAR', CroppedCIFARDataProvider)
+DataProvider.register_data_provider('memmap', 'Memory-mapped batches', MemmapDataProvider)
 
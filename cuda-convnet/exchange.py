@@ -0,0 +1,849 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Weight exchange between the ranks of an MPI job.
+#
+# All of a model's weight and bias arrays (and their increments) are packed into
+# one contiguous float32 buffer with a fixed layout, so that an exchange is a
+# single buffer collective rather than a pickled broadcast of the layer dicts.
+#
+# Self-test: mpirun -np 4 python exchange.py
+# Benchmark: mpirun -np 4 python exchange.py benchmark <mode> <batches> <exchange freq> [<fake hosts>]
+# Codec regression: mpirun -np 4 python exchange.py regression <codec> <batches> <exchange freq>
+
+from mpi4py import MPI
+from time import time
+import numpy as n
+import sys
+import zlib
+
+class WeightLayout:
+    """The position of every weight, weight increment, bias and bias increment
+    array of a list of layer dicts in one flat float32 buffer. Arrays shared
+    between layers appear once."""
+    def __init__(self, layers):
+        self.arrays = []
+        seen = set()
+        for l in layers:
+            if 'weights' not in l:
+                continue
+            for a in l['weights'] + l['weightsInc'] + [l['biases'], l['biasesInc']]:
+                if id(a) not in seen:
+                    seen.add(id(a))
+                    self.arrays += [a]
+        self.offsets = n.cumsum([0] + [a.size for a in self.arrays])
+        self.size = int(self.offsets[-1])
+        self.nbytes = self.size * n.dtype(n.single).itemsize
+
+    def new_buffer(self):
+        return n.empty(self.size, dtype=n.single)
+
+    # Copies the arrays into buf (a new buffer if None) and returns it.
+    def pack(self, buf=None):
+        if buf is None:
+            buf = self.new_buffer()
+        for a, start, end in zip(self.arrays, self.offsets[:-1], self.offsets[1:]):
+            buf[start:end] = a.reshape(-1)
+        return buf
+
+    # Copies buf into the arrays, in place, so that anything holding on to them sees the new values.
+    def unpack(self, buf):
+        for a, start, end in zip(self.arrays, self.offsets[:-1], self.offsets[1:]):
+            a[...] = buf[start:end].reshape(a.shape)
+
+class WeightExchanger:
+    """Lets every rank of comm take over the weights of the rank with the lowest cost.
+    
+    An exchange has two phases. The ranks first gather each other's costs and
+    agree on the receivers: the ranks whose cost is at least threshold times
+    the best. Only the best rank and the receivers then take part in the
+    transfer, point to point if there is one receiver and as a broadcast on a
+    sub-communicator otherwise. If there are no receivers nothing is sent.
+    
+    exchange() returns whether the local weights were replaced. The bytes
+    moved and the time taken by the last exchange are kept in last_bytes and
+    last_time."""
+    def __init__(self, comm, layers, threshold=1.05):
+        self.comm = comm
+        self.layout = WeightLayout(layers)
+        self.buffer = self.layout.new_buffer()
+        self.threshold = threshold
+        self.rank = comm.Get_rank()
+
+        self.exchanges = 0
+        self.last_bytes = 0
+        self.last_time = 0.0
+        self.total_bytes = 0
+        self.total_time = 0.0
+        self.costs = []
+        self.best_rank = self.rank
+        self.receivers = []
+
+    # prepare_send, if given, is called on the sending rank before its weights are
+    # packed, e.g. to bring the host copies of the weights up to date.
+    def exchange(self, my_cost, prepare_send=None):
+        start = time()
+        self.costs = self.comm.allgather(my_cost)
+        self.best_rank = int(n.argmin(self.costs))
+        best_cost = self.costs[self.best_rank]
+        self.receivers = [r for r, cost in enumerate(self.costs) if r != self.best_rank and cost >= self.threshold * best_cost]
+        
+        nbytes = 0
+        if self.rank == self.best_rank and self.receivers:
+            if prepare_send is not None:
+                prepare_send()
+            self.layout.pack(self.buffer)
+            nbytes = self.layout.nbytes * len(self.receivers)
+        elif self.rank in self.receivers:
+            nbytes = self.layout.nbytes
+        self.__transfer()
+        
+        changed = self.rank in self.receivers
+        if changed:
+            self.layout.unpack(self.buffer)
+        self.__record(nbytes, time() - start)
+        return changed
+    
+    def __transfer(self):
+        if len(self.receivers) == 1:
+            if self.rank == self.best_rank:
+                self.comm.Send([self.buffer, MPI.FLOAT], dest=self.receivers[0])
+            elif self.rank == self.receivers[0]:
+                self.comm.Recv([self.buffer, MPI.FLOAT], source=self.best_rank)
+        elif len(self.receivers) > 1:
+            # every rank knows the receivers, so all of them can take part in the split
+            participating = self.rank == self.best_rank or self.rank in self.receivers
+            subcomm = self.comm.Split(0 if participating else MPI.UNDEFINED, 0 if self.rank == self.best_rank else 1 + self.rank)
+            if participating:
+                subcomm.Bcast([self.buffer, MPI.FLOAT], root=0)
+                subcomm.Free()
+
+    def __record(self, nbytes, elapsed):
+        self.exchanges += 1
+        self.last_bytes, self.last_time = nbytes, elapsed
+        self.total_bytes += nbytes
+        self.total_time += elapsed
+
+class WeightAverager:
+    """Replaces the weights of every rank of comm with the average over all ranks.
+    
+    The packed buffers are summed with an in-place Allreduce. Weight and bias
+    increments are averaged along with the weights, so momentum carries on
+    from the averaged model. Has the same interface as WeightExchanger; every
+    rank sends, so prepare_send is called everywhere and exchange() always
+    returns True. last_bytes counts what a ring allreduce moves per rank."""
+    def __init__(self, comm, layers):
+        self.comm = comm
+        self.layout = WeightLayout(layers)
+        self.buffer = self.layout.new_buffer()
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+
+        self.exchanges = 0
+        self.last_bytes = 0
+        self.last_time = 0.0
+        self.total_bytes = 0
+        self.total_time = 0.0
+        self.costs = []
+        self.best_rank = self.rank
+        self.receivers = [r for r in xrange(self.size) if r != self.rank]
+        
+    def exchange(self, my_cost, prepare_send=None):
+        start = time()
+        self.costs = self.comm.allgather(my_cost)
+        self.best_rank = int(n.argmin(self.costs))
+        if prepare_send is not None:
+            prepare_send()
+        self.layout.pack(self.buffer)
+        self.comm.Allreduce(MPI.IN_PLACE, [self.buffer, MPI.FLOAT], op=MPI.SUM)
+        self.buffer /= self.size
+        self.layout.unpack(self.buffer)
+        
+        elapsed = time() - start
+        self.exchanges += 1
+        self.last_bytes, self.last_time = 2 * self.layout.nbytes * (self.size - 1) / self.size, elapsed
+        self.total_bytes += self.last_bytes
+        self.total_time += elapsed
+        return True
+
+class AsyncWeightExchanger:
+    """Runs best-peer or averaging exchanges with non-blocking MPI calls, so that
+    training carries on while the weights are in flight.
+    
+    start() snapshots the local weights and posts the first step of an
+    exchange. progress() is called at every batch boundary after that. It
+    moves the exchange along as far as it can without blocking, and applies
+    the received weights once they are in. An exchange is forced to finish
+    at the staleness-th boundary, so weights are never applied more than
+    staleness batches after they were sent.
+    
+    In best mode the costs are gathered with Iallgather first, then the best
+    rank Isends its snapshot to the receivers. In average mode the snapshots
+    are summed with Iallreduce; the averaged weights plus whatever the local
+    model has learned since the snapshot replace the local weights.
+    
+    sync_host and copy_to_gpu are called to bring the host weights up to date
+    and to upload them again. Time spent blocked on MPI is kept in wait_time."""
+    def __init__(self, comm, layers, mode, threshold=1.05, staleness=1, sync_host=None, copy_to_gpu=None):
+        if mode not in exchange_modes:
+            raise ExchangeModeException("Unknown exchange mode '%s'; expected one of %s" % (mode, ", ".join(sorted(exchange_modes))))
+        self.comm = comm
+        self.layout = WeightLayout(layers)
+        self.snapshot = self.layout.new_buffer()
+        self.buffer = self.layout.new_buffer()
+        self.mode = mode
+        self.threshold = threshold
+        self.staleness = max(1, staleness)
+        self.sync_host = sync_host or (lambda: None)
+        self.copy_to_gpu = copy_to_gpu or (lambda: None)
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        
+        self.my_cost = n.zeros(1, dtype=n.float64)
+        self.cost_buffer = n.zeros(self.size, dtype=n.float64)
+        self.state = None
+        self.requests = []
+        self.age = 0
+        
+        self.exchanges = 0
+        self.applied = 0
+        self.last_bytes = 0
+        self.total_bytes = 0
+        self.wait_time = 0.0
+        self.pending_wait_time = 0.0
+        self.costs = []
+        self.best_rank = self.rank
+        self.receivers = []
+        
+    def is_busy(self):
+        return self.state is not None
+    
+    def start(self, my_cost):
+        if self.is_busy():
+            self.finish()
+        self.sync_host()
+        self.layout.pack(self.snapshot)
+        self.age = 0
+        self.exchanges += 1
+        if self.mode == 'average':
+            self.buffer[:] = self.snapshot
+            self.requests = [self.comm.Iallreduce(MPI.IN_PLACE, [self.buffer, MPI.FLOAT], op=MPI.SUM)]
+            self.receivers = [r for r in xrange(self.size) if r != self.rank]
+            self.last_bytes = 2 * self.layout.nbytes * (self.size - 1) / self.size
+            self.state = 'weights'
+        else:
+            self.my_cost[0] = my_cost
+            self.requests = [self.comm.Iallgather([self.my_cost, MPI.DOUBLE], [self.cost_buffer, MPI.DOUBLE])]
+            self.state = 'costs'
+        self.total_bytes += self.last_bytes
+        
+    # Called at every batch boundary. Returns True if new weights were applied.
+    def progress(self):
+        if not self.is_busy():
+            return False
+        self.age += 1
+        return self.__advance(self.age >= self.staleness)
+    
+    # Blocks until the exchange in flight, if any, is complete.
+    def finish(self):
+        if self.is_busy():
+            return self.__advance(True)
+        return False
+    
+    def __advance(self, block):
+        if self.state == 'costs':
+            if not self.__complete(block):
+                return False
+            self.__send_weights()
+        if self.state == 'weights':
+            if not self.__complete(block):
+                return False
+            self.state = None
+            return self.__apply()
+        return False
+    
+    def __complete(self, block):
+        start = time()
+        if block:
+            MPI.Request.Waitall(self.requests)
+            done = True
+        else:
+            done = MPI.Request.Testall(self.requests)
+        self.wait_time += time() - start
+        self.pending_wait_time += time() - start
+        return done
+    
+    def __send_weights(self):
+        self.costs = list(self.cost_buffer)
+        self.best_rank = int(n.argmin(self.costs))
+        best_cost = self.costs[self.best_rank]
+        self.receivers = [r for r, cost in enumerate(self.costs) if r != self.best_rank and cost >= self.threshold * best_cost]
+        if self.rank == self.best_rank:
+            self.requests = [self.comm.Isend([self.snapshot, MPI.FLOAT], dest=r) for r in self.receivers]
+            self.last_bytes = self.layout.nbytes * len(self.receivers)
+        elif self.rank in self.receivers:
+            self.requests = [self.comm.Irecv([self.buffer, MPI.FLOAT], source=self.best_rank)]
+            self.last_bytes = self.layout.nbytes
+        else:
+            self.requests = []
+            self.last_bytes = 0
+        self.total_bytes += self.last_bytes
+        self.state = 'weights'
+    
+    def __apply(self):
+        if self.mode == 'average':
+            self.buffer /= self.size
+            # keep what the local model has learned since the snapshot
+            self.sync_host()
+            self.buffer += self.layout.pack()
+            self.buffer -= self.snapshot
+        elif self.rank not in self.receivers:
+            return False
+        self.layout.unpack(self.buffer)
+        self.copy_to_gpu()
+        self.applied += 1
+        return True
+        
+    # Returns the time spent blocked on MPI since the last call.
+    def take_wait_time(self):
+        wait_time, self.pending_wait_time = self.pending_wait_time, 0.0
+        return wait_time
+
+class ExchangeCodecException(Exception):
+    pass
+
+class DeltaCodec:
+    """Encodes float32 weight deltas for sending. spec is a comma-separated list
+    of stages: optionally one of
+    
+        fp16             down-cast to float16
+        topk[:fraction]  keep the largest fraction (default 0.01) of the values by magnitude
+    
+    which turn the array into bytes, followed optionally by
+    
+        zlib[:level]     deflate the bytes (default level 1).
+    
+    Without the first kind of stage the raw float32 bytes are used."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.array_stage = None
+        self.fraction = 0.01
+        self.zlib_level = None
+        for stage in [st for st in spec.split(',') if st]:
+            name, sep, arg = stage.partition(':')
+            try:
+                if name in ('fp16', 'topk') and self.array_stage is None and self.zlib_level is None:
+                    self.array_stage = name
+                    if name == 'topk':
+                        self.fraction = float(arg) if arg else self.fraction
+                        if not 0 < self.fraction <= 1:
+                            raise ValueError
+                elif name == 'zlib' and self.zlib_level is None:
+                    self.zlib_level = int(arg) if arg else 1
+                else:
+                    raise ValueError
+            except ValueError:
+                raise ExchangeCodecException("Bad stage '%s' in exchange codec '%s'" % (stage, spec))
+        self.lossy = self.array_stage is not None
+        
+    def encode(self, delta):
+        if self.array_stage == 'fp16':
+            data = delta.astype(n.float16).tostring()
+        elif self.array_stage == 'topk':
+            k = max(1, int(self.fraction * delta.size))
+            idx = n.sort(n.argpartition(n.abs(delta), delta.size - k)[delta.size - k:]).astype(n.int32)
+            data = idx.tostring() + delta[idx].tostring()
+        else:
+            data = delta.tostring()
+        if self.zlib_level is not None:
+            data = zlib.compress(data, self.zlib_level)
+        return data
+    
+    # Returns the dense float32 delta of the given size that data encodes.
+    def decode(self, data, size):
+        if self.zlib_level is not None:
+            data = zlib.decompress(data)
+        if self.array_stage == 'fp16':
+            return n.frombuffer(data, dtype=n.float16).astype(n.single)
+        if self.array_stage == 'topk':
+            k = len(data) / 8
+            delta = n.zeros(size, dtype=n.single)
+            delta[n.frombuffer(data[:4 * k], dtype=n.int32)] = n.frombuffer(data[4 * k:], dtype=n.single)
+            return delta
+        return n.frombuffer(data, dtype=n.single).copy()
+
+class CompressedWeightAverager:
+    """Averages the weights of every rank of comm like WeightAverager, but sends
+    each rank's change since the last average through a DeltaCodec.
+    
+    All ranks hold the same reference weights, the result of the last
+    average. Each rank encodes the difference between its weights and the
+    reference, the encoded deltas are allgathered, and every rank decodes
+    them all and adds their mean to the reference. For lossy codecs the part
+    of a delta that was lost in encoding is carried over into the next one
+    (error feedback), so small updates are delayed rather than dropped.
+    The first exchange is a plain average, to set up the reference."""
+    def __init__(self, comm, layers, codec):
+        self.comm = comm
+        self.layout = WeightLayout(layers)
+        self.codec = codec
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.reference = None
+        self.residual = n.zeros(self.layout.size, dtype=n.single)
+        
+        self.exchanges = 0
+        self.last_bytes = 0
+        self.last_time = 0.0
+        self.total_bytes = 0
+        self.total_time = 0.0
+        self.last_ratio = 1.0
+        self.last_encode_time = 0.0
+        self.last_decode_time = 0.0
+        self.costs = []
+        self.best_rank = self.rank
+        self.receivers = [r for r in xrange(self.size) if r != self.rank]
+        
+    def exchange(self, my_cost, prepare_send=None):
+        start = time()
+        self.costs = self.comm.allgather(my_cost)
+        self.best_rank = int(n.argmin(self.costs))
+        if prepare_send is not None:
+            prepare_send()
+        weights = self.layout.pack()
+        
+        if self.reference is None:
+            self.comm.Allreduce(MPI.IN_PLACE, [weights, MPI.FLOAT], op=MPI.SUM)
+            weights /= self.size
+            self.reference = weights
+            self.last_bytes = 2 * self.layout.nbytes * (self.size - 1) / self.size
+            self.last_ratio, self.last_encode_time, self.last_decode_time = 1.0, 0.0, 0.0
+        else:
+            encode_start = time()
+            delta = weights - self.reference + self.residual
+            data = self.codec.encode(delta)
+            if self.codec.lossy:
+                self.residual = delta - self.codec.decode(data, self.layout.size)
+            self.last_encode_time = time() - encode_start
+            
+            peer_data = self.comm.allgather(data)
+            
+            decode_start = time()
+            for d in peer_data:
+                self.reference += self.codec.decode(d, self.layout.size) / self.size
+            self.last_decode_time = time() - decode_start
+            self.last_bytes = sum(len(d) for d in peer_data) - len(data) # received
+            self.last_ratio = float(self.layout.nbytes) / len(data)
+        self.layout.unpack(self.reference)
+        
+        elapsed = time() - start
+        self.exchanges += 1
+        self.last_time = elapsed
+        self.total_bytes += self.last_bytes
+        self.total_time += elapsed
+        return True
+
+class HostTopology:
+    """Groups the ranks of comm by host.
+    
+    node_comm holds the ranks on this rank's host, and leader_comm, on the
+    host's first rank only, holds one leader per host. host_of[r] is the
+    host of rank r and leaders[h] the rank leading host h. With fake_hosts,
+    the ranks of each real host are dealt out in consecutive blocks to that
+    many pretend hosts, to try hierarchical exchanges on one machine."""
+    def __init__(self, comm, fake_hosts=0):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        shared_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=self.rank)
+        if fake_hosts > 0:
+            per_host = -(-comm.Get_size() // fake_hosts)
+            self.node_comm = shared_comm.Split(self.rank // per_host, self.rank)
+            shared_comm.Free()
+        else:
+            self.node_comm = shared_comm
+        self.is_leader = self.node_comm.Get_rank() == 0
+        self.leader_comm = comm.Split(0 if self.is_leader else MPI.UNDEFINED, self.rank)
+        
+        host = self.node_comm.bcast(self.leader_comm.Get_rank() if self.is_leader else None, root=0)
+        self.host_of = comm.allgather(host)
+        self.num_hosts = max(self.host_of) + 1
+        self.leaders = [self.host_of.index(h) for h in xrange(self.num_hosts)]
+        
+    # Returns a float32 array of the given size in memory shared by the ranks of
+    # this host, and the window that owns it, which must be kept alive with it.
+    def allocate_shared(self, size):
+        itemsize = n.dtype(n.single).itemsize
+        win = MPI.Win.Allocate_shared(size * itemsize if self.is_leader else 0, itemsize, comm=self.node_comm)
+        mem, itemsize = win.Shared_query(0)
+        return n.ndarray(buffer=mem, dtype=n.single, shape=(size,)), win
+
+class HierarchicalWeightExchanger:
+    """A WeightExchanger that only sends weights between hosts once per host.
+    
+    The best rank packs its weights into its host's shared buffer. Its host's
+    leader sends the buffer to the leader of every other host with receivers,
+    and the receivers unpack from their host's shared buffer. last_bytes
+    counts the bytes this rank sent or received between hosts."""
+    def __init__(self, topology, layers, threshold=1.05):
+        self.topology = topology
+        self.comm = topology.comm
+        self.layout = WeightLayout(layers)
+        self.shared, self.win = topology.allocate_shared(self.layout.size)
+        self.threshold = threshold
+        self.rank = self.comm.Get_rank()
+
+        self.exchanges = 0
+        self.last_bytes = 0
+        self.last_time = 0.0
+        self.total_bytes = 0
+        self.total_time = 0.0
+        self.costs = []
+        self.best_rank = self.rank
+        self.receivers = []
+        
+    def exchange(self, my_cost, prepare_send=None):
+        start = time()
+        topo = self.topology
+        self.costs = self.comm.allgather(my_cost)
+        self.best_rank = int(n.argmin(self.costs))
+        best_cost = self.costs[self.best_rank]
+        self.receivers = [r for r, cost in enumerate(self.costs) if r != self.best_rank and cost >= self.threshold * best_cost]
+        nbytes = 0
+        
+        if self.receivers:
+            best_host = topo.host_of[self.best_rank]
+            hosts = sorted(set(topo.host_of[r] for r in self.receivers) - set([best_host]))
+            if self.rank == self.best_rank:
+                if prepare_send is not None:
+                    prepare_send()
+                self.layout.pack(self.shared)
+            topo.node_comm.Barrier()
+            if topo.is_leader and topo.host_of[self.rank] == best_host:
+                requests = [topo.leader_comm.Isend([self.shared, MPI.FLOAT], dest=h) for h in hosts]
+                MPI.Request.Waitall(requests)
+                nbytes = self.layout.nbytes * len(hosts)
+            elif topo.is_leader and topo.host_of[self.rank] in hosts:
+                topo.leader_comm.Recv([self.shared, MPI.FLOAT], source=best_host)
+                nbytes = self.layout.nbytes
+            topo.node_comm.Barrier()
+            if self.rank in self.receivers:
+                self.layout.unpack(self.shared)
+        
+        elapsed = time() - start
+        self.exchanges += 1
+        self.last_bytes, self.last_time = nbytes, elapsed
+        self.total_bytes += nbytes
+        self.total_time += elapsed
+        return self.rank in self.receivers
+
+class HierarchicalWeightAverager:
+    """A WeightAverager that sums within each host first.
+    
+    The weights of a host's ranks are reduced into the host's shared buffer,
+    the host leaders allreduce those sums, and every rank unpacks the average
+    from its host's shared buffer. last_bytes counts the bytes this rank
+    moved between hosts."""
+    def __init__(self, topology, layers):
+        self.topology = topology
+        self.comm = topology.comm
+        self.layout = WeightLayout(layers)
+        self.buffer = self.layout.new_buffer()
+        self.shared, self.win = topology.allocate_shared(self.layout.size)
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+
+        self.exchanges = 0
+        self.last_bytes = 0
+        self.last_time = 0.0
+        self.total_bytes = 0
+        self.total_time = 0.0
+        self.costs = []
+        self.best_rank = self.rank
+        self.receivers = [r for r in xrange(self.size) if r != self.rank]
+        
+    def exchange(self, my_cost, prepare_send=None):
+        start = time()
+        topo = self.topology
+        self.costs = self.comm.allgather(my_cost)
+        self.best_rank = int(n.argmin(self.costs))
+        if prepare_send is not None:
+            prepare_send()
+        self.layout.pack(self.buffer)
+        
+        topo.node_comm.Reduce([self.buffer, MPI.FLOAT], [self.shared, MPI.FLOAT] if topo.is_leader else None, op=MPI.SUM, root=0)
+        nbytes = 0
+        if topo.is_leader:
+            topo.leader_comm.Allreduce(MPI.IN_PLACE, [self.shared, MPI.FLOAT], op=MPI.SUM)
+            self.shared /= self.size
+            nbytes = 2 * self.layout.nbytes * (topo.num_hosts - 1) / topo.num_hosts
+        topo.node_comm.Barrier()
+        self.layout.unpack(self.shared)
+        
+        elapsed = time() - start
+        self.exchanges += 1
+        self.last_bytes, self.last_time = nbytes, elapsed
+        self.total_bytes += nbytes
+        self.total_time += elapsed
+        return True
+
+exchange_modes = {'best': lambda comm, layers, threshold: WeightExchanger(comm, layers, threshold),
+                  'average': lambda comm, layers, threshold: WeightAverager(comm, layers)}
+
+class ExchangeModeException(Exception):
+    pass
+
+# Returns the exchanger for the given mode. If codec (a DeltaCodec spec) is
+# given, weight deltas are compressed; only averaging supports that. If
+# topology (a HostTopology) is given, the exchange goes through host leaders.
+def make_weight_exchanger(mode, comm, layers, threshold=1.05, codec='', topology=None):
+    if mode not in exchange_modes:
+        raise ExchangeModeException("Unknown exchange mode '%s'; expected one of %s" % (mode, ", ".join(sorted(exchange_modes))))
+    if codec and topology is not None:
+        raise ExchangeModeException("Exchange codecs and host topologies cannot be combined")
+    if codec:
+        if mode != 'average':
+            raise ExchangeModeException("Exchange codecs need the average exchange mode")
+        return CompressedWeightAverager(comm, layers, DeltaCodec(codec))
+    if topology is not None:
+        if mode == 'average':
+            return HierarchicalWeightAverager(topology, layers)
+        return HierarchicalWeightExchanger(topology, layers, threshold)
+    return exchange_modes[mode](comm, layers, threshold)
+
+# Returns a list of layer dicts shaped like a small convnet's, with random
+# weights drawn from rng. The second fc layer shares its weights with the first.
+def make_test_layers(rng, scale=1):
+    layers = []
+    for name, shape in (('conv1', (75, 64)), ('conv2', (1600, 64)), ('fc1', (64 * 64 * scale, 10))):
+        w = rng.randn(*shape).astype(n.single)
+        layers += [{'name': name,
+                    'weights': [w],
+                    'weightsInc': [n.zeros_like(w)],
+                    'biases': rng.randn(1, shape[1]).astype(n.single),
+                    'biasesInc': n.zeros((1, shape[1]), dtype=n.single)}]
+    layers += [{'name': 'fc2', 'weights': layers[-1]['weights'], 'weightsInc': layers[-1]['weightsInc'],
+                'biases': rng.randn(1, 10).astype(n.single), 'biasesInc': n.zeros((1, 10), dtype=n.single)}]
+    layers += [{'name': 'softmax'}]
+    return layers
+
+def layers_equal(layers1, layers2):
+    return all(WeightLayout(layers1).pack() == WeightLayout(layers2).pack())
+
+class StandInModel:
+    """Trains the fully-connected layers of a list of test layers on random data
+    with numpy, as a CPU-only stand-in for the GPU model in scaling benchmarks."""
+    def __init__(self, layers, minibatch_size, rng, eps=1e-4, mom=0.9):
+        self.layers = [l for l in layers if 'weights' in l]
+        self.inputs = [[rng.randn(w.shape[0], minibatch_size).astype(n.single) for w in l['weights']] for l in self.layers]
+        self.minibatch_size = minibatch_size
+        self.rng = rng
+        self.eps, self.mom = eps, mom
+        
+    def train_batch(self):
+        for l, inputs in zip(self.layers, self.inputs):
+            for w, inc, x in zip(l['weights'], l['weightsInc'], inputs):
+                grad = n.dot(x, n.dot(w.T, x).T) / self.minibatch_size
+                inc *= self.mom
+                inc -= self.eps * grad
+                w += inc
+        return 1.0 + self.rng.rand()
+
+# Trains a StandInModel for the given number of batches, exchanging weights
+# every exchange_freq batches, and prints the throughput from rank 0.
+# With fake_hosts > 0 the exchange goes through the leaders of that many pretend hosts.
+def scaling_benchmark(comm, mode, batches=40, exchange_freq=1, fake_hosts=0, minibatch_size=128, scale=16):
+    rank = comm.Get_rank()
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    model = StandInModel(layers, minibatch_size, n.random.RandomState(rank))
+    ex = make_weight_exchanger(mode, comm, layers, topology=HostTopology(comm, fake_hosts) if fake_hosts > 0 else None)
+    model.train_batch()
+    comm.Barrier()
+    
+    start = time()
+    compute_time = 0.0
+    for b in xrange(1, batches + 1):
+        batch_start = time()
+        cost = model.train_batch()
+        compute_time += time() - batch_start
+        if b % exchange_freq == 0:
+            ex.exchange(cost)
+    comm.Barrier()
+    elapsed = time() - start
+    if rank == 0:
+        print "ranks %d images/sec %.1f compute %.3f exchange %.3f MB/exchange %.2f" % (
+            comm.Get_size(), comm.Get_size() * batches * minibatch_size / elapsed, compute_time, ex.total_time,
+            ex.total_bytes / 2.0**20 / max(1, ex.exchanges))
+
+# Trains softmax regression on dummy-cn-n batches on every rank of comm,
+# averaging the weights every exchange_freq batches through codec. Every rank
+# starts from the same weights and draws its own data. Returns the training
+# costs, the final weights and the exchanger.
+def train_dummy_softmax(comm, codec, batches, exchange_freq, data_dim=256, num_classes=10, eps=0.01, mom=0.9):
+    from data import DummyConvNetDataProvider
+    n.random.seed(comm.Get_rank()) # the dummy provider draws from numpy's global generator
+    dp = DummyConvNetDataProvider(data_dim)
+    w = (n.random.RandomState(0).randn(data_dim, num_classes) * 0.01).astype(n.single)
+    b = n.zeros((num_classes, 1), dtype=n.single)
+    layers = [{'name': 'fc', 'weights': [w], 'weightsInc': [n.zeros_like(w)], 'biases': b, 'biasesInc': n.zeros_like(b)}]
+    ex = make_weight_exchanger('average', comm, layers, codec=codec)
+    
+    costs = []
+    for i in xrange(1, batches + 1):
+        epoch, batchnum, (data, labels) = dp.get_next_batch()
+        labels = labels.reshape(-1).astype(n.int32)
+        z = n.dot(w.T, data) + b
+        p = n.exp(z - z.max(axis=0))
+        p /= p.sum(axis=0)
+        costs += [-n.mean(n.log(p[labels, n.arange(labels.size)]))]
+        p[labels, n.arange(labels.size)] -= 1
+        p /= labels.size
+        for param, inc, grad in ((w, layers[0]['weightsInc'][0], n.dot(data, p.T)), (b, layers[0]['biasesInc'], p.sum(axis=1).reshape(b.shape))):
+            inc *= mom
+            inc -= eps * grad
+            param += inc
+        if i % exchange_freq == 0:
+            ex.exchange(costs[-1])
+    return costs, WeightLayout(layers).pack(), ex
+
+# Compares training with codec against training with uncompressed averaging
+# and prints the result from rank 0.
+def codec_regression(comm, codec, batches=200, exchange_freq=5):
+    exact_costs, exact_weights, ex = train_dummy_softmax(comm, '', batches, exchange_freq)
+    costs, weights, ex = train_dummy_softmax(comm, codec, batches, exchange_freq)
+    if comm.Get_rank() == 0:
+        tail = max(1, batches / 10)
+        print "codec %s cost %.5f exact_cost %.5f divergence %.5f ratio %.1f encode_ms %.3f decode_ms %.3f" % (
+            codec, n.mean(costs[-tail:]), n.mean(exact_costs[-tail:]),
+            n.linalg.norm(weights - exact_weights) / n.linalg.norm(exact_weights),
+            ex.last_ratio, 1000 * ex.last_encode_time, 1000 * ex.last_decode_time)
+
+def self_test(comm, iterations=10, scale=64):
+    rank, size = comm.Get_rank(), comm.Get_size()
+    if size < 2:
+        print "the exchange self-test needs at least 2 ranks"
+        return
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    ex = WeightExchanger(comm, layers)
+    assert ex.layout.size == sum(a.size for a in ex.layout.arrays)
+
+    # the rank with the lowest cost is 0, every other rank is well behind it
+    changed = ex.exchange(1.0 + rank)
+    assert changed == (rank != 0)
+    assert layers_equal(layers, make_test_layers(n.random.RandomState(0), scale))
+    assert layers[3]['weights'][0] is layers[2]['weights'][0]
+    
+    # ranks within the threshold of the best keep their own weights, and nothing is sent
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    ex = WeightExchanger(comm, layers)
+    prepared = []
+    assert not ex.exchange(1.0 + rank * 0.01, prepare_send=lambda: prepared.append(rank))
+    assert layers_equal(layers, make_test_layers(n.random.RandomState(rank), scale))
+    assert ex.last_bytes == 0 and not prepared
+    
+    # a single receiver gets the weights point to point; the others are left alone
+    assert ex.exchange(2.0 if rank == size - 1 else 1.0 + rank * 0.01, prepare_send=lambda: prepared.append(rank)) == (rank == size - 1)
+    assert layers_equal(layers, make_test_layers(n.random.RandomState(0 if rank == size - 1 else rank), scale))
+    assert prepared == ([0] if rank == 0 else [])
+    
+    # several receivers share a broadcast; rank 1 is the best and rank 0 sits it out
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    ex = WeightExchanger(comm, layers, threshold=1.5)
+    assert ex.exchange({0: 1.2, 1: 1.0}.get(rank, 3.0)) == (rank > 1)
+    assert layers_equal(layers, make_test_layers(n.random.RandomState(1 if rank > 1 else rank), scale))
+
+    # averaging leaves every rank with the mean of all of them
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    assert make_weight_exchanger('average', comm, layers).exchange(1.0)
+    mean = sum(WeightLayout(make_test_layers(n.random.RandomState(r), scale)).pack().astype(n.float64) for r in xrange(size)) / size
+    assert n.allclose(WeightLayout(layers).pack(), mean, atol=1e-5)
+
+    # async best-peer exchange: weights arrive by the staleness-th batch boundary
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    ex = AsyncWeightExchanger(comm, layers, 'best', staleness=2)
+    ex.start(1.0 + rank)
+    applied = ex.progress() or ex.progress()
+    assert not ex.is_busy() and applied == (rank != 0)
+    assert layers_equal(layers, make_test_layers(n.random.RandomState(0), scale))
+    
+    # async averaging keeps the local progress made while the exchange was in flight
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    ex = AsyncWeightExchanger(comm, layers, 'average', staleness=3)
+    ex.start(1.0)
+    for l in layers[:3]:
+        l['biases'] += 1
+    while ex.is_busy():
+        ex.progress()
+    expected = make_test_layers(n.random.RandomState(0), scale)
+    WeightLayout(expected).unpack(mean)
+    for l in expected[:3]:
+        l['biases'] += 1
+    assert n.allclose(WeightLayout(layers).pack(), WeightLayout(expected).pack(), atol=1e-5)
+
+    # codecs round-trip, and compressed averaging gives every rank the same weights
+    delta = n.random.RandomState(rank).randn(10000).astype(n.single)
+    assert (DeltaCodec('zlib').decode(DeltaCodec('zlib').encode(delta), delta.size) == delta).all()
+    assert n.allclose(DeltaCodec('fp16,zlib:6').decode(DeltaCodec('fp16,zlib:6').encode(delta), delta.size), delta, rtol=1e-3, atol=1e-3)
+    decoded = DeltaCodec('topk:0.1').decode(DeltaCodec('topk:0.1').encode(delta), delta.size)
+    assert (decoded != 0).sum() == 1000 and n.abs(decoded).min() == 0 and n.abs(delta[decoded != 0]).min() >= n.abs(delta[decoded == 0]).max()
+    for codec in ('zlib', 'fp16', 'topk:0.05,zlib'):
+        layers = make_test_layers(n.random.RandomState(rank), scale)
+        ex = make_weight_exchanger('average', comm, layers, codec=codec)
+        for i in xrange(3):
+            ex.exchange(1.0)
+            for l in layers[:3]:
+                l['weights'][0] += n.random.RandomState(rank + i).randn(*l['weights'][0].shape).astype(n.single) * 0.01
+        ex.exchange(1.0)
+        assert n.allclose(comm.bcast(WeightLayout(layers).pack(), root=0), WeightLayout(layers).pack())
+
+    # through host leaders, with the ranks split over two pretend hosts
+    topology = HostTopology(comm, fake_hosts=2)
+    assert topology.num_hosts == min(2, size) and topology.host_of[rank] == rank // -(-size // 2)
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    ex = make_weight_exchanger('best', comm, layers, topology=topology)
+    assert ex.exchange(1.0 if rank == size - 1 else 2.0) == (rank != size - 1)
+    assert layers_equal(layers, make_test_layers(n.random.RandomState(size - 1), scale))
+    layers = make_test_layers(n.random.RandomState(rank), scale)
+    assert make_weight_exchanger('average', comm, layers, topology=topology).exchange(1.0)
+    assert n.allclose(WeightLayout(layers).pack(), mean, atol=1e-5)
+
+    ex = WeightExchanger(comm, layers)
+    for i in xrange(iterations):
+        ex.exchange(1.0 + (rank + i) % size)
+    if rank == 0:
+        print "%d ranks, %.1f MB of weights: %.3f ms and %.1f MB per exchange on rank 0" % (
+            size, ex.layout.nbytes / 2.0**20, 1000 * ex.total_time / ex.exchanges, ex.total_bytes / 2.0**20 / ex.exchanges)
+    comm.Barrier()
+    if rank == 0:
+        print "exchange self-test passed"
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['benchmark']:
+        mode, batches, exchange_freq = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+        fake_hosts = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+        scaling_benchmark(MPI.COMM_WORLD, mode, batches, exchange_freq, fake_hosts)
+    elif sys.argv[1:2] == ['regression']:
+        codec, batches, exchange_freq = sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+        codec_regression(MPI.COMM_WORLD, codec, batches, exchange_freq)
+    else:
+        self_test(MPI.COMM_WORLD)
@@ -29,6 +29,7 @@
 
 #include <vector>
 #include <string>
+#include <map>
 #include <cutil_inline.h>
 #include <time.h>
 #include <queue.h>
@@ -51,6 +52,7 @@ protected:
     std::vector<Layer*> _layers;
     std::vector<DataLayer*> _dataLayers;
     std::vector<CostLayer*> _costs;
+    std::map<int, NVMatrix*> _buffers; // Activity and gradient matrices pooled between layers, see LayerParser.plan_buffers
     GPUData* _data;
 
     DataProvider* _dp;
@@ -58,6 +58,9 @@ protected:
     bool _conserveMem;
     int _numGradProducersNext;
     int _actsTarget, _actsGradTarget;
+    // Indices of the pooled matrices holding my activities and activity gradients, or -1
+    int _actsBuffer, _actsGradBuffer;
+    bool _pooledActs;
     std::string _name, _type;
 
     void fpropNext(PASS_TYPE passType);
@@ -92,7 +95,8 @@ public:
     std::vector<Layer*>& getNext();
     virtual NVMatrix& getActs();
     virtual NVMatrix& getActsGrad();
-    virtual void postInit();
+    bool hasPooledActs();
+    virtual void postInit(std::map<int, NVMatrix*>& buffers);
     
     // Do nothing if this layer has no weights
     virtual void updateWeights() {
@@ -29,9 +29,15 @@ import os
 import numpy as n
 import numpy.random as nr
 from math import ceil, floor
-from ordereddict import OrderedDict
+try:
+    from collections import OrderedDict
+except ImportError: # Python < 2.7
+    from ordereddict import OrderedDict
 from os import linesep as NL
-from options import OptionsParser
+from options import OptionsParser, BooleanOptionParser, StringOptionParser, IntegerOptionParser
+from util import pickle, unpickle
+import hashlib
+import weightinit
 import re
 
 class LayerParsingError(Exception):
@@ -62,9 +68,10 @@ class ParamNeuronParser(NeuronParser):
         self.base_type = m.group(1)
         self.param_names = m.group(2).split(',')
         assert len(set(self.param_names)) == len(self.param_names)
+        self.param_regex = re.compile(r'^%s\s*\[([\d,\.\s\-e]*)\]\s*$' % self.base_type)
         
     def parse(self, type):
-        m = re.match(r'^%s\s*\[([\d,\.\s\-e]*)\]\s*$' % self.base_type, type)
+        m = self.param_regex.match(type)
         if m:
             try:
                 param_vals = [float(v.strip()) for v in m.group(1).split(',')]
@@ -250,6 +257,10 @@ class LayerParser:
                 raise LayerParsingError("Layer definition file '%s' does not exist" % layer_cfg_path)
             if not os.path.exists(param_cfg_path):
                 raise LayerParsingError("Layer parameter file '%s' does not exist" % param_cfg_path)
+            cache_path = LayerParser.get_cache_path(layer_cfg_path, param_cfg_path, model) if len(layers) == 0 else None
+            cached_layers = LayerParser.load_cached_layers(cache_path, model)
+            if cached_layers is not None:
+                return cached_layers
             if len(layers) == 0:
                 mcp = MyConfigParser(dict_type=OrderedDict)
                 mcp.read([layer_cfg_path])
@@ -267,11 +278,10 @@ class LayerParser:
                     l['parser'].optimize(layers)
                     del l['parser']
                     
-                for l in layers:
-                    if not l['type'].startswith('cost.'):
-                        found = max(l['name'] in [layers[n]['name'] for n in l2['inputs']] for l2 in layers if 'inputs' in l2)
-                        if not found:
-                            raise LayerParsingError("Layer '%s' of type '%s' is unused" % (l['name'], l['type']))
+                used = set(inp for l in layers for inp in l.get('inputs', []))
+                for i, l in enumerate(layers):
+                    if not l['type'].startswith('cost.') and i not in used:
+                        raise LayerParsingError("Layer '%s' of type '%s' is unused" % (l['name'], l['type']))
             
             mcp = MyConfigParser(dict_type=OrderedDict)
             mcp.read([param_cfg_path])
@@ -282,17 +292,220 @@ class LayerParser:
                 lp = layer_parsers[l['type']]().init(l)
                 lp.add_params(mcp)
                 lp.dic['conserveMem'] = model.op.get_value('conserve_mem')
+                l['actsBuffer'] = l['actsGradBuffer'] = -1
+            # The plan depends on which layers learn, so it is redone whenever the parameters are read.
+            if model.op.get_value('plan_buffers'):
+                LayerParser.plan_buffers(layers)
+            if cache_path is not None:
+                LayerParser.save_cached_layers(cache_path, layers)
         except LayerParsingError, e:
             print e
             sys.exit(1)
         return layers
-        
+
+    # With --layer-cache, parse_layers keeps the layers it parses, minus their
+    # weights, in a file named after a hash of everything the parse depends on:
+    # the two files, the options below and the source of this module.
+    @staticmethod
+    def get_cache_path(layer_cfg_path, param_cfg_path, model):
+        cache_dir = model.op.get_value('layer_cache')
+        if not cache_dir:
+            return None
+        h = hashlib.sha1()
+        for path in (layer_cfg_path, param_cfg_path, os.path.splitext(__file__)[0] + '.py'):
+            f = open(path, 'rb')
+            h.update(f.read())
+            f.close()
+        for name in LAYER_CACHE_OPTIONS:
+            h.update('%s=%r;' % (name, model.op.get_value(name)))
+        return os.path.join(cache_dir, 'layers-%s.pickle' % h.hexdigest())
+
+    # Returns the cached layers in cache_path with freshly initialized weights,
+    # or None if there are none that fit the model's data.
+    @staticmethod
+    def load_cached_layers(cache_path, model):
+        if cache_path is None or not os.path.exists(cache_path):
+            return None
+        try:
+            layers = unpickle(cache_path)
+        except Exception, e:
+            print "Ignoring unreadable layer cache %s: %s" % (cache_path, e)
+            return None
+        dp = model.train_data_provider
+        for l in layers:
+            if l['type'] == 'data' and l['outputs'] != dp.get_data_dims(idx=l['dataIdx']):
+                return None
+            if l['type'] == 'cost.logreg' and l['numInputs'][1] != dp.get_num_classes():
+                return None
+        for i, l in enumerate(layers):
+            lp = layer_parsers[l['type']]().init(l)
+            if isinstance(lp, WeightLayerParser):
+                lp.prev_layers = layers[:i]
+                lp.init_workers = model.op.get_value('init_workers')
+                lp.init_weights()
+        print "Loaded layer definitions from %s" % cache_path
+        return layers
+
+    @staticmethod
+    def save_cached_layers(cache_path, layers):
+        copies = OrderedDict((id(l), dict((k, v) for k, v in l.iteritems() if k not in WEIGHT_KEYS)) for l in layers)
+        # inputLayers refers to the input layers themselves, weights and all.
+        for l in copies.itervalues():
+            if 'inputLayers' in l:
+                l['inputLayers'] = [copies[id(inp)] for inp in l['inputLayers']]
+        layers = copies.values()
+        # Write to a temporary file first, so that concurrent runs never see a partial cache file.
+        tmp_path = '%s.%d' % (cache_path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            pickle(tmp_path, layers)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError), e:
+            print "Unable to write layer cache %s: %s" % (cache_path, e)
+        
+    # Does this layer, or some layer below it, learn anything? Such layers receive gradients.
+    @staticmethod
+    def get_grad_consumers(layers):
+        consumers = []
+        for l in layers:
+            consumers += [l['gradConsumer'] or any(consumers[i] for i in l.get('inputs', []))]
+        return consumers
+
+    # Returns the orders in which the CUDA ConvNet runs fprop and bprop on the
+    # layers. fprop walks up from the data layers depth-first, running a layer
+    # once all of its inputs have run. bprop walks down from the cost layers,
+    # running a layer once every layer above it that produces a gradient has run.
+    @staticmethod
+    def get_pass_order(layers):
+        next_layers = [[] for l in layers]
+        for i, l in enumerate(layers):
+            for inp in l.get('inputs', []):
+                next_layers[inp] += [i]
+        consumers = LayerParser.get_grad_consumers(layers)
+        producers = [l['type'] != 'data' and l.get('coeff', 1) != 0 for l in layers]
+        fprop_order, bprop_order = [], []
+        rcvd_f, rcvd_b = [0] * len(layers), [0] * len(layers)
+        def fprop(i):
+            fprop_order.append(i)
+            for nxt in next_layers[i]:
+                rcvd_f[nxt] += 1
+                if rcvd_f[nxt] == len(layers[nxt]['inputs']):
+                    fprop(nxt)
+        def bprop(i):
+            if rcvd_b[i] != sum(producers[nxt] for nxt in next_layers[i]):
+                return
+            rcvd_b[i] += 1
+            bprop_order.append(i)
+            below = [inp for inp in layers[i].get('inputs', []) if producers[i] and consumers[inp]]
+            for inp in below:
+                rcvd_b[inp] += 1
+            for inp in below:
+                bprop(inp)
+        for i, l in enumerate(layers):
+            if l['type'] == 'data':
+                fprop(i)
+        for i, l in enumerate(layers):
+            if l['type'].startswith('cost.') and producers[i]:
+                bprop(i)
+        return fprop_order, bprop_order
+
+    # Assigns the activity and activity gradient matrices of the layers to a
+    # pool of matrices, like a register allocator. A matrix is live from the
+    # pass that first writes it to the pass that last reads it, in the order of
+    # get_pass_order, and matrices that are never live at the same time share
+    # a pool matrix, which grows to the largest of them. The pool indices go in
+    # actsBuffer and actsGradBuffer; -1 means that the layer owns its matrix or
+    # borrows an input's through actsTarget/actsGradTarget.
+    #
+    # Data layers, cost layers and the inputs of cost layers keep their own
+    # matrices, since they are read between passes. The activities of other
+    # layers are not, which is why shownet.py drops the plan to write features.
+    @staticmethod
+    def plan_buffers(layers):
+        fprop_order, bprop_order = LayerParser.get_pass_order(layers)
+        fprop_time = dict((i, t) for t, i in enumerate(fprop_order))
+        bprop_time = dict((i, len(fprop_order) + t) for t, i in enumerate(bprop_order))
+        consumers = LayerParser.get_grad_consumers(layers)
+        next_layers = [[] for l in layers]
+        for i, l in enumerate(layers):
+            for inp in l.get('inputs', []):
+                next_layers[inp] += [i]
+        costs = [i for i, l in enumerate(layers) if l['type'].startswith('cost.')]
+        pinned = set(i for i, l in enumerate(layers) if l['type'] == 'data') | set(costs)
+        pinned |= set(inp for i in costs for inp in layers[i]['inputs'])
+
+        # The matrix of every layer is that of the layer it borrows from, if any.
+        # ranges: matrix --> [first write, last read, largest outputs]
+        acts, grads, ranges = [], [], OrderedDict()
+        def extend(matrix, times, outputs):
+            r = ranges.setdefault(matrix, [min(times), max(times), outputs])
+            r[0], r[1], r[2] = min([r[0]] + times), max([r[1]] + times), max(r[2], outputs)
+        for i, l in enumerate(layers):
+            acts += [acts[l['inputs'][l['actsTarget']]] if l['actsTarget'] >= 0 else ('acts', i)]
+            grads += [grads[l['inputs'][l['actsGradTarget']]] if l['actsGradTarget'] >= 0 else ('grad', i)]
+            if i in fprop_time:
+                times = [fprop_time[i]] + [fprop_time[nxt] for nxt in next_layers[i]]
+                times += [bprop_time[i]] if l['usesActs'] and i in bprop_time else []
+                times += [bprop_time[nxt] for nxt in next_layers[i] if layers[nxt]['usesInputs'] and nxt in bprop_time]
+                extend(acts[i], times, l['outputs'])
+            if consumers[i] and i in bprop_time:
+                extend(grads[i], [bprop_time[nxt] for nxt in next_layers[i] if nxt in bprop_time] + [bprop_time[i]], l['outputs'])
+        for matrix in set(acts[i] for i in pinned) | set(grads[i] for i in costs):
+            ranges.pop(matrix, None)
+
+        # Linear scan: every matrix takes the free pool matrix closest in size.
+        # A matrix read in a pass cannot be reused for a matrix written in the same pass.
+        pool, free, assignment = [], [], {}
+        for matrix, (start, end, outputs) in sorted(ranges.items(), key=lambda (m, r): r[0]):
+            reusable = [b for b in free if pool[b][0] < start]
+            if reusable:
+                fits = [b for b in reusable if pool[b][1] >= outputs]
+                b = min(fits, key=lambda b: pool[b][1]) if fits else max(reusable, key=lambda b: pool[b][1])
+                free.remove(b)
+            else:
+                b = len(pool)
+                pool += [None]
+            pool[b] = (end, max(outputs, pool[b][1] if pool[b] else 0))
+            free += [b]
+            assignment[matrix] = b
+        for i, l in enumerate(layers):
+            l['actsBuffer'] = assignment.get(acts[i], -1) if acts[i] == ('acts', i) else -1
+            l['actsGradBuffer'] = assignment.get(grads[i], -1) if grads[i] == ('grad', i) else -1
+        return len(pool)
+
     @staticmethod
     def register_layer_parser(ltype, cls):
         if ltype in layer_parsers:
             raise LayerParsingError("Layer type '%s' already registered" % ltype)
         layer_parsers[ltype] = cls
 
+class StandInDataProvider:
+    def __init__(self, data_dims, num_classes):
+        self.data_dims, self.num_classes = data_dims, num_classes
+    
+    def get_data_dims(self, idx=0):
+        return self.data_dims if idx == 0 else 1
+    
+    def get_num_classes(self):
+        return self.num_classes
+
+# Just enough of a ConvNetRunner for LayerParser to build a model's layers, for
+# tools that parse a layer definition without training it. It has the options
+# the parsers read, at their defaults.
+class StandInRunner:
+    def __init__(self, data_dims, num_classes):
+        self.op = OptionsParser()
+        self.op.add_option("conserve-mem", "conserve_mem", BooleanOptionParser, "Conserve GPU memory", default=0)
+        self.op.set_value('conserve_mem', 0, parse=False)
+        self.op.add_option("plan-buffers", "plan_buffers", BooleanOptionParser, "Share activity matrices", default=0)
+        self.op.set_value('plan_buffers', 0, parse=False)
+        self.op.add_option("layer-cache", "layer_cache", StringOptionParser, "Layer cache directory", default="")
+        self.op.set_value('layer_cache', "", parse=False)
+        self.op.add_option("init-workers", "init_workers", IntegerOptionParser, "Weight initialization threads", default=0)
+        self.op.set_value('init_workers', 0, parse=False)
+        self.train_data_provider = StandInDataProvider(data_dims, num_classes)
+
 # Any layer that takes an input (i.e. non-data layer)
 class LayerWithInputParser(LayerParser):
     def __init__(self, num_inputs=-1):
@@ -630,6 +843,8 @@ class WeightLayerParser(LayerWithInputParser):
     
     def __init__(self):
         LayerWithInputParser.__init__(self)
+        # Threads drawing the initial weights, 0 meaning one per core
+        self.init_workers = 0
     
     @staticmethod
     def get_layer_name(name_str):
@@ -682,8 +897,9 @@ class WeightLayerParser(LayerWithInputParser):
         except (ImportError, AttributeError, TypeError), e:
             raise LayerParsingError("Layer '%s': %s." % (dic['name'], e))
         
-    def make_weights(self, initW, rows, cols, order='C'):
+    def make_weights(self, initW, rows, cols, order='C', fan_in=None):
         dic = self.dic
+        fan_in = fan_in or rows
         dic['weights'], dic['weightsInc'] = [], []
         if dic['initWFunc']: # Initialize weights from user-supplied python function
             # Initialization function is supplied in the format
@@ -712,7 +928,8 @@ class WeightLayerParser(LayerWithInputParser):
                                                 % (dic['name'], dic['weightSource'][i], dic['weights'][i].shape[0], dic['weights'][i].shape[1], rows[i], cols[i]))
                     print "Layer '%s' initialized weight matrix %d from %s" % (dic['name'], i, dic['weightSource'][i])
                 else:
-                    dic['weights'] += [n.array(initW[i] * nr.randn(rows[i], cols[i]), dtype=n.single, order=order)]
+                    dic['weights'] += [weightinit.make_weights(dic['initWDist'][i], initW[i], (rows[i], cols[i]), order=order,
+                                                               fan_in=fan_in[i], workers=self.init_workers)]
                     dic['weightsInc'] += [n.zeros_like(dic['weights'][i])]
         
     def make_biases(self, rows, cols, order='C'):
@@ -740,10 +957,14 @@ class WeightLayerParser(LayerWithInputParser):
         dic['initB'] = mcp.safe_get_float(name, 'initB', default=0)
         dic['initWFunc'] = mcp.safe_get(name, 'initWFunc', default="")
         dic['initBFunc'] = mcp.safe_get(name, 'initBFunc', default="")
+        dic['initWDist'] = mcp.safe_get_list(name, 'initWDist', default=['gauss'] * len(dic['inputs']))
+        self.init_workers = model.op.get_value('init_workers')
         # Find shared weight matrices
         
         dic['weightSource'] = mcp.safe_get_list(name, 'weightSource', default=[''] * len(dic['inputs']))
-        self.verify_num_params(['initW', 'weightSource'])
+        self.verify_num_params(['initW', 'initWDist', 'weightSource'])
+        for dist in dic['initWDist']:
+            self.verify_str_in(dist, weightinit.init_dists.keys())
         
         prev_names = map(lambda x: x['name'], prev_layers)
         dic['weightSourceLayerIndices'] = []
@@ -785,11 +1006,15 @@ class FCLayerParser(WeightLayerParser):
         dic['outputs'] = mcp.safe_get_int(name, 'outputs')
         
         self.verify_num_range(dic['outputs'], 'outputs', 1, None)
-        self.make_weights(dic['initW'], dic['numInputs'], [dic['outputs']] * len(dic['numInputs']), order='F')
-        self.make_biases(1, dic['outputs'], order='F')
+        self.init_weights()
         print "Initialized fully-connected layer '%s', producing %d outputs" % (name, dic['outputs'])
         return dic
 
+    def init_weights(self):
+        dic = self.dic
+        self.make_weights(dic['initW'], dic['numInputs'], [dic['outputs']] * len(dic['numInputs']), order='F')
+        self.make_biases(1, dic['outputs'], order='F')
+
 class LocalLayerParser(WeightLayerParser):
     def __init__(self):
         WeightLayerParser.__init__(self)
@@ -911,7 +1136,6 @@ class LocalLayerParser(WeightLayerParser):
                 self.verify_divisible(dic['channels'][i], dic['filterChannels'][i], 'channels', 'filterChannels', input_idx=i)
                 self.verify_divisible(dic['filterChannels'][i], 4, 'filterChannels', input_idx=i)
                 self.verify_divisible( dic['groups'][i]*dic['filterChannels'][i], dic['channels'][i], 'groups * filterChannels', 'channels', input_idx=i)
-                dic['filterConns'][i] = self.gen_rand_conns(dic['groups'][i], dic['channels'][i], dic['filterChannels'][i], i)
             else:
                 if dic['groups'][i] > 1:
                     self.verify_divisible(dic['channels'][i], 4*dic['groups'][i], 'channels', '4 * groups', input_idx=i)
@@ -924,6 +1148,13 @@ class LocalLayerParser(WeightLayerParser):
 
         return dic    
 
+    # The random connectivity of sparse layers is initialized along with their weights.
+    def make_conns(self):
+        dic = self.dic
+        for i in xrange(len(dic['inputs'])):
+            if dic['randSparse'][i]:
+                dic['filterConns'][i] = self.gen_rand_conns(dic['groups'][i], dic['channels'][i], dic['filterChannels'][i], i)
+
 class ConvLayerParser(LocalLayerParser):
     def __init__(self):
         LocalLayerParser.__init__(self)
@@ -937,14 +1168,19 @@ class ConvLayerParser(LocalLayerParser):
         if dic['partialSum'] != 0 and dic['modules'] % dic['partialSum'] != 0:
             raise LayerParsingError("Layer '%s': convolutional layer produces %dx%d=%d outputs per filter, but given partialSum parameter (%d) does not divide this number" % (name, dic['modulesX'], dic['modulesX'], dic['modules'], dic['partialSum']))
 
+        self.init_weights()
+
+        print "Initialized convolutional layer '%s', producing %dx%d %d-channel output" % (name, dic['modulesX'], dic['modulesX'], dic['filters'])
+        return dic    
+
+    def init_weights(self):
+        dic = self.dic
         num_biases = dic['filters'] if dic['sharedBiases'] else dic['modules']*dic['filters']
 
         eltmult = lambda list1, list2: [l1 * l2 for l1,l2 in zip(list1, list2)]
+        self.make_conns()
         self.make_weights(dic['initW'], eltmult(dic['filterPixels'], dic['filterChannels']), [dic['filters']] * len(dic['inputs']), order='C')
         self.make_biases(num_biases, 1, order='C')
-
-        print "Initialized convolutional layer '%s', producing %dx%d %d-channel output" % (name, dic['modulesX'], dic['modulesX'], dic['filters'])
-        return dic    
     
 class LocalUnsharedLayerParser(LocalLayerParser):
     def __init__(self):
@@ -952,14 +1188,19 @@ class LocalUnsharedLayerParser(LocalLayerParser):
         
     def parse(self, name, mcp, prev_layers, model):
         dic = LocalLayerParser.parse(self, name, mcp, prev_layers, model)
+        self.init_weights()
+        
+        print "Initialized locally-connected layer '%s', producing %dx%d %d-channel output" % (name, dic['modulesX'], dic['modulesX'], dic['filters'])
+        return dic  
 
+    def init_weights(self):
+        dic = self.dic
         eltmult = lambda list1, list2: [l1 * l2 for l1,l2 in zip(list1, list2)]
         scmult = lambda x, lst: [x * l for l in lst]
-        self.make_weights(dic['initW'], scmult(dic['modules'], eltmult(dic['filterPixels'], dic['filterChannels'])), [dic['filters']] * len(dic['inputs']), order='C')
+        self.make_conns()
+        self.make_weights(dic['initW'], scmult(dic['modules'], eltmult(dic['filterPixels'], dic['filterChannels'])), [dic['filters']] * len(dic['inputs']), order='C',
+                          fan_in=eltmult(dic['filterPixels'], dic['filterChannels']))
         self.make_biases(dic['modules'] * dic['filters'], 1, order='C')
-        
-        print "Initialized locally-connected layer '%s', producing %dx%d %d-channel output" % (name, dic['modulesX'], dic['modulesX'], dic['filters'])
-        return dic  
     
 class DataLayerParser(LayerParser):
     def __init__(self):
@@ -1106,6 +1347,11 @@ class SumOfSquaresCostParser(CostParser):
         print "Initialized sum-of-squares cost '%s'" % name
         return dic
 
+# The options that parse_layers reads, and so the layer cache is keyed on
+LAYER_CACHE_OPTIONS = ('conserve_mem', 'plan_buffers')
+# The random parameters of a layer, which the layer cache leaves out
+WEIGHT_KEYS = ('weights', 'weightsInc', 'biases', 'biasesInc')
+
 # All the layer parsers
 layer_parsers = {'data': lambda : DataLayerParser(),
                  'fc': lambda : FCLayerParser(),
@@ -22,11 +22,17 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
 # EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from checkpoint import *
+from codec import Codec, CodecException
 from data import *
 from options import *
 from os import linesep as NL
 from time import time, asctime, strftime, localtime
-import convnet
+try:
+    import convnet
+except ImportError: # not built; only the cpu backend is available
+    convnet = None
+import cpuconvnet
 import ctypes
 import layer as lay
 import math as m
@@ -37,6 +43,7 @@ import sys
 MPILIB = ctypes.CDLL('libmpi.so', ctypes.RTLD_GLOBAL)
 PALLIB = ctypes.CDLL('libopen-pal.so', ctypes.RTLD_GLOBAL)
 from mpi4py import MPI
+from exchange import *
 WORLD = MPI.COMM_WORLD
 
 class ModelStateException(Exception):
@@ -47,6 +54,16 @@ class ConvNetRunner(object):
         filename_options = []
         dp_params['multiview_test'] = op.get_value('multiview_test')
         dp_params['crop_border'] = op.get_value('crop_border')
+        dp_params['crop_seed'] = op.get_value('crop_seed')
+        dp_params['prefetch'] = op.get_value('prefetch')
+        dp_params['decode_workers'] = op.get_value('decode_workers')
+        dp_params['cache_mb'] = op.get_value('cache_mb')
+        dp_params['cache_dir'] = op.get_value('cache_dir')
+        # Batches are filled in recycled buffers: one on the GPU, one loading,
+        # two test batches and the prefetched ones. Buffers filled by prefetch
+        # processes come back as copies, so those cannot be recycled.
+        self.buffer_pool = BatchBufferPool(3 + op.get_value('prefetch')) if op.get_value('prefetch_pool') != 'process' else None
+        dp_params['buffer_pool'] = self.buffer_pool
 
         # these are input parameters
         self.model_name = 'ConvNet'
@@ -55,6 +72,8 @@ class ConvNetRunner(object):
         self.load_dic = load_dic
         self.filename_options = filename_options
         self.dp_params = dp_params
+        self.checkpoint_manifest = None
+        self.model_lib = self.get_model_lib(op.get_value('backend'))
         self.get_gpus()
         self.fill_excused_options()
 
@@ -62,6 +81,38 @@ class ConvNetRunner(object):
         
         for o in op.get_options_list():
             setattr(self, o.name, o.value)
+        if self.exchange_mode not in exchange_modes:
+            print "Unknown exchange mode '%s'; expected one of %s" % (self.exchange_mode, ", ".join(sorted(exchange_modes)))
+            sys.exit(1)
+        if self.exchange_codec:
+            try:
+                DeltaCodec(self.exchange_codec)
+            except ExchangeCodecException, e:
+                print e
+                sys.exit(1)
+            if self.exchange_mode != 'average' or self.exchange_staleness > 0:
+                print "--exchange-codec needs --exchange-mode=average and --exchange-staleness=0"
+                sys.exit(1)
+        if self.exchange_topology not in ('flat', 'host'):
+            print "Unknown exchange topology '%s'; expected flat or host" % self.exchange_topology
+            sys.exit(1)
+        if self.exchange_topology == 'host' and (self.exchange_codec or self.exchange_staleness > 0):
+            print "--exchange-topology=host cannot be combined with --exchange-codec or --exchange-staleness"
+            sys.exit(1)
+        # checkpoints from before codecs store --zip-save as a boolean
+        if not isinstance(self.zip_save, str):
+            self.zip_save = ZIP_CODEC if self.zip_save else ''
+        if self.zip_save and self.zip_save != ZIP_CODEC:
+            try:
+                Codec(self.zip_save)
+            except CodecException, e:
+                print e
+                sys.exit(1)
+        if self.full_save_freq > 1 and self.zip_save == ZIP_CODEC:
+            print "--full-save-freq needs uncompressed checkpoints or a --zip-save codec other than zip"
+            sys.exit(1)
+        self.checkpoint_writer = CheckpointWriter(self.full_save_freq)
+        self.retention_policy = RetentionPolicy(self.max_filesize_mb * 1024 * 1024, self.keep_last, self.keep_best, self.keep_every)
        
         n.random.shuffle(self.train_batch_range)
 
@@ -104,6 +155,9 @@ class ConvNetRunner(object):
             self.train_data_provider = DataProvider.get_instance(self.data_path, self.train_batch_range,
                                                                      self.model_state["epoch"], self.model_state["batchnum"],
                                                                      type=self.dp_type, dp_params=self.dp_params, test=False)
+            if self.prefetch > 0:
+                self.train_data_provider = PrefetchingDataProvider(self.train_data_provider, depth=self.prefetch,
+                                                                   workers=self.prefetch_workers, pool_type=self.prefetch_pool)
         except DataProviderException, e:
             print "Unable to create data provider: %s" % e
             self._providers()
@@ -113,6 +167,7 @@ class ConvNetRunner(object):
         if self.test_only:
             self.test_outputs += [self.get_test_error()]
             self.print_test_results()
+            self.stop_model()
             sys.exit(1)
         self.train()
     
@@ -122,7 +177,10 @@ class ConvNetRunner(object):
         self.op.print_values()
         print "========================="
         self.print_model_state()
-        print "Running on CUDA device(s) %s" % ", ".join("%d" % d for d in self.device_ids)
+        if self.backend == 'gpu':
+            print "Running on CUDA device(s) %s" % ", ".join("%d" % d for d in self.device_ids)
+        else:
+            print "Running on the CPU"
         print "Current time: %s" % asctime(localtime())
         print "Saving checkpoints to %s" % os.path.join(self.save_path, self.save_file)
         print "========================="
@@ -141,6 +199,7 @@ class ConvNetRunner(object):
             next_data = self.get_next_batch()
             
             costmap, num_cases = self.finish_batch()
+            self.release_batch(batch_data)
             self.train_outputs += [(costmap, num_cases)]
             self.print_train_results()
 
@@ -152,11 +211,15 @@ class ConvNetRunner(object):
                 self.conditional_save()
             
             self.print_train_time(time() - compute_time_py)
+            if next_data[0] != self.epoch:
+                self.print_epoch_stats()
             
             if self.get_num_batches_done() % self.exchange_freq == 0:
                 running_avg = n.mean(
                     [cm['logprob'][1] for (cm, num_cases) in self.train_outputs[-self.exchange_freq:]])
                 self.exchange_weights(running_avg)
+            elif self.exchange_staleness > 0:
+                self.weight_exchanger.progress()
 
         self.cleanup()
     
@@ -164,10 +227,23 @@ class ConvNetRunner(object):
         pass
     
     def cleanup(self):
+        if self.exchange_staleness > 0:
+            self.weight_exchanger.finish()
+        self.checkpoint_writer.wait()
+        self.stop_model()
         sys.exit(0)
     
+    # The gpu backend's thread lives in the compiled module and ends with the
+    # process; the cpu backend's is a Python thread that has to be stopped first.
+    def stop_model(self):
+        if self.backend == 'cpu':
+            self.model.stop()
+    
     def sync_with_host(self):
-        assert self.run_worker(convnet.SyncWorker) == convnet.WorkResult.SYNC_DONE
+        assert self.run_worker(self.model_lib.SyncWorker) == self.model_lib.WorkResult.SYNC_DONE
+    
+    def copy_to_gpu(self):
+        assert self.run_worker(self.model_lib.CopyToGPUWorker) == self.model_lib.WorkResult.SYNC_DONE
             
     def get_num_batches_done(self):
         return len(self.train_batch_range) * (self.epoch - 1) + self.batchnum - self.train_batch_range[0] + 1
@@ -185,43 +261,38 @@ class ConvNetRunner(object):
         cost = result.getResults()
         return cost.getCostMap(), cost.getNumCases()
       
+    # Recycles the buffers of a batch whose TrainingWorker has finished with them.
+    def release_batch(self, batch_data):
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(*batch_data)
+      
     def exchange_weights(self, my_cost):
-        start = time()
-        peer_costs = WORLD.allgather(my_cost)
-        sync_costs = time()
-
-        peer_costs = sorted(enumerate(peer_costs), key=lambda t: t[1])
-        best_peer, best_cost = peer_costs[0]
-        def copy_array_with_jitter(src, dst):
-            dst[:] = src
-            #total_weight = n.sum(n.abs(src))
-            #dst[:] = src + (n.random.random(dst.shape) * 1e-2 / total_weight)
-        
-        # if i'm the best peer, share my weights with everyone else
-        new_layers = WORLD.bcast(self.model_state['layers'], root=best_peer)
+        if self.exchange_staleness > 0:
+            self.weight_exchanger.start(my_cost)
+            return
         
-        print >>sys.stderr, 'Peers: ', peer_costs
-        print >>sys.stderr, 'Best: ', best_peer, best_cost, '; Local: ', WORLD.Get_rank(), my_cost
-
-        # if our peer isn't significantly better then us, keep going with our own weights
-        if my_cost / best_cost < 1.05:
-            print >>sys.stderr, 'Keeping local weights.'
+        # the sender's host copies of the weights are only up to date after a sync
+        start = time()
+        changed = self.weight_exchanger.exchange(my_cost, prepare_send=self.sync_with_host)
+        ex = self.weight_exchanger
+        print >>sys.stderr, 'Peers: ', sorted(enumerate(ex.costs), key=lambda t: t[1])
+        print >>sys.stderr, 'Best: ', ex.best_rank, ex.costs[ex.best_rank], '; Local: ', WORLD.Get_rank(), my_cost
+        if self.exchange_codec:
+            print >>sys.stderr, 'Averaged weight deltas over %d peers with %s: ratio %.1fx, encode %f decode %f' % (
+                WORLD.Get_size(), self.exchange_codec, ex.last_ratio, ex.last_encode_time, ex.last_decode_time)
+        elif self.exchange_mode == 'average':
+            print >>sys.stderr, 'Averaged weights over %d peers' % WORLD.Get_size()
+        elif changed:
+            print >>sys.stderr, 'Fetched weights from ', ex.best_rank
         else:
-            print >>sys.stderr, 'Fetching weights from ', best_peer
-            for me, peer in zip(self.model_state['layers'], new_layers):
-                if 'weights' in me: 
-                  for idx in range(len(me['weights'])): 
-                    copy_array_with_jitter(me['weights'][idx], peer['weights'][idx])
-                    copy_array_with_jitter(me['weightsInc'][idx], peer['weightsInc'][idx])
-                  copy_array_with_jitter(me['biases'], peer['biases'])
-                  copy_array_with_jitter(me['biasesInc'], peer['biasesInc'])
+            print >>sys.stderr, 'Keeping local weights.'
         
-        WORLD.Barrier()
         sync_weights = time()
-        assert self.run_worker(convnet.CopyToGPUWorker) == convnet.WorkResult.SYNC_DONE
+        if changed:
+            self.copy_to_gpu()
         sync_gpu = time()
-        print >>sys.stderr, 'Synced with peers: costs: %f weights: %f copy to gpu: %f' % (
-            sync_costs - start, sync_weights - sync_costs, sync_gpu - sync_weights)
+        print >>sys.stderr, 'Synced with peers: weights: %f (%.1f MB to %d peers) copy to gpu: %f' % (
+            sync_weights - start, ex.last_bytes / 2.0**20, len(ex.receivers), sync_gpu - sync_weights)
     
     def run_worker(self, klass):
         worker = klass(self.model)
@@ -240,6 +311,7 @@ class ConvNetRunner(object):
             if load_next: # load next batch
                 next_data = self.get_next_batch(train=False)
             test_outputs += [self.finish_batch()]
+            self.release_batch(data[2])
             if self.test_only: # Print the individual batch results for safety
                 print "batch %d: %s" % (data[1], str(test_outputs[-1]))
             if not load_next:
@@ -273,19 +345,30 @@ class ConvNetRunner(object):
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
     
-        pickle(checkpoint_file_full_path, dic, compress=self.zip_save)
-        
-        for f in sorted(os.listdir(checkpoint_dir), key=alphanum_key):
-            if sum(os.path.getsize(os.path.join(checkpoint_dir, f2)) for f2 in os.listdir(checkpoint_dir)) > self.max_filesize_mb * 1024 * 1024 and f != checkpoint_file:
-                os.remove(os.path.join(checkpoint_dir, f))
-            else:
-                break
+        if self.checkpoint_manifest is None:
+            self.checkpoint_manifest = CheckpointManifest(checkpoint_dir)
+        test_error = self.get_retention_error()
+        epoch, batchnum = self.epoch, self.batchnum
+        def prune():
+            self.checkpoint_manifest.add(checkpoint_file, os.path.getsize(checkpoint_file_full_path), epoch, batchnum, test_error,
+                                         base=self.checkpoint_writer.last_base)
+            self.checkpoint_manifest.prune(self.retention_policy)
+        self.checkpoint_writer.save(checkpoint_file_full_path, dic, codec=self.zip_save, after_write=prune)
+    
+    # The test error that --keep-best ranks checkpoints by: the logprob
+    # cost's second value (the error rate) on the latest test.
+    def get_retention_error(self):
+        if not self.test_outputs or 'logprob' not in self.test_outputs[-1][0]:
+            return None
+        return self.test_outputs[-1][0]['logprob'][1]
             
+    # Loads the newest checkpoint in load_dir, or load_dir itself if it is a file.
+    # With lazy, the weights are only read from disk once they are used.
     @staticmethod
-    def load_checkpoint(load_dir):
+    def load_checkpoint(load_dir, lazy=False):
         if os.path.isdir(load_dir):
-            return unpickle(os.path.join(load_dir, sorted(os.listdir(load_dir), key=alphanum_key)[-1]))
-        return unpickle(load_dir)
+            return load_checkpoint(os.path.join(load_dir, list_checkpoints(load_dir)[-1]), lazy=lazy)
+        return load_checkpoint(load_dir, lazy=lazy)
 
     @staticmethod
     def parse_options(op):
@@ -293,7 +376,9 @@ class ConvNetRunner(object):
             load_dic = None
             options = op.parse()
             if options["load_file"].value_given:
-                load_dic = ConvNetRunner.load_checkpoint(options["load_file"].value)
+                # only training touches every weight right away; tests and inspections may not
+                lazy = options["test_only"].value if "test_only" in options else True
+                load_dic = ConvNetRunner.load_checkpoint(options["load_file"].value, lazy=lazy)
                 old_op = load_dic["op"]
                 old_op.merge_from(op)
                 op = old_op
@@ -312,19 +397,28 @@ class ConvNetRunner(object):
     def init_model_lib(self):
         num_peers = WORLD.Get_size()
         
-        # Adjust our learning rate based on the number of other workers - more workers -> larger
-        # batch size -> higher learning rate.
-        print 'Resetting model parameters for %d peers.' % num_peers
-        rate_adjustment = num_peers / 32.
-        for l in self.layers:
-          pass
-          #if 'epsW' in l: l['epsW'] = [rate_adjustment * num_peers for w in l['epsW']]
-          #if 'epsB' in l: l['epsB'] = rate_adjustment * num_peers
-          #if 'momW' in l: l['momW'] = [w / num_peers for w in l['momW']]
-          #if 'momB' in l: l['momB'] = w / num_peers
+        # Averaging the weights of num_peers models trains on num_peers times
+        # the minibatch, so the learning rates go up to match. Momentum is a
+        # decay per update, which averaging does not change.
+        if self.exchange_mode == 'average' and num_peers > 1:
+            print 'Resetting learning rates for %d peers.' % num_peers
+            for l in self.layers:
+                if 'epsW' in l: l['epsW'] = [e * num_peers for e in l['epsW']]
+                if 'epsB' in l: l['epsB'] = l['epsB'] * num_peers
 
-        self.model = convnet.ConvNet(self.layers, self.minibatch_size, self.device_ids[0])
+        try:
+            self.model = self.model_lib.ConvNet(self.layers, self.minibatch_size, self.device_ids[0])
+        except cpuconvnet.CPUConvNetException, e:
+            print e
+            sys.exit(1)
         self.model.start()
+        if self.exchange_staleness > 0:
+            self.weight_exchanger = AsyncWeightExchanger(WORLD, self.layers, self.exchange_mode, self.exchange_threshold, self.exchange_staleness,
+                                                         sync_host=self.sync_with_host, copy_to_gpu=self.copy_to_gpu)
+        else:
+            topology = HostTopology(WORLD, self.fake_hosts) if self.exchange_topology == 'host' else None
+            self.weight_exchanger = make_weight_exchanger(self.exchange_mode, WORLD, self.layers, threshold=self.exchange_threshold,
+                                                          codec=self.exchange_codec, topology=topology)
         
     def init_model_state(self):
         ms = self.model_state
@@ -395,8 +489,22 @@ class ConvNetRunner(object):
 #        print data.shape, labels.shape
         return epoch, batch_num, [data, labels]
 
+    # Returns the module implementing the workers of the given backend.
+    def get_model_lib(self, backend):
+        if backend not in ('gpu', 'cpu'):
+            print "Unknown backend '%s'; expected gpu or cpu" % backend
+            sys.exit(1)
+        if backend == 'gpu' and convnet is None:
+            print "The gpu backend needs the compiled convnet module; build it or use --backend=cpu"
+            sys.exit(1)
+        return convnet if backend == 'gpu' else cpuconvnet
+
     def get_gpus(self):
         rank = int(WORLD.Get_rank())
+        if self.op.get_value('backend') == 'cpu':
+            self.device_ids = [-1]
+            print >> sys.stderr, 'MPI RANK: %d, cpu' % rank
+            return
         gpus = self.op.get_value('gpu')
         if gpus == [-1]:
           gpus = range(10)
@@ -407,22 +515,22 @@ class ConvNetRunner(object):
         print >> sys.stderr, 'MPI RANK: %d, device %s' % (rank, self.device_ids)
 
     def start_batch(self, batch_data, train=True):
-        cpudata = convnet.CPUData(batch_data)
+        cpudata = self.model_lib.CPUData(batch_data)
         cpudata.thisown = 0
 
         if self.check_grads:
-            worker = convnet.GradCheckWorker(self.model, cpudata)
+            worker = self.model_lib.GradCheckWorker(self.model, cpudata)
             worker.thisown = 0
             self.model.getWorkerQueue().enqueue(worker)
             res = self.model.getResultQueue().dequeue()
-            assert res.getResultType() == convnet.WorkResult.BATCH_DONE
+            assert res.getResultType() == self.model_lib.WorkResult.BATCH_DONE
         elif not train and self.multiview_test:
-            worker = convnet.MultiviewTestWorker(self.model, cpudata,
+            worker = self.model_lib.MultiviewTestWorker(self.model, cpudata,
                                                  self.tran_data_provider.num_views, self.logreg_idx)
             worker.thisown = 0
             self.model.getWorkerQueue().enqueue(worker)
         else:
-            worker = convnet.TrainingWorker(self.model, cpudata, not train)
+            worker = self.model_lib.TrainingWorker(self.model, cpudata, not train)
             worker.thisown = 0
             self.model.getWorkerQueue().enqueue(worker)
         
@@ -430,7 +538,27 @@ class ConvNetRunner(object):
         print "%d.%d..." % (self.epoch, self.batchnum),
         
     def print_train_time(self, compute_time_py):
-        print "(%.3f sec)" % (compute_time_py)
+        times = ["%.3f sec" % compute_time_py]
+        if isinstance(self.train_data_provider, PrefetchingDataProvider):
+            queued, ready = self.train_data_provider.get_queue_depth()
+            times += ["data wait %.3f sec, %d/%d batches ready" % (self.train_data_provider.last_wait_time, ready, queued)]
+        if self.exchange_staleness > 0:
+            times += ["comm wait %.3f sec" % self.weight_exchanger.take_wait_time()]
+        save_wait_time = self.checkpoint_writer.take_wait_time()
+        if save_wait_time is not None:
+            times += ["save wait %.3f sec" % save_wait_time]
+        print "(%s)" % ", ".join(times)
+        
+    def print_epoch_stats(self):
+        stats = self.train_data_provider.get_cache_stats() if hasattr(self.train_data_provider, 'get_cache_stats') else None
+        if stats is not None:
+            lookups = max(1, stats['ram_hits'] + stats['disk_hits'] + stats['misses'])
+            print "Decoded batch cache: %d RAM hits, %d disk hits, %d misses (%.1f%% hit rate), %d evictions, %d batches / %.1f MB in RAM" % (
+                    stats['ram_hits'], stats['disk_hits'], stats['misses'], 100.0 * (lookups - stats['misses']) / lookups,
+                    stats['evictions'], stats['batches'], stats['bytes'] / float(2**20))
+        if self.buffer_pool is not None:
+            stats = self.buffer_pool.get_stats()
+            print "Batch buffers: %d allocations, %d reuses, %d pooled" % (stats['allocations'], stats['reuses'], stats['pooled'])
         
     def print_costs(self, cost_outputs):
         costs, num_cases = cost_outputs[0], cost_outputs[1]
@@ -440,6 +568,7 @@ class ConvNetRunner(object):
             print ", ".join("%6f" % v for v in costs[errname]),
             if sum(m.isnan(v) for v in costs[errname]) > 0 or sum(m.isinf(v) for v in costs[errname]):
                 print "^ got nan or inf!"
+                self.stop_model()
                 sys.exit(1)
         
     def print_train_results(self):
@@ -473,7 +602,7 @@ class ConvNetRunner(object):
     def conditional_save(self):
         self.save_state()
         print "-------------------------------------------------------"
-        print "Saved checkpoint to %s" % os.path.join(self.save_path, self.save_file)
+        print "Saving checkpoint to %s" % os.path.join(self.save_path, self.save_file)
         print "=======================================================",
         
     def aggregate_test_outputs(self, test_outputs):
@@ -493,26 +622,47 @@ class ConvNetRunner(object):
         op.add_option("data-provider", "dp_type", StringOptionParser, "Data provider", default="default")
         op.add_option("test-freq", "testing_freq", IntegerOptionParser, "Testing frequency", default=25)
         op.add_option("exchange-freq", "exchange_freq", IntegerOptionParser, "Exchange frequency", default=10)
+        op.add_option("exchange-mode", "exchange_mode", StringOptionParser, "Weight exchange mode (best/average)", default="best")
+        op.add_option("exchange-threshold", "exchange_threshold", FloatOptionParser, "Fetch the best peer's weights if our cost is at least this many times its cost", default=1.05)
+        op.add_option("exchange-staleness", "exchange_staleness", IntegerOptionParser, "Exchange weights in the background, applying them at most this many batches later (0 for blocking exchanges)", default=0)
+        op.add_option("exchange-codec", "exchange_codec", StringOptionParser, "Average mode: compress weight deltas with these codec stages (e.g. fp16,zlib or topk:0.01)", default="")
+        op.add_option("exchange-topology", "exchange_topology", StringOptionParser, "Exchange topology: flat, or host to exchange within each host first and between hosts once", default="flat")
+        op.add_option("fake-hosts", "fake_hosts", IntegerOptionParser, "Host topology: split the ranks of each host over this many pretend hosts (for testing)", default=0)
+        op.add_option("prefetch", "prefetch", IntegerOptionParser, "Number of training batches to load ahead (0 to disable)", default=0)
+        op.add_option("prefetch-workers", "prefetch_workers", IntegerOptionParser, "Number of prefetch workers", default=1)
+        op.add_option("prefetch-pool", "prefetch_pool", StringOptionParser, "Prefetch pool type (thread/process)", default="thread")
+        op.add_option("decode-workers", "decode_workers", IntegerOptionParser, "ImageNet DP: image decoding processes (0 for one per core)", default=0)
+        op.add_option("cache-mb", "cache_mb", IntegerOptionParser, "ImageNet DP: megabytes of RAM for caching decoded batches", default=0)
+        op.add_option("cache-dir", "cache_dir", StringOptionParser, "ImageNet DP: directory for caching decoded batches on disk", default="")
         op.add_option("epochs", "num_epochs", IntegerOptionParser, "Number of epochs", default=500)
         op.add_option("data-path", "data_path", StringOptionParser, "Data path")
         op.add_option("save-path", "save_path", StringOptionParser, "Save path")
         op.add_option("max-filesize", "max_filesize_mb", IntegerOptionParser, "Maximum save file size (MB)", default=5000)
+        op.add_option("keep-last", "keep_last", IntegerOptionParser, "Number of newest checkpoints to keep regardless of size", default=1)
+        op.add_option("keep-best", "keep_best", IntegerOptionParser, "Number of checkpoints with the lowest test error to keep regardless of size", default=0)
+        op.add_option("keep-every", "keep_every", IntegerOptionParser, "Keep the last checkpoint of every this many epochs regardless of size (0 to disable)", default=0)
         op.add_option("max-test-err", "max_test_err", FloatOptionParser, "Maximum test error for saving")
         op.add_option("num-gpus", "num_gpus", IntegerOptionParser, "Number of GPUs", default=1)
         op.add_option("test-only", "test_only", BooleanOptionParser, "Test and quit?", default=0)
-        op.add_option("zip-save", "zip_save", BooleanOptionParser, "Compress checkpoints?", default=0)
+        op.add_option("zip-save", "zip_save", StringOptionParser, "Compress checkpoints with this codec: fast, default, best, zip (single-threaded zip) or stages like shuffle,zlib:3", default="")
+        op.add_option("full-save-freq", "full_save_freq", IntegerOptionParser, "Write every n-th checkpoint in full and the others as deltas against the last full one", default=1)
         op.add_option("test-one", "test_one", BooleanOptionParser, "Test on one batch at a time?", default=1)
         op.add_option("gpu", "gpu", ListOptionParser(IntegerOptionParser), "GPU override", default=OptionExpression("[-1] * num_gpus"))
+        op.add_option("backend", "backend", StringOptionParser, "Run the model on the gpu (CUDA) or the cpu (NumPy, slow)", default="gpu")
         op.add_option("mini", "minibatch_size", IntegerOptionParser, "Minibatch size", default=128)
         op.add_option("layer-def", "layer_def", StringOptionParser, "Layer definition file", set_once=True)
         op.add_option("layer-params", "layer_params", StringOptionParser, "Layer parameter file")
         op.add_option("check-grads", "check_grads", BooleanOptionParser, "Check gradients and quit?", default=0, excuses=['data_path', 'save_path', 'train_batch_range', 'test_batch_range'])
         op.add_option("multiview-test", "multiview_test", BooleanOptionParser, "Cropped DP: test on multiple patches?", default=0, requires=['logreg_name'])
         op.add_option("crop-border", "crop_border", IntegerOptionParser, "Cropped DP: crop border size", default=4, set_once=True)
+        op.add_option("crop-seed", "crop_seed", IntegerOptionParser, "Cropped DP: seed for random crops (-1 for unseeded)", default=-1)
         op.add_option("logreg-name", "logreg_name", StringOptionParser, "Cropped DP: logreg layer name (for --multiview-test)", default="")
         op.add_option("conv-to-local", "conv_to_local", ListOptionParser(StringOptionParser), "Convert given conv layers to unshared local", default=[])
         op.add_option("unshare-weights", "unshare_weights", ListOptionParser(StringOptionParser), "Unshare weight matrices in given layers", default=[])
         op.add_option("conserve-mem", "conserve_mem", BooleanOptionParser, "Conserve GPU memory (slower)?", default=0)
+        op.add_option("plan-buffers", "plan_buffers", BooleanOptionParser, "Share activity matrices between layers that are never live at the same time?", default=0)
+        op.add_option("layer-cache", "layer_cache", StringOptionParser, "Cache parsed layer definitions in this directory", default="")
+        op.add_option("init-workers", "init_workers", IntegerOptionParser, "Threads drawing the initial weights (0 for one per core)", default=0)
                 
         op.delete_option('max_test_err')
         op.options["max_filesize_mb"].default = 0
@@ -143,7 +143,7 @@ class OptionsParser:
                 o.set_value(dic[o.prefixed_letter])
             else:
                 # check if excused or has default
-                excused = max([o2.prefixed_letter in dic for o2 in self.options.values() if o2.excuses == self.EXCLUDE_ALL or o.name in o2.excuses])
+                excused = any([o2.prefixed_letter in dic for o2 in self.options.values() if o2.excuses == self.EXCLUDE_ALL or o.name in o2.excuses])
                 if not excused and o.default is None:
                     raise OptionMissingException("Option %s (%s) not supplied" % (o.prefixed_letter, o.desc))
                 o.set_default()
@@ -337,6 +337,8 @@ class RangeOptionParser(OptionParser):
     
     @staticmethod
     def to_string(value):
+        if len(value) == 0:
+            return ""
         return "%d-%d" % (value[0], value[-1])
     
     @staticmethod
@@ -0,0 +1,262 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# Static cost model of a layer graph. From the layer dicts built by layer.py
+# alone, it reports the forward and backward FLOPs, parameter bytes and
+# activity and gradient bytes of every layer, and the peak GPU memory of
+# training as a function of the minibatch size.
+#
+# Usage: python planner.py --layer-def=<file> --layer-params=<file> [--mini=32,64,128,256] [--gpu-mem-mb=<MB>]
+#
+# Memory follows the CUDA layers (src/layer.cu). A layer owns an activity
+# matrix unless its actsTarget names an input whose matrix it borrows. A
+# gradient consumer also gets an activity gradient matrix, unless its
+# actsGradTarget names an input whose matrix it borrows. With --plan-buffers,
+# matrices that are never live at the same time share a pooled matrix instead
+# (see LayerParser.plan_buffers). Every weight matrix lives on the GPU three
+# times: the weights, their increment and their gradient.
+#
+# No matrix is ever freed: NVMatrix::truncate keeps its allocation, so
+# --conserve-mem does not lower the peak, and the peak of a training step is
+# everything it allocates.
+#
+# FLOPs count a multiply-add as two. Pooling, normalization and neurons are
+# counted as a few operations per element; they are small next to the weight layers.
+
+from ordereddict import OrderedDict
+from options import *
+import layer as lay
+import sys
+
+FLOAT_BYTES = 4
+# The three GPU copies of every weight matrix: weights, increment and gradient.
+WEIGHT_COPIES = 3
+
+class LayerCost:
+    """The static costs of one layer. FLOPs and activity bytes are per case."""
+    def __init__(self, dic):
+        self.name, self.type = dic['name'], dic['type']
+        self.fprop_flops = self.bprop_flops = 0
+        self.param_bytes = 0
+        self.acts_bytes = dic['outputs'] * FLOAT_BYTES
+        # Scratch matrices that live from fprop until the layer's bprop: per case, and independent of the minibatch.
+        self.temp_bytes = self.temp_fixed_bytes = 0
+        # Scratch matrices that only live during the layer's bprop.
+        self.bprop_temp_bytes = self.bprop_temp_fixed_bytes = 0
+
+def _weight_flops(cost, l, consumers, macs):
+    for i, inp in enumerate(l['inputs']):
+        cost.fprop_flops += 2 * macs[i]
+        if consumers[inp]:
+            cost.bprop_flops += 2 * macs[i]
+        if l['epsW'][i] > 0:
+            cost.bprop_flops += 2 * macs[i]
+        if l['weightSourceLayerIndices'][i] < 0:
+            cost.param_bytes += l['weights'][i].size * FLOAT_BYTES
+    cost.fprop_flops += l['outputs']
+    if l['epsB'] > 0:
+        cost.bprop_flops += l['outputs']
+    cost.param_bytes += l['biases'].size * FLOAT_BYTES
+
+def fc_cost(cost, l, layers, consumers):
+    _weight_flops(cost, l, consumers, [inputs * l['outputs'] for inputs in l['numInputs']])
+
+def local_cost(cost, l, layers, consumers):
+    macs = [fc * fp * l['filters'] * l['modules'] for fc, fp in zip(l['filterChannels'], l['filterPixels'])]
+    _weight_flops(cost, l, consumers, macs)
+    if l['type'] == 'conv':
+        # With partialSum, weight gradients are summed over groups of partialSum modules in a scratch matrix first.
+        if l['partialSum'] > 0 and any(e > 0 for e in l['epsW']):
+            cost.bprop_temp_fixed_bytes = max(l['modules'] / l['partialSum'] * fc * fp * l['filters'] * FLOAT_BYTES
+                                              for fc, fp in zip(l['filterChannels'], l['filterPixels']))
+        # Oversampled sparse inputs get their gradient summed from a scratch matrix.
+        cost.bprop_temp_bytes = max([0] + [o * inputs * FLOAT_BYTES for o, inputs, inp in zip(l['overSample'], l['numInputs'], l['inputs'])
+                                           if o > 1 and consumers[inp]])
+
+def pool_cost(cost, l, layers, consumers):
+    cost.fprop_flops = l['sizeX']**2 * l['outputs']
+    cost.bprop_flops = l['sizeX']**2 * l['outputs'] if consumers[l['inputs'][0]] else 0
+
+def norm_cost(cost, l, layers, consumers):
+    window = l['size'] if l['type'] == 'cmrnorm' else l['size']**2
+    cost.fprop_flops = (window + 4) * l['outputs']
+    cost.bprop_flops = 2 * (window + 4) * l['outputs'] if consumers[l['inputs'][0]] else 0
+    # The denominators, and for cnorm the differences from the mean, are kept from fprop for bprop.
+    cost.temp_bytes = (2 if l['type'] == 'cnorm' else 1) * l['outputs'] * FLOAT_BYTES
+
+def softmax_cost(cost, l, layers, consumers):
+    cost.fprop_flops = 5 * l['outputs']
+    if consumers[l['inputs'][0]]:
+        next_layers = [l2 for l2 in layers if l['name'] in [layers[i]['name'] for i in l2.get('inputs', [])]]
+        logreg_grad = len(next_layers) == 1 and next_layers[0]['type'] == 'cost.logreg'
+        cost.bprop_flops = 2 * l['outputs'] if logreg_grad else 2 * l['outputs']**2
+
+def eltwise_cost(cost, l, layers, consumers):
+    cost.fprop_flops = 2 * len(l['inputs']) * l['outputs']
+    cost.bprop_flops = sum(consumers[i] for i in l['inputs']) * l['outputs']
+
+def cost_cost(cost, l, layers, consumers):
+    cost.fprop_flops = 2 * sum(l['numInputs'])
+    cost.bprop_flops = sum(l['numInputs'][i] for i, inp in enumerate(l['inputs']) if consumers[inp])
+
+def elementwise_cost(cost, l, layers, consumers):
+    cost.fprop_flops = l['outputs']
+    cost.bprop_flops = l['outputs'] if any(consumers[i] for i in l['inputs']) else 0
+
+# Layer type --> function(cost, layer, layers, consumers) filling in a LayerCost.
+# Types not listed here cost one operation per output in each direction.
+layer_costs = {'fc': fc_cost,
+               'conv': local_cost,
+               'local': local_cost,
+               'pool': pool_cost,
+               'rnorm': norm_cost,
+               'cnorm': norm_cost,
+               'cmrnorm': norm_cost,
+               'softmax': softmax_cost,
+               'eltsum': eltwise_cost,
+               'eltmax': eltwise_cost,
+               'cost.logreg': cost_cost,
+               'cost.sum2': cost_cost}
+
+def get_layer_costs(layers):
+    consumers = lay.LayerParser.get_grad_consumers(layers)
+    costs = []
+    for l in layers:
+        cost = LayerCost(l)
+        if 'inputs' in l:
+            layer_costs.get(l['type'], elementwise_cost)(cost, l, layers, consumers)
+        costs += [cost]
+    return costs
+
+# Returns, for every layer, the buffers holding its activities and activity
+# gradients, as keys into a dict of buffer --> size in bytes per case. Without
+# share, every layer owns its matrices; with it, the actsTarget and
+# actsGradTarget that LayerWithInputParser.optimize chose are honoured, and with
+# planned too, the pooled matrices that LayerParser.plan_buffers chose.
+def get_buffers(layers, share=True, planned=False):
+    acts, grads, sizes = [], [], {}
+    for i, l in enumerate(layers):
+        acts_target = l.get('actsTarget', -1) if share else -1
+        grad_target = l.get('actsGradTarget', -1) if share else -1
+        acts_buffer = l.get('actsBuffer', -1) if planned else -1
+        grad_buffer = l.get('actsGradBuffer', -1) if planned else -1
+        acts += [acts[l['inputs'][acts_target]] if acts_target >= 0 else ('pool', acts_buffer) if acts_buffer >= 0 else ('acts', i)]
+        grads += [grads[l['inputs'][grad_target]] if grad_target >= 0 else ('pool', grad_buffer) if grad_buffer >= 0 else ('grad', i)]
+        for key in (acts[i], grads[i]):
+            sizes[key] = max(sizes.get(key, 0), l['outputs'] * FLOAT_BYTES)
+    return acts, grads, sizes
+
+class MemoryPlan:
+    """The GPU memory of a training step: fixed bytes, plus bytes per case."""
+    def __init__(self, fixed, per_case):
+        self.fixed, self.per_case = fixed, per_case
+
+    def get_peak_bytes(self, minibatch_size):
+        return self.fixed + minibatch_size * self.per_case
+
+    # The largest minibatch size whose peak fits in budget bytes, or 0 if none does.
+    def get_max_minibatch_size(self, budget):
+        return max(0, (budget - self.fixed) / self.per_case) if self.per_case > 0 else 0
+
+# Returns the bytes per case of the activity and activity gradient matrices
+# that the given buffers (see get_buffers) allocate.
+def get_matrix_bytes(layers, buffers):
+    acts, grads, sizes = buffers
+    consumers = lay.LayerParser.get_grad_consumers(layers)
+    # Cost layers never receive a gradient.
+    live = set(acts) | set(grads[i] for i, l in enumerate(layers) if consumers[i] and not l['type'].startswith('cost.'))
+    return sum(sizes[k] for k in live)
+
+# Returns the MemoryPlan of training the given layers with the given buffers.
+# Scratch matrices are layer members, so they all stay allocated too.
+def get_memory_plan(layers, costs, buffers):
+    fixed = WEIGHT_COPIES * sum(c.param_bytes for c in costs) + sum(c.temp_fixed_bytes + c.bprop_temp_fixed_bytes for c in costs)
+    per_case = get_matrix_bytes(layers, buffers) + sum(c.temp_bytes + c.bprop_temp_bytes for c in costs)
+    return MemoryPlan(fixed, per_case)
+
+def mb(nbytes):
+    return nbytes / 1024.0**2
+
+def print_layer_costs(layers, costs):
+    acts, grads, sizes = get_buffers(layers)
+    consumers = lay.LayerParser.get_grad_consumers(layers)
+    print "%-16s %-12s %9s %12s %12s %10s %10s %10s  %s" % ("layer", "type", "outputs", "fprop MFLOP", "bprop MFLOP",
+                                                           "params MB", "acts KB", "grad KB", "shares")
+    for i, (l, c) in enumerate(zip(layers, costs)):
+        shares = []
+        if acts[i] != ('acts', i):
+            shares += ["acts of %s" % layers[acts[i][1]]['name']]
+        if grads[i] != ('grad', i):
+            shares += ["grad of %s" % layers[grads[i][1]]['name']]
+        print "%-16s %-12s %9d %12.3f %12.3f %10.2f %10.1f %10s  %s" % (l['name'], l['type'], l['outputs'], c.fprop_flops / 1e6, c.bprop_flops / 1e6,
+                                                                        mb(c.param_bytes), c.acts_bytes / 1024.0,
+                                                                        "%.1f" % (c.acts_bytes / 1024.0) if consumers[i] else "-", ", ".join(shares))
+    print "(FLOPs and activity sizes are per case)"
+
+def print_memory_plans(layers, costs, minibatch_sizes, gpu_mem_mb=0):
+    lay.LayerParser.plan_buffers(layers)
+    buffers = OrderedDict([('unshared', get_buffers(layers, share=False)),
+                           ('shared', get_buffers(layers)),
+                           ('planned', get_buffers(layers, planned=True))])
+    plans = OrderedDict((name, get_memory_plan(layers, costs, b)) for name, b in buffers.iteritems())
+    fprop_flops, bprop_flops = sum(c.fprop_flops for c in costs), sum(c.bprop_flops for c in costs)
+    print ""
+    print "Parameters: %.1f MB (%.1f MB on the GPU with increments and gradients)" % (mb(sum(c.param_bytes for c in costs)),
+                                                                                     mb(WEIGHT_COPIES * sum(c.param_bytes for c in costs)))
+    print "Activity and gradient matrices per case: %s" % ", ".join("%s %.1f KB" % (name, get_matrix_bytes(layers, b) / 1024.0)
+                                                                  for name, b in buffers.iteritems())
+    print ""
+    print "%-8s %12s %12s  %s" % ("mini", "fprop GFLOP", "bprop GFLOP", "  ".join("%18s" % ("%s MB" % name) for name in plans))
+    for size in minibatch_sizes:
+        print "%-8d %12.2f %12.2f  %s" % (size, size * fprop_flops / 1e9, size * bprop_flops / 1e9,
+                                          "  ".join("%18.1f" % mb(p.get_peak_bytes(size)) for p in plans.itervalues()))
+    if gpu_mem_mb > 0:
+        print ""
+        print "Largest minibatch in %d MB: %s" % (gpu_mem_mb, ", ".join("%s %d" % (name, p.get_max_minibatch_size(gpu_mem_mb * 1024**2))
+                                                                       for name, p in plans.iteritems()))
+
+def get_options_parser():
+    op = OptionsParser()
+    op.add_option("layer-def", "layer_def", StringOptionParser, "Layer definition file")
+    op.add_option("layer-params", "layer_params", StringOptionParser, "Layer parameter file")
+    op.add_option("data-dims", "data_dims", IntegerOptionParser, "Data dimensionality", default=3072)
+    op.add_option("num-classes", "num_classes", IntegerOptionParser, "Number of classes", default=10)
+    op.add_option("mini", "minibatch_sizes", ListOptionParser(IntegerOptionParser), "Minibatch sizes to report", default=[32, 64, 128, 256])
+    op.add_option("gpu-mem-mb", "gpu_mem_mb", IntegerOptionParser, "Report the largest minibatch that fits in this much GPU memory (MB)", default=0)
+    return op
+
+if __name__ == "__main__":
+    op = get_options_parser()
+    try:
+        op.parse()
+        op.eval_expr_defaults()
+    except OptionException, e:
+        print e
+        op.print_usage()
+        sys.exit(1)
+    model = lay.StandInRunner(op.get_value('data_dims'), op.get_value('num_classes'))
+    layers = lay.LayerParser.parse_layers(op.get_value('layer_def'), op.get_value('layer_params'), model, layers=[])
+    print ""
+    costs = get_layer_costs(layers)
+    print_layer_costs(layers, costs)
+    print_memory_plans(layers, costs, op.get_value('minibatch_sizes'), op.get_value('gpu_mem_mb'))
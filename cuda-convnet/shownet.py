@@ -67,6 +67,9 @@ class ShowConvNet(ConvNetRunner):
             
     def init_model_state(self):
         #ConvNetRunner.init_model_state(self)
+        # Features may come from any layer, so every layer keeps its own matrices.
+        for l in self.layers:
+            l['actsBuffer'] = l['actsGradBuffer'] = -1
         if self.op.get_value('show_preds'):
             self.sotmax_idx = self.get_layer_idx(self.op.get_value('show_preds'), check_type='softmax')
         if self.op.get_value('write_features'):
@@ -73,7 +73,7 @@ ConvNet::ConvNet(PyListObject* layerParams, int minibatchSize, int deviceID) : T
          
         // Execute post-initialization stuff
         for (int i = 0; i < _layers.size(); i++) {
-            _layers[i]->postInit();
+            _layers[i]->postInit(_buffers);
         }
         
         _dp = new DataProvider(minibatchSize);
@@ -56,6 +56,9 @@ Layer::Layer(PyObject* paramsDict, bool trans) :
     _actsTarget = pyDictGetInt(paramsDict, "actsTarget");
     _actsGradTarget = pyDictGetInt(paramsDict, "actsGradTarget");
     _conserveMem = pyDictGetInt(paramsDict, "conserveMem");
+    _actsBuffer = pyDictGetInt(paramsDict, "actsBuffer");
+    _actsGradBuffer = pyDictGetInt(paramsDict, "actsGradBuffer");
+    _pooledActs = false;
     _outputs = _actsTarget < 0 ? new NVMatrix() : NULL;
     _actsGrad = _actsGradTarget < 0 ? new NVMatrix() : NULL;
 }
@@ -69,11 +72,11 @@ void Layer::fpropNext(PASS_TYPE passType) {
 }
 
 void Layer::truncBwdActs() {
-    // Only truncate actsGrad if I own it
-    if (_conserveMem && _actsGradTarget < 0) { 
+    // Only truncate actsGrad if I own it, and no other layer may be using it
+    if (_conserveMem && _actsGradTarget < 0 && _actsGradBuffer < 0) { 
         getActsGrad().truncate();
     }
-    if (_conserveMem) {
+    if (_conserveMem && !_pooledActs) {
         getActs().truncate();
     }
 }
@@ -197,9 +200,27 @@ void Layer::addPrev(Layer* l) {
     _prev.push_back(l);
 }
 
-void Layer::postInit() {
+static NVMatrix* getBuffer(map<int, NVMatrix*>& buffers, int idx) {
+    if (buffers.count(idx) == 0) {
+        buffers[idx] = new NVMatrix();
+    }
+    return buffers[idx];
+}
+
+void Layer::postInit(map<int, NVMatrix*>& buffers) {
 //    _outputs = _actsTarget < 0 ? new NVMatrix() : &_prev[_actsTarget]->getActs();
     _actsGrad = _actsGradTarget < 0 ? new NVMatrix() : &_prev[_actsGradTarget]->getActsGrad();
+    // Layers that borrow a matrix come after the layer they borrow it from,
+    // so that layer's matrix is already in place.
+    if (_actsBuffer >= 0) {
+        delete _outputs;
+        _outputs = getBuffer(buffers, _actsBuffer);
+    }
+    if (_actsGradBuffer >= 0) {
+        delete _actsGrad;
+        _actsGrad = getBuffer(buffers, _actsGradBuffer);
+    }
+    _pooledActs = _actsTarget < 0 ? _actsBuffer >= 0 : _prev[_actsTarget]->hasPooledActs();
 }
 
 // Does this layer, or some layer below it, need the gradient
@@ -233,6 +254,10 @@ NVMatrix& Layer::getActs() {
     return *_outputs;
 }
 
+bool Layer::hasPooledActs() {
+    return _pooledActs;
+}
+
 NVMatrix& Layer::getActsGrad() {
     assert(_actsGrad != NULL);
     return *_actsGrad;
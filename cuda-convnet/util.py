@@ -27,10 +27,15 @@ import cPickle
 import os
 import numpy as n
 from math import sqrt
+from ordereddict import OrderedDict
 
 import glob
 import gzip
 import zipfile
+import struct
+import thread
+from ast import literal_eval
+from codec import CODEC_MAGIC, dump as codec_dump, load as codec_load
 
 class UnpickleError(Exception):
     pass
@@ -39,12 +44,11 @@ VENDOR_ID_REGEX = re.compile('^vendor_id\s+: (\S+)')
 GPU_LOCK_NO_SCRIPT = -2
 GPU_LOCK_NO_LOCK = -1
 
-try:
-    import magic
-    ms = magic.open(magic.MAGIC_NONE)
-    ms.load()
-except ImportError: # no magic module
-    ms = None
+# Leading bytes of the compressed formats unpickle() reads.
+GZIP_MAGIC = '\x1f\x8b'
+ZIP_MAGIC = 'PK\x03\x04'
+# The codec name of single-threaded zip-compressed pickles.
+ZIP_CODEC = 'zip'
 
 def gpu_count():
   devs = glob.glob('/dev/nvidia*')
@@ -63,10 +67,14 @@ def get_gpu_lock(id=-1):
         return id if got_id else GPU_LOCK_NO_LOCK
     return GPU_LOCK_NO_SCRIPT if id < 0 else id
 
+# compress is a codec (see codec.py), or True or "zip" for a zip-compressed pickle.
 def pickle(filename, data, compress=False):
-    if compress:
+    if compress is True or compress == ZIP_CODEC:
         fo = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
         fo.writestr('data', cPickle.dumps(data, -1))
+    elif compress:
+        fo = open(filename, "wb")
+        codec_dump(fo, data, compress)
     else:
         fo = open(filename, "wb")
         cPickle.dump(data, fo, protocol=cPickle.HIGHEST_PROTOCOL)
@@ -75,12 +83,16 @@ def pickle(filename, data, compress=False):
 def unpickle(filename):
     if not os.path.exists(filename):
         raise UnpickleError("Path '%s' does not exist." % filename)
-    if ms is not None and ms.file(filename).startswith('gzip'):
+    magic = read_magic(filename)
+    if magic.startswith(GZIP_MAGIC):
         fo = gzip.open(filename, 'rb')
         dict = cPickle.load(fo)
-    elif ms is not None and ms.file(filename).startswith('Zip'):
+    elif magic.startswith(ZIP_MAGIC):
         fo = zipfile.ZipFile(filename, 'r', zipfile.ZIP_DEFLATED)
         dict = cPickle.loads(fo.read('data'))
+    elif magic == CODEC_MAGIC:
+        fo = open(filename, 'rb')
+        dict = codec_load(fo)
     else:
         fo = open(filename, 'rb')
         dict = cPickle.load(fo)
@@ -88,6 +100,84 @@ def unpickle(filename):
     fo.close()
     return dict
 
+# Returns the first 8 bytes of filename, which identify its format.
+def read_magic(filename):
+    fo = open(filename, 'rb')
+    magic = fo.read(8)
+    fo.close()
+    return magic
+
+# Batch files: an 8-byte magic string, the length of the header, and a header
+# listing (name, dtype, shape, offset) for every array. The arrays follow as raw
+# C-ordered data, each starting on a page boundary so that they can be mapped
+# straight into memory.
+BATCH_FILE_MAGIC = 'CCNBATCH'
+BATCH_FILE_ALIGN = 4096
+
+def _align(offset, alignment=BATCH_FILE_ALIGN):
+    return (offset + alignment - 1) / alignment * alignment
+
+# Returns an uninitialized C-contiguous array whose data starts on an alignment boundary.
+def empty_aligned(shape, dtype=n.single, alignment=BATCH_FILE_ALIGN):
+    dtype = n.dtype(dtype)
+    nbytes = dtype.itemsize * int(n.prod(shape))
+    raw = n.empty(nbytes + alignment, dtype=n.uint8)
+    start = -raw.ctypes.data % alignment
+    return raw[start:start + nbytes].view(dtype).reshape(shape)
+
+def create_batch_file(filename, specs, magic=BATCH_FILE_MAGIC):
+    """Creates a batch file holding arrays of the given (name, dtype, shape) specs
+    and returns an OrderedDict of writable memory maps of them, to be filled in by the caller.
+    Other formats built on batch files pass their own 8-byte magic string."""
+    entries, offset = [], 0
+    for name, dtype, shape in specs:
+        entries += [(name, n.dtype(dtype).str, tuple(int(d) for d in shape), offset)]
+        offset = _align(offset + n.dtype(dtype).itemsize * int(n.prod(shape)))
+    header = repr(entries)
+    data_start = _align(len(magic) + 4 + len(header))
+
+    fo = open(filename, 'wb')
+    fo.write(magic + struct.pack('<I', len(header)) + header)
+    fo.truncate(data_start + offset)
+    fo.close()
+    return _map_batch_file(filename, entries, data_start, 'r+')
+
+def write_batch_file(filename, arrays):
+    """Writes the (name, array) pairs in arrays to a batch file. The file is
+    written under a temporary name and renamed into place when complete. The
+    temporary name is unique to the process and thread, so several writers
+    of the same file each rename a complete file into place."""
+    tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), thread.get_ident())
+    maps = create_batch_file(tmp_filename, [(name, a.dtype, a.shape) for name, a in arrays])
+    for name, a in arrays:
+        maps[name][...] = a
+    for m in maps.values():
+        m.flush()
+    del maps
+    os.rename(tmp_filename, filename)
+
+def open_batch_file(filename, mode='c', magic=BATCH_FILE_MAGIC):
+    """Maps the arrays in a batch file into memory without reading them. Returns an
+    OrderedDict of name --> array. The default copy-on-write mode lets callers
+    modify the arrays without touching the file."""
+    fo = open(filename, 'rb')
+    if fo.read(len(magic)) != magic:
+        fo.close()
+        raise UnpickleError("File '%s' does not start with %r." % (filename, magic))
+    header_len = struct.unpack('<I', fo.read(4))[0]
+    entries = literal_eval(fo.read(header_len))
+    fo.close()
+    return _map_batch_file(filename, entries, _align(len(magic) + 4 + header_len), mode)
+
+def _map_batch_file(filename, entries, data_start, mode):
+    mm = n.memmap(filename, dtype=n.uint8, mode=mode)
+    arrays = OrderedDict()
+    for name, dtype, shape, offset in entries:
+        dtype = n.dtype(dtype)
+        start = data_start + offset
+        arrays[name] = mm[start:start + dtype.itemsize * int(n.prod(shape))].view(dtype).reshape(shape)
+    return arrays
+
 def tryint(s):
     try:
         return int(s)
@@ -0,0 +1,113 @@
+# Copyright (c) 2011, Alex Krizhevsky (akrizhevsky@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# Random initial weight matrices, for WeightLayerParser.make_weights. The
+# initWDist parameter of a layer picks one of init_dists per input, and initW
+# scales it:
+#
+#   gauss       initW * N(0, 1), the default
+#   uniform     uniform on [-initW, initW]
+#   fanin       initW / sqrt(fan-in) * N(0, 1); initW=1.41 gives the scaling
+#               of He et al. for rectified linear units
+#   orthogonal  initW times a matrix with orthonormal columns (or rows, if it
+#               has more columns than rows)
+#
+# Matrices are drawn straight into their final single-precision buffer, in its
+# C or Fortran order, CHUNK_SIZE elements at a time, so drawing one takes its
+# own memory plus a chunk rather than several double-precision copies of it.
+# Every chunk has its own random stream, seeded by the matrix's seed and the
+# chunk's index, so chunks can be drawn on a pool of threads (numpy releases the
+# interpreter lock while it draws) and the result does not depend on how many
+# threads there are. Orthogonal matrices come from a QR decomposition of the
+# whole matrix, so they are drawn in double precision on one thread.
+
+from multiprocessing.pool import ThreadPool
+from ordereddict import OrderedDict
+import multiprocessing
+import numpy as n
+import numpy.random as nr
+
+# Elements per chunk.
+CHUNK_SIZE = 1 << 20
+
+class WeightInitException(Exception):
+    pass
+
+def _draw_gauss(rng, size):
+    return rng.standard_normal(size)
+
+def _draw_uniform(rng, size):
+    return rng.uniform(-1, 1, size)
+
+def _fill_chunks(out, draw, scale, seed, workers):
+    flat = out.ravel(order='A')
+    assert n.may_share_memory(flat, out)
+    def fill(start):
+        rng = nr.RandomState([seed, start / CHUNK_SIZE])
+        chunk = flat[start:start + CHUNK_SIZE]
+        n.multiply(draw(rng, chunk.size), scale, out=chunk, casting='unsafe')
+    starts = range(0, flat.size, CHUNK_SIZE)
+    if len(starts) > 1 and workers != 1:
+        pool = ThreadPool(min(len(starts), workers or multiprocessing.cpu_count()))
+        try:
+            pool.map(fill, starts, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(fill, starts)
+
+def gauss(out, scale, fan_in, seed, workers):
+    _fill_chunks(out, _draw_gauss, scale, seed, workers)
+
+def uniform(out, scale, fan_in, seed, workers):
+    _fill_chunks(out, _draw_uniform, scale, seed, workers)
+
+def fanin(out, scale, fan_in, seed, workers):
+    _fill_chunks(out, _draw_gauss, scale / n.sqrt(fan_in), seed, workers)
+
+def orthogonal(out, scale, fan_in, seed, workers):
+    rows, cols = out.shape
+    a = nr.RandomState(seed).standard_normal((max(rows, cols), min(rows, cols)))
+    q, r = n.linalg.qr(a)
+    # Fix the signs so that q is uniformly distributed over orthogonal matrices.
+    q *= n.sign(n.diag(r))
+    out[:] = scale * (q if rows >= cols else q.T)
+
+# Name --> function(out, scale, fan-in, seed, workers) filling the matrix out.
+init_dists = OrderedDict([('gauss', gauss),
+                          ('uniform', uniform),
+                          ('fanin', fanin),
+                          ('orthogonal', orthogonal)])
+
+def make_weights(dist, scale, shape, order='C', fan_in=None, seed=None, workers=0):
+    """Returns a new single-precision matrix of the given shape and order, drawn
+    from init_dists[dist]. fan_in defaults to the number of rows, and seed to a
+    draw from numpy.random's global stream. workers is the number of threads
+    drawing it, 0 meaning one per core."""
+    if dist not in init_dists:
+        raise WeightInitException("Unknown weight distribution '%s'; must be one of %s" % (dist, ", ".join(init_dists)))
+    out = n.empty(shape, dtype=n.single, order=order)
+    seed = nr.randint(2**31) if seed is None else seed
+    init_dists[dist](out, scale, shape[0] if fan_in is None else fan_in, seed, workers)
+    return out
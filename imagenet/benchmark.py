@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Microbenchmarks for the ImageNet preprocessing.
+#
+# Usage: python benchmark.py <benchmark> [options]
+
+import argparse
+import cStringIO
+import imagenet
+import numpy as N
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+# Run in a fresh interpreter, so each measurement is a worker's startup.
+STARTUP_SNIPPET = '''
+import time
+start = time.time()
+import imagenet
+imagenet.DATADIR, imagenet.LABELFILE = %r, %r
+%s
+print time.time() - start
+'''
+
+EAGER_TABLES = 'imagenet.synids(); imagenet.synid_to_name(); imagenet.synid_to_label()'
+LAZY_TABLES = 'imagenet.lookup_synid(%r)'
+
+def make_synsets(data_dir, num_synsets):
+  '''Writes num_synsets empty synset zips with a synset list and label file.'''
+  synsets = open(data_dir + '/fall11_synsets.txt', 'w')
+  labels = open(data_dir + '/synid-to-label', 'w')
+  for i in range(num_synsets):
+    synid = '%08d' % i
+    open(data_dir + '/n%s.zip' % synid, 'w').close()
+    synsets.write('%s synset %d, another name for synset %d\n' % (synid, i, i))
+    labels.write('%s %d\n' % (synid, i))
+  synsets.close()
+  labels.close()
+
+def time_startup(data_dir, tables):
+  snippet = STARTUP_SNIPPET % (data_dir, data_dir + '/synid-to-label', tables)
+  out = subprocess.check_output([sys.executable, '-c', snippet], cwd=os.path.dirname(os.path.abspath(__file__)))
+  return float(out.split()[-1])
+
+def bench_startup(args):
+  data_dir = tempfile.mkdtemp(prefix='imagenet-bench-')
+  try:
+    make_synsets(data_dir, args.synsets)
+    lazy = LAZY_TABLES % ('%08d' % (args.synsets / 2))
+    print '%-28s %10s' % ('%d synsets' % args.synsets, 'sec')
+    print '%-28s %10.4f' % ('eager tables', min(time_startup(data_dir, EAGER_TABLES) for i in range(args.repeat)))
+    print '%-28s %10.4f' % ('index build', time_startup(data_dir, lazy))
+    print '%-28s %10.4f' % ('index load', min(time_startup(data_dir, lazy) for i in range(args.repeat)))
+  finally:
+    shutil.rmtree(data_dir)
+
+def legacy_transform_image(data, size):
+  '''transform_image as it was before load_thumbnail: full decode, copy, JPEG out.'''
+  img = Image.open(cStringIO.StringIO(data)).convert('RGB')
+  out = Image.new('RGB', (size, size))
+  thumb = img.copy()
+  thumb.thumbnail((size, size), Image.BICUBIC)
+  x_off = (size - thumb.size[0]) / 2
+  y_off = (size - thumb.size[1]) / 2
+  out.paste(thumb, (x_off, y_off, x_off + thumb.size[0], y_off + thumb.size[1]))
+  bytes_out = cStringIO.StringIO()
+  out.save(bytes_out, 'jpeg')
+  return bytes_out.getvalue()
+
+def make_jpegs(num_images, width, height):
+  '''Returns num_images JPEGs of smooth random content, which compress about as well as photos.'''
+  jpegs = []
+  for i in range(num_images):
+    small = Image.fromarray(N.random.randint(0, 256, (height / 16 + 1, width / 16 + 1, 3)).astype(N.uint8))
+    bytes_out = cStringIO.StringIO()
+    small.resize((width, height), Image.BILINEAR).save(bytes_out, 'jpeg', quality=90)
+    jpegs.append(bytes_out.getvalue())
+  return jpegs
+
+def bench_transform(args):
+  jpegs = make_jpegs(args.images, args.width, args.height)
+  transforms = [('legacy jpeg', lambda: [legacy_transform_image(d, args.img_size) for d in jpegs]),
+                ('jpeg', lambda: [imagenet.transform_image(d, args.img_size, draft=False) for d in jpegs]),
+                ('jpeg + draft', lambda: [imagenet.transform_image(d, args.img_size) for d in jpegs]),
+                ('raw', lambda: imagenet.transform_images_raw(jpegs, args.img_size, draft=False)),
+                ('raw + draft', lambda: imagenet.transform_images_raw(jpegs, args.img_size))]
+  print '%-28s %10s' % ('%dx%d --> %d' % (args.width, args.height, args.img_size), 'images/sec')
+  for name, func in transforms:
+    best = None
+    for i in range(args.repeat):
+      start = time.time()
+      func()
+      elapsed = time.time() - start
+      best = elapsed if best is None else min(best, elapsed)
+    print '%-28s %10.1f' % (name, args.images / best)
+
+def get_parser():
+  parser = argparse.ArgumentParser(description='ImageNet preprocessing microbenchmarks.')
+  subparsers = parser.add_subparsers()
+
+  startup = subparsers.add_parser('startup', help='time to load the synset tables in a new worker')
+  startup.add_argument('--synsets', type=int, default=21841, help='number of synsets')
+  startup.add_argument('--repeat', type=int, default=5, help='runs to take the best of')
+  startup.set_defaults(func=bench_startup)
+
+  transform = subparsers.add_parser('transform', help='images/sec of the JPEG and raw transforms')
+  transform.add_argument('--images', type=int, default=200, help='number of source images')
+  transform.add_argument('--width', type=int, default=500, help='source image width')
+  transform.add_argument('--height', type=int, default=375, help='source image height')
+  transform.add_argument('--img-size', type=int, default=imagenet.IMAGESIZE, help='output image size')
+  transform.add_argument('--repeat', type=int, default=3, help='runs to take the best of')
+  transform.set_defaults(func=bench_transform)
+  return parser
+
+if __name__ == '__main__':
+  args = get_parser().parse_args()
+  args.func(args)
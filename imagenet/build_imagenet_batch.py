@@ -1,40 +1,129 @@
 #!/usr/bin/env python
 
 from os.path import basename
+import argparse
 import cPickle
 import glob
 import imagenet
+import leveldb
 import logging
-import mycloud
+import multiprocessing
 import os
+import shutil
+import time
+import zipfile
+import zlib
 
 logging.basicConfig(level=logging.INFO, format="%(created)f %(process)d %(levelname).1s:%(filename)s:%(lineno)3d:%(message)s")
 
+# Lists the synset zips that have been written to every batch, one per line.
+DONE_FILE = 'done'
+
 def filename_to_synid(f):
   return basename(f).split('.')[0][1:]
 
-def zip_to_batch():
-  os.system('rm "%s"/*' % imagenet.OUTPUTDIR)
-  os.system('mkdir -p "%s"' % imagenet.OUTPUTDIR)
-  
-  batch_meta = { 'label_names' : imagenet.LABEL_NAMES }
-  cPickle.dump(batch_meta, open(imagenet.OUTPUTDIR + '/batches.meta', 'w'))
-
-  from mycloud.mapreduce import MapReduce
-  from mycloud.resource import Zip, LevelDB, Pickle
-  cluster = mycloud.Cluster()
-
-  zips = glob.glob('/hdfs/imagenet/zip/*.zip')
-  zips = [f for f in zips if filename_to_synid(f) in imagenet.SYNIDS]
-  inputs = [Zip(f) for f in zips]
-  outputs = [Pickle(imagenet.OUTPUTDIR + '/batch-%d' % i) for i in range(imagenet.NUM_BATCHES)]
-
-  mr = MapReduce(cluster, 
-                 imagenet.imagenet_mapper,
-                 imagenet.imagenet_reducer,
-                 inputs, outputs)
-  mr.run()
-      
+def batch_for_key(key, num_batches):
+  return zlib.crc32(key) % num_batches
+
+def zip_members(zip_file):
+  '''Yields (filename, data) for each member of zip_file, reading one member at a time.'''
+  zf = zipfile.ZipFile(zip_file)
+  try:
+    for info in zf.infolist():
+      if not info.filename.endswith('/'):
+        yield basename(info.filename), zf.read(info)
+  finally:
+    zf.close()
+
+def map_zip(args):
+  '''Runs the mapper over one synset zip. Returns the zip's name, the number of
+  images in it and a dict of batch --> [(key, pickled record)].'''
+  zip_file, num_batches, size, raw = args
+  batches = {}
+  def output(key, value):
+    batches.setdefault(batch_for_key(key, num_batches), []).append((key, cPickle.dumps(value, -1)))
+
+  imagenet.imagenet_mapper(zip_members(zip_file), output, size, raw)
+  return basename(zip_file), sum(len(kvs) for kvs in batches.values()), batches
+
+def read_done(output_dir):
+  done_file = os.path.join(output_dir, DONE_FILE)
+  if not os.path.exists(done_file):
+    return set()
+  return set(open(done_file).read().split())
+
+def mark_done(done_file, zip_name):
+  done_file.write(zip_name + '\n')
+  done_file.flush()
+  os.fsync(done_file.fileno())
+
+def zip_to_batch(data_dir=imagenet.DATADIR, output_dir=imagenet.OUTPUTDIR, num_batches=imagenet.NUM_BATCHES,
+                 workers=0, restart=False, size=imagenet.IMAGESIZE, raw=False):
+  '''Converts the synset zips in data_dir into num_batches LevelDB batches in
+  output_dir, which ImageNetDataProvider reads directly. Images are spread over
+  the batches by a hash of their file name.
+
+  Each zip is mapped on a process pool and its records are synced to the
+  batches before the zip is recorded as done, so an interrupted run picks up
+  where it stopped unless restart is given.
+
+  Images are size x size, stored as JPEGs or, with raw, as uint8 CHW pixels.'''
+  if restart and os.path.exists(output_dir):
+    shutil.rmtree(output_dir)
+  imagenet.set_data_dir(data_dir)
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+  done = read_done(output_dir)
+  batch_meta = { 'label_names' : imagenet.get_label_names(), 'img_size' : size, 'raw' : raw }
+  if done:
+    old_meta = cPickle.load(open(output_dir + '/batches.meta'))
+    if (old_meta.get('img_size'), old_meta.get('raw', False)) != (size, raw):
+      raise ValueError('%s holds %dx%d %s images; use --restart to rebuild it.' % (
+          output_dir, old_meta.get('img_size'), old_meta.get('img_size'), 'raw' if old_meta.get('raw') else 'JPEG'))
+  cPickle.dump(batch_meta, open(output_dir + '/batches.meta', 'w'))
+
+  zips = sorted(glob.glob(data_dir + '/*.zip'))
+  zips = [f for f in zips if imagenet.has_synid(filename_to_synid(f))]
+  todo = [f for f in zips if basename(f) not in done]
+  logging.info('%d synset zips, %d already done, %d to go.', len(zips), len(zips) - len(todo), len(todo))
+  if not todo:
+    return
+
+  dbs = [leveldb.LevelDB(output_dir + '/batch-%d' % i) for i in range(num_batches)]
+  done_file = open(os.path.join(output_dir, DONE_FILE), 'a')
+  pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+
+  start = time.time()
+  num_images = 0
+  try:
+    for i, (zip_name, zip_images, batches) in enumerate(pool.imap_unordered(map_zip, [(f, num_batches, size, raw) for f in todo])):
+      for b, kvs in batches.iteritems():
+        write_batch = leveldb.WriteBatch()
+        imagenet.imagenet_reducer(kvs, write_batch.Put)
+        dbs[b].Write(write_batch, sync=True)
+      mark_done(done_file, zip_name)
+
+      num_images += zip_images
+      elapsed = time.time() - start
+      logging.info('%d/%d zips (%s, %d images). %d images in %.1f sec, %.1f images/sec, %.0f sec to go.',
+                   i + 1, len(todo), zip_name, zip_images, num_images, elapsed, num_images / elapsed,
+                   elapsed / (i + 1) * (len(todo) - i - 1))
+  finally:
+    pool.terminate()
+    done_file.close()
+
+def get_parser():
+  parser = argparse.ArgumentParser(description='Build ImageNet LevelDB batches from synset zip files.')
+  parser.add_argument('--data-dir', default=imagenet.DATADIR, help='directory holding the synset zips')
+  parser.add_argument('--output-dir', default=imagenet.OUTPUTDIR, help='directory to write the batches to')
+  parser.add_argument('--num-batches', type=int, default=imagenet.NUM_BATCHES, help='number of batches to spread the images over')
+  parser.add_argument('--workers', type=int, default=0, help='number of mapper processes (0 for one per core)')
+  parser.add_argument('--img-size', type=int, default=imagenet.IMAGESIZE, help='size of the output images')
+  parser.add_argument('--raw', action='store_true', help='store uint8 pixels instead of JPEGs')
+  parser.add_argument('--restart', action='store_true', help='discard the output of an earlier run instead of resuming it')
+  return parser
+
 if __name__ == '__main__':
-  zip_to_batch()
-  #zip_to_hbase()
+  args = get_parser().parse_args()
+  zip_to_batch(args.data_dir, args.output_dir, args.num_batches, args.workers, args.restart, args.img_size, args.raw)
@@ -1,24 +1,27 @@
 #!/usr/bin/env python
 
 from os.path import basename
-import Image
 import cStringIO
 import glob
 import logging
 import numpy as N
+import os
 import random
 import re
+import time
 import zipfile
 import cPickle
 
 from PIL import Image
 
 DATADIR = '/hdfs/imagenet/zip'
-OUTPUTDIR = '/hdfs/imagenet/batches/imagesize-%d' % IMAGESIZE
+LABELFILE = '/hdfs/imagenet/synid-to-label'
 
 NUM_BATCHES = 100
 IMAGESIZE = 64
 
+OUTPUTDIR = '/hdfs/imagenet/batches/imagesize-%d' % IMAGESIZE
+
 def synids():
   ids = glob.glob(DATADIR + '/*.zip')
   ids = [basename(x)[1:-4] for x in ids]
@@ -32,35 +35,119 @@ def synid_to_name():
   return syns
 
 def synid_to_label():
-  lines = open('/hdfs/imagenet/synid-to-label').read().strip().split('\n')
+  lines = open(LABELFILE).read().strip().split('\n')
   kv = [l.split(' ') for l in lines]
   return dict([(k, int(v)) for k, v in kv])
- 
-SYNIDS = synids()
-SYNID_NAMES = synid_to_name()
-SYNIDS = [synid for synid in SYNIDS if synid in SYNID_NAMES]
-LABEL_NAMES = [SYNID_NAMES[s] for s in SYNIDS]
-SYNID_TO_LABEL = synid_to_label() 
 
-print len(SYNIDS), ' categories.'
+# The synset tables are built once from the zip directory, the synset list and
+# the label file, and saved as an array of (synid, label, name) sorted by synid.
+# Worker processes map the saved array instead of globbing and parsing again.
+# Synsets missing from the label file are kept, as they are label names too,
+# with the label NO_LABEL.
+_index = None
+NO_LABEL = -1
+
+def index_file():
+  return DATADIR + '/synsets-index.npy'
+
+def build_synset_index():
+  names = synid_to_name()
+  labels = synid_to_label()
+  ids = sorted(synid for synid in synids() if synid in names)
+  index = N.zeros(len(ids), dtype=[('synid', 'S%d' % max([1] + [len(s) for s in ids])),
+                                   ('label', N.int32),
+                                   ('name', 'S%d' % max([1] + [len(names[s]) for s in ids]))])
+  for i, synid in enumerate(ids):
+    index[i] = (synid, labels.get(synid, NO_LABEL), names[synid])
+  return index
+
+def index_is_stale(filename):
+  mtime = os.path.getmtime(filename)
+  return any(os.path.getmtime(f) > mtime for f in (DATADIR, DATADIR + '/fall11_synsets.txt', LABELFILE))
+
+def synset_index():
+  global _index
+  if _index is None:
+    start = time.time()
+    filename = index_file()
+    if not os.path.exists(filename) or index_is_stale(filename):
+      index = build_synset_index()
+      N.save(filename + '.tmp.npy', index)
+      os.rename(filename + '.tmp.npy', filename)
+      os.utime(filename, None) # newer than the directory entry the rename just changed
+      logging.info('Built synset index of %d categories in %.3f sec.', len(index), time.time() - start)
+    _index = N.load(filename, mmap_mode='r')
+    logging.debug('Loaded synset index in %.3f sec.', time.time() - start)
+  return _index
+
+def set_data_dir(data_dir):
+  global DATADIR, _index
+  DATADIR, _index = data_dir, None
+
+# Returns the (label name, label) of synid. Raises KeyError for synids
+# without a name or without a label.
+def lookup_synid(synid):
+  index = synset_index()
+  i = index['synid'].searchsorted(synid)
+  if i == len(index) or index['synid'][i] != synid or index['label'][i] == NO_LABEL:
+    raise KeyError(synid)
+  return str(index['name'][i]), int(index['label'][i])
+
+def has_synid(synid):
+  try:
+    lookup_synid(synid)
+    return True
+  except KeyError:
+    return False
+
+def get_synids():
+  return [str(s) for s in synset_index()['synid']]
+
+def get_label_names():
+  return [str(s) for s in synset_index()['name']]
 
 def randsyn():
-  ids = SYNIDS
-  while 1:
-    synid = ids[random.randrange(len(ids))]
-    if synid in SYNID_NAMES:
-      return synid
-  
-def transform_image(data):
-  data_file = cStringIO.StringIO(data)
-  img = Image.open(data_file).convert('RGB')
-  out = Image.new('RGB', (IMAGESIZE, IMAGESIZE))
+  ids = synset_index()['synid']
+  return str(ids[random.randrange(len(ids))])
   
-  thumb = img.copy()
-  thumb.thumbnail((IMAGESIZE, IMAGESIZE), Image.BICUBIC)
+def load_thumbnail(data, size=IMAGESIZE, draft=True):
+  '''Decodes a JPEG and shrinks it to fit in size x size, keeping its aspect ratio.
+  With draft, the JPEG decoder itself downscales by up to 8x first, which is
+  much cheaper than decoding at full size when the source is large.'''
+  img = Image.open(cStringIO.StringIO(data))
+  if draft:
+    img.draft('RGB', (size, size))
+  img = img.convert('RGB')
+  img.thumbnail((size, size), Image.BICUBIC)
+  return img
+
+def transform_image_raw(data, size=IMAGESIZE, draft=True, out=None):
+  '''Returns the image as a uint8 array of shape (3, size, size), centered on a
+  black background. The pixels are written into out if given.'''
+  thumb = load_thumbnail(data, size, draft)
+  if out is None:
+    out = N.empty((3, size, size), dtype=N.uint8)
+  out[...] = 0
+
+  x_off = (size - thumb.size[0]) / 2
+  y_off = (size - thumb.size[1]) / 2
+  out[:, y_off:y_off + thumb.size[1], x_off:x_off + thumb.size[0]] = N.asarray(thumb).transpose(2, 0, 1)
+  return out
+
+def transform_images_raw(datas, size=IMAGESIZE, draft=True):
+  '''Returns the images in datas as a uint8 array of shape (len(datas), 3, size, size).'''
+  out = N.empty((len(datas), 3, size, size), dtype=N.uint8)
+  for i, data in enumerate(datas):
+    transform_image_raw(data, size, draft, out[i])
+  return out
+
+def transform_image(data, size=IMAGESIZE, draft=True):
+  '''Returns the image as a size x size JPEG, centered on a black background.'''
+  thumb = load_thumbnail(data, size, draft)
+  out = Image.new('RGB', (size, size))
 
-  x_off = (IMAGESIZE - thumb.size[0]) / 2
-  y_off = (IMAGESIZE - thumb.size[1]) / 2
+  x_off = (size - thumb.size[0]) / 2
+  y_off = (size - thumb.size[1]) / 2
   box = (x_off, y_off, x_off + thumb.size[0], y_off + thumb.size[1])
   out.paste(thumb, box)
 
@@ -68,13 +155,19 @@ def transform_image(data):
   out.save(bytes_out, 'jpeg')
   return bytes_out.getvalue()
 
-def imagenet_mapper(kv_iter, output):
+# With raw, records hold the (3, size, size) uint8 pixels, saving the training
+# side a JPEG decode per image and the images a second lossy compression.
+def imagenet_mapper(kv_iter, output, size=IMAGESIZE, raw=False):
   for filename, img in kv_iter:
     synid = filename.split('_')[0][1:]
-    label_name = SYNID_NAMES[synid]
-    label = SYNID_TO_LABEL[synid]
-    output(filename, { 
-             'data' : transform_image(img), 'label' : label, 'label_name' : label_name, 'synid' : synid })
+    label_name, label = lookup_synid(synid)
+    record = { 'label' : label, 'label_name' : label_name, 'synid' : synid }
+    if raw:
+      record['data'] = transform_image_raw(img, size).tostring()
+      record['shape'] = (3, size, size)
+    else:
+      record['data'] = transform_image(img, size)
+    output(filename, record)
 
 def imagenet_reducer(kv_iter, output):
   for filename, data in kv_iter: